@@ -2,52 +2,118 @@ import os
 import sys
 import importlib
 
-from .config import SETTINGS, VARSPACE
+from .config import SETTINGS, VARSPACE, INITIALIZERS
 
 from .version import __version__
-print('HAPI2 version: ',__version__)
 
-# Import HAPI library (avoiding on-import stdout output).
-__devnull__ = open(os.devnull, 'w')
-__stdout__ = sys.stdout
-sys.stdout = __devnull__
-import hapi
-sys.stdout = __stdout__
-
-# Read config file.
-from . import config
-config.init()
-
-# Initialize the database backend module.
-from . import db
-db.init()
-
-# Initialize the web API module.
-from . import web
-web.init()
-
-# Initialize the provenance module.
-from . import provenance
-provenance.init()
-
-# Initialize the opacity module.
-from . import opacity
-opacity.init()
-
-# Do higher-level imports.
-from hapi2.collect import Collection
-from hapi2.utils import tic,toc,tictoc
-from hapi2.format.utils import read_header
-
-db_backend = VARSPACE['db_backend']
-
-session = VARSPACE['session']
-
-provenance = VARSPACE['prov_backend']
-
-opacity = VARSPACE['opacity']
-
-storage2cache = db_backend.storage2cache
+# Subsystems are initialized lazily, on the first access to their objects
+# (hapi2.Molecule, hapi2.session, VARSPACE['db_backend'], etc.),
+# or explicitly by calling hapi2.init().
+__subsystems__ = {}
+
+def init_hapi_():
+    print('HAPI2 version: ',__version__)
+    # Import HAPI library (avoiding on-import stdout output).
+    __devnull__ = open(os.devnull, 'w')
+    __stdout__ = sys.stdout
+    sys.stdout = __devnull__
+    try:
+        import hapi
+    finally:
+        sys.stdout = __stdout__
+        __devnull__.close()
+
+def init_config_(**argv):
+    # Read config file.
+    config = importlib.import_module('hapi2.config')
+    config.init(**argv)
+
+def init_db_():
+    # Initialize the database backend module.
+    db = importlib.import_module('hapi2.db')
+    db.init()
+    db_backend = VARSPACE['db_backend']
+    __exports__.update({
+        'db_backend':db_backend,
+        'session':VARSPACE['session'],
+        'storage2cache':db_backend.storage2cache,
+        'save_columns':db_backend.save_columns,
+        'load_columns':db_backend.load_columns,
+        'drop_columns':db_backend.drop_columns,
+        'columns2cache':db_backend.columns2cache,
+        'create_indexes':db_backend.create_indexes,
+        'drop_indexes':db_backend.drop_indexes,
+    })
+    for _ in __db_backend_objects__:
+        __exports__[_] = getattr(db_backend.models, _)
+
+def init_web_():
+    # Initialize the web API module.
+    web = importlib.import_module('hapi2.web')
+    web.init()
+    for _ in __web_api_objects__:
+        __exports__[_] = getattr(web.api, _)
+
+def init_provenance_():
+    # Initialize the provenance module.
+    provenance = importlib.import_module('hapi2.provenance')
+    provenance.init()
+    __exports__['provenance'] = VARSPACE['prov_backend']
+
+def init_opacity_():
+    # Initialize the opacity module.
+    opacity = importlib.import_module('hapi2.opacity')
+    opacity.init()
+    opacity = VARSPACE['opacity']
+    __exports__['opacity'] = opacity
+    for _ in __opacity_objects__:
+        __exports__[_] = getattr(opacity, _)
+
+# Subsystem: (initializer, required subsystems).
+__initializers__ = {
+    'config': (init_config_, ['hapi']),
+    'hapi': (init_hapi_, []),
+    'db': (init_db_, ['config']),
+    'provenance': (init_provenance_, ['db']),
+    'web': (init_web_, ['db']),
+    'opacity': (init_opacity_, ['db','provenance']),
+}
+
+def init_subsystem_(name,**argv):
+    """
+    Initialize the subsystem and the subsystems it requires (once).
+    """
+    if name in __subsystems__: return
+    __subsystems__[name] = False # in progress
+    initializer,requires = __initializers__[name]
+    for req in requires:
+        init_subsystem_(req)
+    initializer(**argv)
+    __subsystems__[name] = True
+    module = sys.modules[__name__]
+    for key,value in __exports__.items():
+        setattr(module,key,value)
+
+def init(**argv):
+    """
+    Initialize all HAPI2 subsystems: read the config file, start the database backend,
+    web API, provenance and opacity modules.
+    Arguments override the settings of the config file (see hapi2.config.init).
+    Without the explicit call, the subsystems are initialized on the first access.
+    """
+    if argv and 'config' in __subsystems__:
+        raise Exception('HAPI2 settings are already initialized')
+    init_subsystem_('config',**argv)
+    for name in __initializers__:
+        init_subsystem_(name)
+
+# Runtime objects in VARSPACE made by the subsystems.
+for _key,_name in [('settings','config'),('engine','db'),('session','db'),('db_backend','db'),
+        ('prov_backend','provenance'),('opacity','opacity')]:
+    INITIALIZERS[_key] = lambda name=_name: init_subsystem_(name)
+
+# Objects exported by the initialized subsystems.
+__exports__ = {}
 
 __db_backend_objects__ = [
     'query',
@@ -57,9 +123,6 @@ __db_backend_objects__ = [
     'MoleculeCategory','CIACrossSection','CollisionComplex',
     'CollisionComplexAlias','PartitionFunction'
 ]
-for _ in __db_backend_objects__:
-    setattr(sys.modules[__name__], _, 
-        getattr(db_backend.models, _))
 
 __web_api_objects__ = [
     'fetch_molecule_categories','fetch_parameter_metas',
@@ -68,16 +131,42 @@ __web_api_objects__ = [
     'fetch_molecules','fetch_collision_complexes',
     'fetch_cia_cross_section_headers','fetch_cia_cross_section_spectra',
     'fetch_cia_cross_sections','fetch_partition_functions','fetch_info',
+    'fetch_files',
 ]
-for _ in __web_api_objects__:
-    setattr(sys.modules[__name__], _, 
-        getattr(web.api, _))
 
 __opacity_objects__ = [
     'Mixture','Conditions',
 ]
 
-for _ in __opacity_objects__:
-    setattr(sys.modules[__name__], _, 
-        getattr(opacity, _))
-
+__lazy_objects__ = {
+    'db_backend':'db', 'session':'db', 'storage2cache':'db',
+    'save_columns':'db', 'load_columns':'db', 'drop_columns':'db',
+    'columns2cache':'db', 'create_indexes':'db', 'drop_indexes':'db',
+    'provenance':'provenance', 'opacity':'opacity',
+}
+__lazy_objects__.update({_:'db' for _ in __db_backend_objects__})
+__lazy_objects__.update({_:'web' for _ in __web_api_objects__})
+__lazy_objects__.update({_:'opacity' for _ in __opacity_objects__})
+
+# Higher-level imports, which don't need the initialization.
+__lazy_imports__ = {
+    'Collection':'hapi2.collect',
+    'tic':'hapi2.utils', 'toc':'hapi2.utils', 'tictoc':'hapi2.utils',
+    'read_header':'hapi2.format.utils',
+}
+
+# "from hapi2 import *" initializes all subsystems.
+__all__ = ['SETTINGS','VARSPACE','init'] + \
+    list(__lazy_objects__) + list(__lazy_imports__)
+
+def __getattr__(name):
+    if name in __lazy_objects__:
+        init_subsystem_(__lazy_objects__[name])
+        if name in __exports__:
+            return __exports__[name]
+    elif name in __lazy_imports__:
+        return getattr(importlib.import_module(__lazy_imports__[name]),name)
+    raise AttributeError('module %r has no attribute %r'%(__name__,name))
+
+def __dir__():
+    return sorted(set(globals())|set(__lazy_objects__)|set(__lazy_imports__))
@@ -19,6 +19,17 @@ SETTINGS_DEFAULT = {
     'echo': False,
     
     # "abscoef" settings
+    'lbl_line_budget': None, # maximum number of lines in RAM for LBL_CALC (None means all lines)
+    'numba_cache': False, # cache the compiled Numba kernels on disk (see hapi2.opacity.warmup)
+    'numba_cache_dir': None, # folder of the Numba cache (None means __pycache__ of the kernels)
+    
+    # ingest settings
+    'ingest_workers': None, # number of parsing processes (None means number of CPUs)
+    'ingest_queue_depth': None, # shards parsed ahead of the writer (None means 2*ingest_workers)
+    'columnar_store': False, # write the columnar store of the linelist at ingest (see save_columns)
+    'columnar_dir': None, # folder of the columnar store (None means "<database>.columns" in database_dir)
+    'blob_compressor': 'zlib', # compressor of the array blobs: none, zlib, zstd or lz4 (see pack_array)
+    'blob_shuffle': True, # shuffle bytes of the array blobs before compression
     
     # web api settings
     'api_version':'v2',
@@ -28,14 +39,36 @@ SETTINGS_DEFAULT = {
     'tmpdir': '~tmp',
     'api_key': None,
     'info': 'server_info.json', # ?
+    'fetch_workers': 8, # number of concurrent downloads (see fetch_files)
+    'fetch_host_limit': 4, # maximum number of concurrent downloads from one host
+    'fetch_retries': 3, # number of retries of the failed downloads
+    'fetch_backoff': 1.0, # delay before the first retry (sec), doubled for each next retry
+    'fetch_gzip': True, # accept the gzip transfer encoding (decompressed on the fly)
+    'fetch_cache': True, # keep the downloaded files in the persistent cache (see DownloadCache)
+    'fetch_cache_dir': None, # folder of the download cache (None means "cache" in tmpdir)
+    'fetch_cache_size': 10*2**30, # maximum size of the download cache (bytes)
+    'fetch_pipelined': False, # insert the transitions while they are downloaded (see fetch_transitions)
+    'fetch_pipeline_depth': 16, # downloaded chunks buffered ahead of the parser
 }
 
 SETTINGS = {}
 
-VARSPACE = {
-    'engine': None, 
-    'session': None, 
-}
+# Initializers of the runtime objects (see hapi2.init).
+INITIALIZERS = {}
+
+class Varspace(dict):
+    """
+    Dictionary of the runtime objects (settings, engine, session, backends).
+    The missing object is made by its initializer on the first access,
+    so the subpackages can be imported before hapi2.init is called.
+    """
+    def __missing__(self,key):
+        if key not in INITIALIZERS:
+            raise KeyError(key)
+        INITIALIZERS[key]()
+        return dict.__getitem__(self,key)
+
+VARSPACE = Varspace()
 
 def check_settings():
     if 'database' not in SETTINGS:
@@ -97,6 +130,7 @@ def read_local_config(config=None):
     with open(CONFIG_FILE) as f:
         dct = json.load(f)
         
+    SETTINGS.update(SETTINGS_DEFAULT) # settings missing in the older config files
     SETTINGS.update(dct)
     print('Updated SETTINGS_DEFAULT by local config file (%s).'%\
         os.path.abspath(config))
@@ -118,3 +152,5 @@ def init(**argv):
 
     # Check settings for the most essential parameters.
     check_settings()
+
+    VARSPACE['settings'] = SETTINGS
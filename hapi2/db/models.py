@@ -7,9 +7,10 @@ from hapi2.config import VARSPACE
 from hapi2.utils.formula import molweight,atoms,natoms
 
 from hapi2.utils.xsc import compress_zlib, decompress_zlib, \
-    pack_double, unpack_double, pack_float, unpack_float
+    pack_double, unpack_double, pack_float, unpack_float, \
+    pack_array, unpack_array
 
-from hapi import putRowObjectToString,HITRAN_DEFAULT_HEADER, AtoB
+from hapi import putRowObjectToString,HITRAN_DEFAULT_HEADER
 
 def get_alias_class(cls):
     """
@@ -191,6 +192,54 @@ class CRUD:
     def all(cls):
         raise NotImplementedError
                    
+# Process-wide cache of the partition function tables: source id -> {(M,I):table}
+PFUNC_CACHE = {}
+
+class PartitionFunctionTable:
+    """
+    Piecewise-polynomial table of the partition function.
+    Uses the same 3- and 4-point Lagrange interpolation as hapi.AtoB,
+    but the polynomials are precomputed for each interval of the TT grid,
+    so the partition function is evaluated for the arrays of temperatures at once.
+    """
+
+    def __init__(self,TT,QQ,tmin=None,tmax=None):
+        TT = np.asarray(TT,dtype=np.float64)
+        QQ = np.asarray(QQ,dtype=np.float64)
+        npt = len(TT)
+        if npt<4:
+            raise Exception('partition function table must have at least 4 points')
+        if np.any(np.diff(TT)<=0):
+            raise Exception('temperatures of the partition function must be strictly increasing')
+        self.TT = TT
+        self.tmin = TT[0] if tmin is None else tmin
+        self.tmax = TT[-1] if tmax is None else tmax
+        # Interval (TT[k-1],TT[k]] uses the nodes TT[k-2:k+2], 
+        # the first and the last intervals use 3 nodes (see hapi.AtoB).
+        K = np.arange(1,npt)
+        START = np.clip(K-2,0,npt-4)
+        START[-1] = npt-3
+        self.T0 = TT[START]
+        self.COEFS = np.zeros((npt-1,4))
+        for npts,INTERVALS in [(4,slice(1,-1)),(3,[0,-1])]:
+            NODES = START[INTERVALS][:,None]+np.arange(npts)
+            X = TT[NODES]-self.T0[INTERVALS][:,None]
+            V = X[:,:,None]**np.arange(npts)
+            self.COEFS[INTERVALS,:npts] = np.linalg.solve(V,QQ[NODES][:,:,None])[:,:,0]
+
+    def __call__(self,T):
+        """
+        Partition function at the temperature T (scalar or array).
+        """
+        T = np.asarray(T,dtype=np.float64)
+        if np.any(T<self.tmin) or np.any(T>self.tmax):
+            raise Exception('out of temperature range: %s'%str((self.tmin,self.tmax)))
+        INDEX = np.clip(np.searchsorted(self.TT,T,side='left'),1,len(self.TT)-1)-1
+        X = T-self.T0[INDEX]
+        C = self.COEFS[INDEX]
+        Q = ((C[...,3]*X+C[...,2])*X+C[...,1])*X+C[...,0]
+        return Q if Q.ndim else float(Q)
+
 class PartitionFunction:
     """ Follows the definition of Partition Function given in 
         Gamache RR, et al. DOI:10.1016/j.jqsrt.2017.03.045 """
@@ -293,25 +342,48 @@ class PartitionFunction:
         return self.Q(T)
 
     def Q(self,T):
-        if 'data' not in self.__dict__:
-            self.data = self.get_data()
-        TT = self.data[0]
-        QQ = self.data[1]
-        Tmin = self.tmin
-        Tmax = self.tmax
-        if T<Tmin or T>Tmax:
-            raise Exception('out of temperature range: %s'%str((Tmin,Tmax)))
-        Qt = AtoB(T,TT,QQ,len(TT))
-        return Qt
+        """
+        Partition function at the temperature T (scalar or array).
+        """
+        return self.get_table()(T)
+
+    def get_table(self):
+        """
+        Get the interpolation table, which is made once per object.
+        """
+        if 'table' not in self.__dict__:
+            TT,QQ = self.get_data()
+            self.table = PartitionFunctionTable(TT,QQ,self.tmin,self.tmax)
+        return self.table
+
+    @classmethod
+    def get_tables(cls,source):
+        """
+        Get the interpolation tables of the source's partition functions {(M,I):table}.
+        The tables are cached process-wide by the source and isotopologue,
+        so the repeated calculations don't query the database.
+        """
+        if source.id in PFUNC_CACHE:
+            return PFUNC_CACHE[source.id]
+        tables = {}
+        for pfunc in source.partition_functions:
+            M = pfunc.isotopologue.molecule.id
+            I = pfunc.isotopologue.isoid
+            tables[(M,I)] = pfunc.get_table()
+        if source.id is not None:
+            PFUNC_CACHE[source.id] = tables
+        return tables
         
     def set_data(self,TT,QQ):
-        self.b__TT__ = compress_zlib(pack_double(TT))
-        self.b__QQ__ = compress_zlib(pack_double(QQ))
+        self.b__TT__ = pack_array(TT)
+        self.b__QQ__ = pack_array(QQ)
+        self.__dict__.pop('table',None)
+        PFUNC_CACHE.clear()
 
     def get_data(self):
         TT = None; QQ = None
-        if self.b__TT__: TT = np.array(unpack_double(decompress_zlib(self.b__TT__)))
-        if self.b__QQ__: QQ = np.array(unpack_double(decompress_zlib(self.b__QQ__)))
+        if self.b__TT__: TT = unpack_array(self.b__TT__)
+        if self.b__QQ__: QQ = unpack_array(self.b__QQ__)
         return TT,QQ
 
     def __str__(self):
@@ -320,6 +392,27 @@ class PartitionFunction:
     def __repr__(self):
         return self.__str__()
 
+def is_uniform_grid_(nu,rtol=1e-6):
+    """
+    Check if the sorted wave number grid has the constant step.
+    """
+    if len(nu)<3: return True
+    step = (nu[-1]-nu[0])/(len(nu)-1)
+    return step>0 and np.abs(np.diff(nu)-step).max()<=rtol*step
+
+def get_uniform_index_(nu,value):
+    """
+    Get the index of the value in the uniform grid (the same as bisect).
+    The index is calculated from the grid step and corrected for the rounding errors.
+    """
+    n = len(nu)
+    if n<2: return int(np.searchsorted(nu,value,side='right'))
+    step = (nu[-1]-nu[0])/(n-1)
+    i = int(min(max(np.floor((value-nu[0])/step)+1,0),n))
+    while i>0 and nu[i-1]>value: i -= 1
+    while i<n and nu[i]<=value: i += 1
+    return i
+
 class CrossSectionData:
     """
     Stores the actual data for the header given in CrossSection.
@@ -344,7 +437,7 @@ class CrossSectionData:
                 self.header.numax,self.header.npnts)
         else:
             try:
-                return np.array(unpack_double(decompress_zlib(data_nu)))
+                return unpack_array(data_nu)
             except Exception as e:
                 print('nu is empty: %s'%e)
                 return None
@@ -355,13 +448,13 @@ class CrossSectionData:
             print('xsc is empty')
             return None
         else:
-            return np.array(unpack_double(decompress_zlib(data_xsc)))
+            return unpack_array(data_xsc)
 
     def pack_nu(self,nu):
-        self.b__nu__ = compress_zlib(pack_double(nu))
+        self.b__nu__ = pack_array(nu)
 
     def pack_xsc(self,xsc):
-        self.b__xsc__ = compress_zlib(pack_double(xsc))
+        self.b__xsc__ = pack_array(xsc)
 
 class CrossSection:
 
@@ -470,6 +563,7 @@ class CrossSection:
         elif len(nu)!=len(xsc):
             raise Exception('nu and xsc must have the same length')
         self.data = VARSPACE['db_backend'].models.CrossSectionData(nu,xsc)
+        self.__dict__.pop('data_cache_',None)
         if nu is not None:
             #self.data.pack_nu(nu)
             self.numin = min(nu)
@@ -479,25 +573,46 @@ class CrossSection:
     def get_data(self):
         """
         Get the spectral data from the "data" relation.
+        Decoded arrays are read-only and cached on the object until set_data is called.
+        """
+        if 'data_cache_' not in self.__dict__:
+            # Search for the data blob first.
+            if not self.data:
+                return None,None
+            nu,xsc = self.data.unpack_nu(), self.data.unpack_xsc()
+            for arr in (nu,xsc):
+                if arr is not None: arr.flags.writeable = False
+            self.data_cache_ = {'nu':nu,'xsc':xsc}
+        return self.data_cache_['nu'],self.data_cache_['xsc']
+
+    def get_sorted_data_(self):
+        """
+        Get the spectral data sorted by wave number, and the flag of the uniform grid.
+        Sortedness and uniformity are checked once and cached with the data.
         """
-        # Search for the data blob first.
-        if self.data:
-            return self.data.unpack_nu(), self.data.unpack_xsc()
-        return None,None
+        nu,xsc = self.get_data()
+        cache = self.data_cache_
+        if 'uniform' not in cache:
+            if np.any(nu[1:]<nu[:-1]):
+                sort_ind = np.argsort(nu,kind='stable')
+                nu = nu[sort_ind]; xsc = xsc[sort_ind]
+                nu.flags.writeable = False; xsc.flags.writeable = False
+            cache['nu_sorted'] = nu; cache['xsc_sorted'] = xsc
+            cache['uniform'] = not self.data.b__nu__ or is_uniform_grid_(nu)
+        return cache['nu_sorted'],cache['xsc_sorted'],cache['uniform']
 
     def range(self,numin=None,numax=None):
         """
         Get the part of the cross section
         lying within the given wave number range.
         """
-        from bisect import bisect
-        nu,xsc = self.get_data()
-        if numin is None: numin = min(nu) - 10
-        if numax is None: numax = max(nu) + 10
-        nu = np.array(nu); xsc = np.array(xsc)
-        sort_ind = np.argsort(nu) # works faster than the latter option
-        nu = nu[sort_ind]; xsc = xsc[sort_ind]
-        i1 = bisect(nu,numin); i2 = bisect(nu,numax)
+        nu,xsc,uniform = self.get_sorted_data_()
+        if numin is None: numin = nu[0] - 10
+        if numax is None: numax = nu[-1] + 10
+        if uniform:
+            i1 = get_uniform_index_(nu,numin); i2 = get_uniform_index_(nu,numax)
+        else:
+            i1,i2 = np.searchsorted(nu,[numin,numax],side='right')
         nu_cut = nu[i1:i2]; xsc_cut = xsc[i1:i2]
         return nu_cut,xsc_cut
 
@@ -512,9 +627,9 @@ class CrossSection:
         Calculate integrated intensity in
         the given spectral region.
         """
-        from scipy.integrate import trapz
+        from scipy.integrate import trapezoid
         nu_cut,xsc_cut = self.range(numin,numax)
-        return trapz(xsc_cut,nu_cut)
+        return trapezoid(xsc_cut,nu_cut)
 
     def interpolate(self,grid,clean=False):
         from scipy.interpolate import interp1d,Akima1DInterpolator,PchipInterpolator
@@ -652,6 +767,7 @@ class CIACrossSection(CrossSection):
         elif len(nu)!=len(xsc):
             raise Exception('nu and xsc must have the same length')
         self.data = VARSPACE['db_backend'].models.CIACrossSectionData(nu,xsc)
+        self.__dict__.pop('data_cache_',None)
         if nu is not None:
             #self.data.pack_nu(nu)
             self.numin = min(nu)
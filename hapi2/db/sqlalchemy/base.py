@@ -9,11 +9,13 @@ import sqlalchemy
 from sqlalchemy import create_engine
 from sqlalchemy.orm.collections import InstrumentedList
 
-from sqlalchemy import Table,Column,String,Integer,Boolean,Float,Date,DateTime,BLOB,PickleType,ForeignKey
+from sqlalchemy import MetaData,Table,Column,String,Integer,Boolean,Float,Date,DateTime,BLOB,PickleType,ForeignKey
 
 from sqlalchemy import Index
 
 from sqlalchemy.dialects.mysql import LONGBLOB,TEXT,DOUBLE
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import deferred
 from sqlalchemy import inspect
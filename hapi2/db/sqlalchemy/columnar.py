@@ -0,0 +1,327 @@
+""" Columnar binary store of the linelist transitions with the memory-mapped reads """
+
+import os
+import json
+import shutil
+from operator import itemgetter
+
+import numpy as np
+
+from hapi import LOCAL_TABLE_CACHE, HITRAN_DEFAULT_HEADER
+from hapi2.config import SETTINGS, VARSPACE
+
+COLUMNAR_HEADER = 'header.json'
+COLUMNAR_FETCH_SIZE = 100000 # number of rows fetched from the database at once
+
+def get_columnar_root_():
+    """
+    Get the root folder of the columnar store
+    (default: "<database>.columns" near the database file).
+    """
+    root = SETTINGS.get('columnar_dir')
+    if root is None:
+        root = os.path.join(SETTINGS['database_dir'],SETTINGS['database']+'.columns')
+    return root
+
+def get_columnar_dir(llst_name):
+    """
+    Get the folder with the columnar files of the linelist.
+    """
+    return os.path.join(get_columnar_root_(),llst_name)
+
+def get_column_dtype_(column):
+    """
+    Get Numpy dtype for the table column.
+    """
+    python_type = column.type.python_type
+    if python_type is int:
+        return np.dtype(np.int64)
+    elif python_type is float:
+        return np.dtype(np.float64)
+    elif python_type is str and column.type.length:
+        return np.dtype('U%d'%column.type.length)
+    return np.dtype(object)
+
+def get_fill_value_(dtype):
+    """
+    Get the value substituting NULLs in the column of the given dtype.
+    """
+    if dtype.kind=='f':
+        return np.nan
+    elif dtype.kind=='i':
+        return -1
+    elif dtype.kind=='U':
+        return ''
+    return None
+
+def rows_to_arrays_(rows,dtypes,fill_values):
+    """
+    Fill the typed arrays column by column from the fetched rows 
+    (np.fromiter, without the intermediate lists), replacing NULLs with the fill values.
+    Returns the list of arrays and the list of NULL masks (None for columns without NULLs).
+    """
+    ARRAYS = []; MASKS = []
+    n = len(rows)
+    for i,(dtype,fill_value) in enumerate(zip(dtypes,fill_values)):
+        col = itemgetter(i)
+        if fill_value is not None and None in map(col,rows):
+            MASKS.append(np.fromiter((val is None for val in map(col,rows)),dtype=bool,count=n))
+            ARRAYS.append(np.fromiter((fill_value if val is None else val for val in map(col,rows)),
+                dtype=dtype,count=n))
+        else:
+            MASKS.append(None)
+            ARRAYS.append(np.fromiter(map(col,rows),dtype=dtype,count=n))
+    return ARRAYS,MASKS
+
+def execute_raw_(stmt):
+    """
+    Execute the statement with the DB-API cursor of the current session connection,
+    skipping the SQLAlchemy result processing. The statement is compiled with
+    the bound parameters passed to the cursor in the paramstyle of the dialect.
+    """
+    conn = VARSPACE['session'].connection()
+    compiled = stmt.compile(dialect=conn.dialect,compile_kwargs={'render_postcompile':True})
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    cursor = conn.connection.driver_connection.cursor()
+    cursor.execute(str(compiled),params)
+    return cursor
+
+def execute_for_arrays_(stmt,dtypes):
+    """
+    Execute the statement returning the cursor-like result. 
+    Numeric and string columns are fetched with the raw DB-API cursor,
+    other types go through the SQLAlchemy result processors.
+    """
+    if any(dtype.hasobject for dtype in dtypes):
+        return VARSPACE['session'].execute(stmt)
+    return execute_raw_(stmt)
+
+def iter_array_chunks_(result,dtypes,fill_values,chunk_size=COLUMNAR_FETCH_SIZE):
+    """
+    Stream the cursor of the executed statement with fetchmany.
+    Yields the typed arrays and NULL masks for each chunk of rows (see rows_to_arrays_).
+    """
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows: break
+            yield rows_to_arrays_(rows,dtypes,fill_values)
+    finally:
+        result.close()
+
+def read_arrays(cls,query=None,colnames=None,fill_values=None,chunk_size=COLUMNAR_FETCH_SIZE):
+    """
+    Read the columns of the query result directly into the typed Numpy arrays
+    bypassing the ORM objects: float64 for floats, int64 for integers, 
+    fixed-width unicode for strings. NULLs are replaced with the fill values
+    (default: nan for floats, -1 for integers, empty string for strings).
+    Returns the dictionary of arrays.
+        cls - model class
+        query - query of the model objects (default: all objects)
+        colnames - names of the columns to read (default: all columns of the model table)
+        fill_values - dictionary of the fill values by column names
+        chunk_size - number of rows fetched at once
+    """
+    session = VARSPACE['session']
+    model = getattr(VARSPACE['db_backend'].models,cls.__name__)
+
+    if query is None:
+        query = session.query(model)
+    if colnames is None:
+        colnames = [col.name for col in model.__table__.columns]
+    if fill_values is None:
+        fill_values = {}
+
+    dtypes = [get_column_dtype_(model.__table__.c[colname]) for colname in colnames]
+    fills = [fill_values.get(colname,get_fill_value_(dtype)) for colname,dtype in zip(colnames,dtypes)]
+
+    stmt = query.with_entities(*[getattr(model,colname) for colname in colnames]).statement
+
+    # Preallocated arrays grow twice when filled up.
+    COLUMNS = [np.empty(chunk_size,dtype=dtype) for dtype in dtypes]
+    nrows = 0
+    for ARRAYS,_ in iter_array_chunks_(execute_for_arrays_(stmt,dtypes),dtypes,fills,chunk_size):
+        n = len(ARRAYS[0])
+        if nrows+n>len(COLUMNS[0]):
+            size = max(2*len(COLUMNS[0]),nrows+n)
+            for COL in COLUMNS: COL.resize(size,refcheck=False)
+        for COL,ARR in zip(COLUMNS,ARRAYS):
+            COL[nrows:nrows+n] = ARR
+        nrows += n
+    for COL in COLUMNS: COL.resize(nrows,refcheck=False)
+
+    return dict(zip(colnames,COLUMNS))
+
+def get_columnar_parnames_(Transition):
+    """
+    Get names of the transition parameters kept in the columnar store ("extra" is excluded).
+    """
+    return [parname for parname,_ in Transition.__keys__ if parname!='extra']
+
+def save_columns(llst_name,parnames=None,chunk_size=COLUMNAR_FETCH_SIZE):
+    """
+    Write the transitions of the linelist to the columnar store:
+    one .npy file per parameter (with an optional .mask.npy file for NULLs)
+    plus the header.json file. The lines are sorted by wavenumber.
+    The old files of the linelist are replaced at once after the new ones are written.
+        llst_name - name of the linelist
+        parnames - parameters to store (default: all except "extra")
+    """
+    session = VARSPACE['session']
+    Transition = VARSPACE['db_backend'].models.Transition
+    Linelist = VARSPACE['db_backend'].models.Linelist
+
+    if parnames is None:
+        parnames = get_columnar_parnames_(Transition)
+    parnames = list(parnames)
+    if 'isotopologue_alias_id' not in parnames:
+        parnames.append('isotopologue_alias_id')
+    dtypes = [get_column_dtype_(Transition.__table__.c[parname]) for parname in parnames]
+    for parname,dtype in zip(parnames,dtypes):
+        if dtype.hasobject:
+            raise Exception('cannot store parameter "%s" in the columnar store'%parname)
+    fills = [get_fill_value_(dtype) for dtype in dtypes]
+
+    q = Linelist(llst_name).transitions
+    nlines = q.count()
+    stmt = q.with_entities(
+        *[getattr(Transition,parname) for parname in parnames]
+    ).order_by(Transition.nu).statement
+
+    dirname = get_columnar_dir(llst_name)
+    tmpdirname = dirname+'.tmp'
+    if os.path.exists(tmpdirname): shutil.rmtree(tmpdirname)
+    os.makedirs(tmpdirname)
+
+    COLUMNS = [np.lib.format.open_memmap(os.path.join(tmpdirname,parname+'.npy'),
+        mode='w+',dtype=dtype,shape=(nlines,)) for parname,dtype in zip(parnames,dtypes)]
+    MASKS = [None for _ in parnames]
+    LIMITS = [[] for _ in parnames]
+    isoal_ids = set()
+
+    offset = 0
+    for ARRAYS,NULLS in iter_array_chunks_(execute_for_arrays_(stmt,dtypes),dtypes,fills,chunk_size):
+        n = len(ARRAYS[0])
+        if offset+n>nlines:
+            raise Exception('linelist "%s" has been changed while saving columns'%llst_name)
+        for i,parname in enumerate(parnames):
+            COLUMNS[i][offset:offset+n] = ARRAYS[i]
+            if dtypes[i].kind in 'if':
+                VALS = ARRAYS[i] if NULLS[i] is None else ARRAYS[i][~NULLS[i]]
+                if len(VALS) and not np.isnan(VALS).all():
+                    LIMITS[i] += [np.nanmin(VALS).item(),np.nanmax(VALS).item()]
+            if NULLS[i] is None: continue
+            if MASKS[i] is None:
+                MASKS[i] = np.lib.format.open_memmap(os.path.join(tmpdirname,parname+'.mask.npy'),
+                    mode='w+',dtype=np.bool_,shape=(nlines,))
+            MASKS[i][offset:offset+n] = NULLS[i]
+        isoal_ids.update(np.unique(ARRAYS[parnames.index('isotopologue_alias_id')]).tolist())
+        offset += n
+    if offset!=nlines:
+        raise Exception('linelist "%s" has been changed while saving columns'%llst_name)
+
+    for ARR in COLUMNS+MASKS:
+        if ARR is not None: ARR.flush()
+    del COLUMNS,MASKS
+
+    header = {
+        'linelist': llst_name,
+        'number_of_rows': nlines,
+        'order': 'nu',
+        'isotopologue_alias_ids': sorted(isoal_ids),
+        'columns': {parname:{'dtype':dtype.str,'fill_value':str(get_fill_value_(dtype)),
+            'min':min(limits) if limits else None,'max':max(limits) if limits else None} \
+            for parname,dtype,limits in zip(parnames,dtypes,LIMITS)},
+    }
+    with open(os.path.join(tmpdirname,COLUMNAR_HEADER),'w') as f:
+        json.dump(header,f,indent=2)
+
+    # Files mapped by the readers stay valid after the replacement (POSIX).
+    if os.path.exists(dirname): shutil.rmtree(dirname)
+    os.rename(tmpdirname,dirname)
+
+    print('Saved %d lines of "%s" to %s'%(nlines,llst_name,dirname))
+
+def drop_columns(llst_name):
+    """
+    Remove the columnar files of the linelist.
+    """
+    dirname = get_columnar_dir(llst_name)
+    if os.path.exists(dirname): shutil.rmtree(dirname)
+
+def read_columnar_header(llst_name):
+    """
+    Read the header of the linelist columnar store.
+    Returns None if the linelist has no columnar store.
+    """
+    path = os.path.join(get_columnar_dir(llst_name),COLUMNAR_HEADER)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def load_columns(llst_name,parnames=None):
+    """
+    Map the columnar files of the linelist into memory (without reading them).
+    Returns the header and the dictionary of arrays, or (None,None)
+    if the linelist has no columnar store.
+    The arrays are mapped in copy-on-write mode, so the pages are shared
+    between the processes and the files are never modified.
+    Columns containing NULLs are returned as masked arrays.
+    """
+    header = read_columnar_header(llst_name)
+    if header is None:
+        return None,None
+    dirname = get_columnar_dir(llst_name)
+    if parnames is None:
+        parnames = list(header['columns'])
+    data = {}
+    for parname in parnames:
+        if parname not in header['columns']:
+            raise Exception('parameter "%s" is not in the columnar store of "%s"'%(parname,llst_name))
+        datum = np.load(os.path.join(dirname,parname+'.npy'),mmap_mode='c')
+        mask_path = os.path.join(dirname,parname+'.mask.npy')
+        if os.path.isfile(mask_path):
+            datum = np.ma.array(datum,mask=np.load(mask_path,mmap_mode='r'))
+        data[parname] = datum
+    return header,data
+
+def columns2cache(tablename,llst_name=None,parnames=None,isoal_ids=None,wnrange=None):
+    """
+    Put the memory-mapped columns of the linelist to the HAPI table cache.
+    If isoal_ids are given, only the lines of these isotopologue aliases are selected
+    (the columns are copied to RAM unless the linelist has no other lines).
+    Returns False if the linelist has no columnar store.
+        tablename - name of the table in the cache
+        llst_name - name of the linelist (default: same as tablename)
+        parnames - parameters to load (default: all stored)
+        isoal_ids - ids of the isotopologue aliases to select
+        wnrange - (numin,numax) range of the line centers to select (no copying)
+    """
+    if llst_name is None:
+        llst_name = tablename
+    if parnames is not None:
+        parnames = set(parnames)-set(['extra'])
+    header,data = load_columns(llst_name,parnames)
+    if header is None:
+        return False
+
+    if wnrange is not None:
+        NU = load_columns(llst_name,['nu'])[1]['nu']
+        i0,i1 = np.searchsorted(NU,wnrange[0],side='left'),np.searchsorted(NU,wnrange[1],side='right')
+        data = {parname:data[parname][i0:i1] for parname in data}
+    else:
+        i0,i1 = 0,header['number_of_rows']
+
+    if isoal_ids is not None and not set(header['isotopologue_alias_ids']).issubset(isoal_ids):
+        ALIAS_IDS = load_columns(llst_name,['isotopologue_alias_id'])[1]['isotopologue_alias_id'][i0:i1]
+        select = np.isin(ALIAS_IDS,list(isoal_ids))
+        data = {parname:data[parname][select] for parname in data}
+
+    LOCAL_TABLE_CACHE[tablename] = {}
+    LOCAL_TABLE_CACHE[tablename]['header'] = HITRAN_DEFAULT_HEADER
+    LOCAL_TABLE_CACHE[tablename]['data'] = data
+
+    return True
@@ -0,0 +1,86 @@
+""" Management of the secondary indexes declared in the backend models """
+
+from hapi2.config import VARSPACE
+
+from .base import inspect, text_
+
+def get_tables_(tables=None):
+    """
+    Get table objects by names (all tables of the backend by default).
+    """
+    if tables is not None and all(type(table) is not str for table in tables):
+        return tables
+    metadata = VARSPACE['db_backend'].models.Base.metadata
+    if tables is None:
+        return metadata.sorted_tables
+    return [metadata.tables[table] if type(table) is str else table for table in tables]
+
+def get_existing_indexes_(conn,table):
+    """
+    Get names of the indexes existing in the database for the given table.
+    """
+    return set(ix['name'] for ix in inspect(conn).get_indexes(table.name))
+
+def deduplicate_rows_(conn,table,cols):
+    """
+    Delete the duplicate rows by the given columns, keeping the first one.
+    Duplicates are left in the tables without the primary key by the older versions
+    (e.g. re-sync of the linelist mapping).
+    """
+    cols = ','.join(cols)
+    if conn.dialect.name=='sqlite':
+        conn.execute(text_('DELETE FROM %s WHERE rowid NOT IN (SELECT MIN(rowid) FROM %s GROUP BY %s)'%\
+            (table.name,table.name,cols)))
+        return
+    if set(col.name for col in table.columns)!=set(col.strip() for col in cols.split(',')):
+        raise Exception('cannot deduplicate %s: it has columns beyond %s'%(table.name,cols))
+    tmp = '%s__dedup'%table.name
+    conn.execute(text_('CREATE TEMPORARY TABLE %s AS SELECT DISTINCT %s FROM %s'%(tmp,cols,table.name)))
+    conn.execute(text_('DELETE FROM %s'%table.name))
+    conn.execute(text_('INSERT INTO %s (%s) SELECT %s FROM %s'%(table.name,cols,cols,tmp)))
+    conn.execute(text_('DROP TEMPORARY TABLE %s'%tmp))
+
+def create_indexes(tables=None,conn=None):
+    """
+    Create the indexes declared in the models, which are missing in the database.
+    Tables created before the primary key was declared (e.g. linelist_vs_transition)
+    get the unique index on the primary key columns instead; the duplicate rows
+    in these tables are deleted once, before the index is created.
+        tables - list of tables or table names (default: all tables)
+        conn - connection to use (default: connection of the current session)
+    """
+    session = VARSPACE['session']
+    if conn is None: conn = session.connection()
+    for table in get_tables_(tables):
+        existing = get_existing_indexes_(conn,table)
+        for index in sorted(table.indexes,key=lambda index:index.name):
+            if index.name in existing: continue
+            print('Creating index %s'%index.name)
+            index.create(conn)
+        pk_cols = [col.name for col in table.primary_key.columns]
+        pk_name = '%s__pk'%table.name
+        if len(pk_cols)>1 and pk_name not in existing and \
+                not inspect(conn).get_pk_constraint(table.name)['constrained_columns']:
+            cols = ','.join(pk_cols)
+            print('Deleting duplicate rows of %s'%table.name)
+            deduplicate_rows_(conn,table,pk_cols)
+            print('Creating index %s'%pk_name)
+            conn.execute(text_('CREATE UNIQUE INDEX %s ON %s (%s)'%(pk_name,table.name,cols)))
+    session.commit()
+
+def drop_indexes(tables=None,conn=None):
+    """
+    Drop the indexes declared in the models, e.g. before the bulk load.
+    Primary keys are not dropped.
+        tables - list of tables or table names (default: all tables)
+        conn - connection to use (default: connection of the current session)
+    """
+    session = VARSPACE['session']
+    if conn is None: conn = session.connection()
+    for table in get_tables_(tables):
+        existing = get_existing_indexes_(conn,table)
+        for index in sorted(table.indexes,key=lambda index:index.name):
+            if index.name not in existing: continue
+            print('Dropping index %s'%index.name)
+            index.drop(conn)
+    session.commit()
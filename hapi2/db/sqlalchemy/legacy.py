@@ -2,9 +2,15 @@ import numpy as np
 from .base import query as base_query
 from hapi import LOCAL_TABLE_CACHE, HITRAN_DEFAULT_HEADER
 from hapi2.config import VARSPACE
+from .columnar import columns2cache
 
 def storage2cache(tablename,query=None,parnames=None):
-    """ Import transitions from database to RAM (legacy) """
+    """ Import transitions from database to RAM (legacy).
+        If the linelist has the columnar store (see save_columns)
+        and no query is given, the columns are memory-mapped instead. """
+
+    if query is None and columns2cache(tablename,parnames=parnames):
+        return
 
     Transition = VARSPACE['db_backend'].models.Transition
     Linelist = VARSPACE['db_backend'].models.Linelist
@@ -19,17 +25,11 @@ def storage2cache(tablename,query=None,parnames=None):
         parnames = [parname for parname,_ in Transition.__keys__]
 
     # exlcude 'extra' from pars
-    parnames = set(parnames)-set(['extra'])
+    parnames = [parname for parname in parnames if parname!='extra']
             
-    data = q.with_entities(
-        *[getattr(Transition,parname) for parname in parnames]
-    ).all()
-    
-    data = list(zip(*data))
+    # NULLs are filled with nan (floats), -1 (integers), or '' (strings).
+    data = Transition.read_arrays(q,parnames)
         
     LOCAL_TABLE_CACHE[tablename] = {}
     LOCAL_TABLE_CACHE[tablename]['header'] = HITRAN_DEFAULT_HEADER
-    LOCAL_TABLE_CACHE[tablename]['data'] = {}
-    
-    for parname,datum in zip(parnames,data):
-        LOCAL_TABLE_CACHE[tablename]['data'][parname] = np.ma.array(datum)
+    LOCAL_TABLE_CACHE[tablename]['data'] = data
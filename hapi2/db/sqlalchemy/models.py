@@ -10,7 +10,9 @@ from hapi2.config import VARSPACE, SETTINGS
 from hapi2.format.dispatch import FormatDispatcher
 
 from .updaters import __update_and_commit_core__
-from .updaters import __insert_transitions_core__
+from .updaters import __insert_transitions_core__, __insert_transitions_parallel_core__, \
+    __insert_transitions_pipelined_core__
+from .columnar import read_arrays
 
 from sqlalchemy import func, distinct
 
@@ -200,6 +202,17 @@ class CRUD_Generic(models.CRUD):
         ).all()
     
         return list(zip(*data))
+
+    @classmethod
+    def read_arrays(cls,query=None,colnames=None,fill_values=None):
+        """
+        Read columns of the query result into typed Numpy arrays 
+        streaming the cursor without creating the ORM objects.
+        NULLs are replaced with the fill values (dictionary by column names,
+        default: nan for floats, -1 for integers, empty string for strings).
+        Returns the dictionary of arrays.
+        """
+        return read_arrays(cls,query,colnames,fill_values)
                         
     @classmethod
     def load(cls,dct):
@@ -240,10 +253,28 @@ class CRUD_Dotpar(CRUD_Generic):
     """
     
     @classmethod
-    def update(cls,header,local=True,llst_name='default',**argv):
+    def update(cls,header,local=True,llst_name='default',parallel=False,chunks=None,**argv):
+        """
+        Set parallel=True to parse the data file in the process pool 
+        (optional nworkers and queue_depth arguments control the pool).
+        Set bulk=True for the fast initial load of new transitions 
+        (supported by the SQLite backend).
+        Set upsert=True to merge the transitions with the existing ones 
+        using the native INSERT ... ON CONFLICT UPDATE (e.g. for incremental refresh);
+        the extra parameters are merged with the stored ones, as in the default mode.
+        Set columnar=True to write the memory-mappable columnar store of the linelist
+        after the ingest (see save_columns).
+        Supply chunks (iterable of bytes, e.g. from the download in progress) to parse
+        and insert the data as they arrive instead of reading the .data file
+        (optional queue_depth and block_size arguments control the pipeline).
+        """
         tmpdir = SETTINGS['tmpdir'] 
         cls.__check_types__(header)                   
         stream = cls.__format_dispatcher_class__().getStreamer(basedir=tmpdir,header=header)
+        if chunks is not None:
+            return __insert_transitions_pipelined_core__(cls,stream,chunks,local=local,llst_name=llst_name,**argv)
+        if parallel:
+            return __insert_transitions_parallel_core__(cls,stream,local=local,llst_name=llst_name,**argv)
         return __insert_transitions_core__(cls,stream,local=local,llst_name=llst_name,**argv)
 
 class PartitionFunction(models.PartitionFunction):
@@ -2,12 +2,14 @@
 
 from ..base import LONGBLOB, TEXT, String, DOUBLE, Integer, Date, Table
 
-from ..base import declarative_base, Column, deferred, PickleType
+from ..base import declarative_base, Column, deferred, PickleType, Index
 
 from ..base import make_session_default
 
 from ..base import commit, query
 
+from ..base import mysql_insert
+
 from hapi2.db.sqlalchemy import models
 
 BLOBTYPE = LONGBLOB
@@ -30,6 +32,14 @@ table_engine = SETTINGS['table_engine']
 def search_string(query,cls,field,pattern):
     return query.filter(getattr(cls,field).ilike(pattern))
 
+def insert_ignore_statement(table):
+    return table.insert().prefix_with('IGNORE')
+
+def upsert_statement(table,colnames):
+    stmt = mysql_insert(table)
+    return stmt.on_duplicate_key_update(
+        {colname:stmt.inserted[colname] for colname in colnames})
+
 class CrossSectionData(models.CrossSectionData, models.CRUD_Generic, Base):
 
     id = Column(INTTYPE,primary_key=True)
@@ -162,9 +172,10 @@ class ParameterMeta(models.ParameterMeta, models.CRUD_Generic, Base):
     )
 
 linelist_vs_transition = Table('linelist_vs_transition', Base.metadata,
-    Column('linelist_id', INTTYPE), #, ForeignKey('linelist.id')
-    Column('transition_id', INTTYPE), #, ForeignKey('transition.id')
-    #Index('linelist_vs_transition__linelist_id','linelist_id'), # fast search for transitions for given linelist
+    Column('linelist_id', INTTYPE, primary_key=True), #, ForeignKey('linelist.id')
+    Column('transition_id', INTTYPE, primary_key=True), #, ForeignKey('transition.id')
+    # primary key also serves the fast search for transitions for given linelist
+    Index('linelist_vs_transition__transition_id','transition_id'), # fast search for linelists for given transition
     mysql_engine=table_engine,
 )
 
@@ -207,7 +218,8 @@ class Transition(models.Transition, models.CRUD_Dotpar, Base):
     extra = deferred(Column('extra',PickleType,default={}))
 
     __table_args__ = (
-        #Index('transition__isotopologue_alias_id', isotopologue_alias_id),
+        Index('transition__nu', nu), # wavenumber range filters
+        Index('transition__isotopologue_alias_id__nu', isotopologue_alias_id, nu), # also search by isotopologue
         {'mysql_engine':table_engine},
     )
 
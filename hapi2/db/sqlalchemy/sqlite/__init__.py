@@ -1,7 +1,10 @@
 from ..base import create_engine
 from ..legacy import storage2cache
+from ..columnar import save_columns, load_columns, drop_columns, columns2cache
+from ..indexes import create_indexes, drop_indexes
 
 from .models import Base, make_session
+from .bulk import bulk_load, insert_transition_dicts_bulk_
 
 from hapi2.config import SETTINGS, VARSPACE
 
@@ -19,6 +22,9 @@ def init():
 
     # Create session.
     VARSPACE['session'] = make_session(VARSPACE['engine'])
+
+    # Create indexes missing in the databases created by the older versions.
+    create_indexes(Base.metadata.sorted_tables)
     
     print('Database name: %s'%SETTINGS['database'])
     print('Database engine: %s'%SETTINGS['engine'])
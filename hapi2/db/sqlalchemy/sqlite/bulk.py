@@ -0,0 +1,111 @@
+""" Bulk-load fast path for the initial linelist ingestion into SQLite """
+
+from contextlib import contextmanager
+
+from hapi2.config import VARSPACE
+
+from ..base import sql
+from ..updaters import TRANS_ATTRS, id_conditions
+from ..indexes import create_indexes, drop_indexes
+
+BULK_CACHE_SIZE = -1024*1024 # page cache size during the bulk load (negative means KiB, i.e. 1 GiB)
+
+TRANS_COLUMNS = ['id','isotopologue_alias_id']+TRANS_ATTRS+['extra']
+
+def get_driver_connection_():
+    """
+    Get raw sqlite3 connection used by the current session.
+    """
+    return VARSPACE['session'].connection().connection.driver_connection
+
+def get_secondary_indexes_(tables):
+    """
+    Get names and definitions of the explicitly created non-unique indexes for the given tables.
+    Automatic indexes (primary keys, unique constraints) have no SQL definition.
+    """
+    conn = get_driver_connection_()
+    cursor = conn.execute("SELECT name,sql FROM sqlite_master WHERE type='index' "
+        "AND sql IS NOT NULL AND sql NOT LIKE 'CREATE UNIQUE%%' "
+        "AND tbl_name IN (%s)"%','.join('?'*len(tables)),tables)
+    return cursor.fetchall()
+
+@contextmanager
+def bulk_load(cls):
+    """
+    Context for the bulk load of transitions into the empty or append-only database.
+    On enter: switch to WAL journal, turn off synchronous writes, enlarge the page cache,
+        and drop the secondary indexes of transition and linelist mapping tables.
+    On exit: rebuild the dropped indexes and restore the connection settings
+        (WAL journal mode is persistent and is kept).
+    If the load fails, the uncommitted batch is rolled back before the indexes are rebuilt,
+    so the transitions are never committed without their linelist mappings.
+    """
+    session = VARSPACE['session']
+    linelist_vs_transition = VARSPACE['db_backend'].models.linelist_vs_transition
+    tables = [cls.__table__,linelist_vs_transition]
+
+    session.commit() # journal mode can't be changed inside the transaction
+    conn = get_driver_connection_()
+    synchronous, = conn.execute('PRAGMA synchronous').fetchone()
+    cache_size, = conn.execute('PRAGMA cache_size').fetchone()
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('PRAGMA cache_size=%d'%BULK_CACHE_SIZE)
+
+    drop_indexes(tables) # indexes declared in the models
+    INDEXES = get_secondary_indexes_([table.name for table in tables]) # other indexes
+    conn = get_driver_connection_()
+    for name,_ in INDEXES:
+        conn.execute('DROP INDEX IF EXISTS "%s"'%name)
+    session.commit()
+
+    try:
+        yield
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.commit()
+        create_indexes(tables)
+        conn = get_driver_connection_()
+        for name,sql in INDEXES:
+            print('Rebuilding index %s'%name)
+            conn.execute(sql)
+        session.commit()
+        conn = get_driver_connection_()
+        conn.execute('PRAGMA synchronous=%d'%synchronous)
+        conn.execute('PRAGMA cache_size=%d'%cache_size)
+
+def insert_transition_dicts_bulk_(cls,TRANS_DICTS,LLST_VS_TRANS):
+    """
+    Insert new transitions and their linelist mappings through the raw sqlite3 executemany.
+    Transition dicts should contain "id" and "isotopologue_alias_id" fields.
+    Raises before inserting anything if some of the ids are already in the database.
+    """
+    session = VARSPACE['session']
+    linelist_vs_transition = VARSPACE['db_backend'].models.linelist_vs_transition
+
+    ids = [trans_dict['id'] for trans_dict in TRANS_DICTS]
+    EXISTING = []
+    for ids_condition in id_conditions(cls.__table__.c.id,ids):
+        EXISTING += session.execute(sql.select(cls.__table__.c.id).where(ids_condition)).scalars()
+    if EXISTING:
+        raise Exception('bulk load can only insert new transitions: %d of %d ids '
+            'are already in the database (e.g. %d), use the default mode to update them'%\
+            (len(EXISTING),len(ids),min(EXISTING)))
+
+    dialect = session.get_bind().dialect
+    process_extra = cls.__table__.c.extra.type.bind_processor(dialect)
+
+    conn = get_driver_connection_()
+
+    if TRANS_DICTS:
+        conn.executemany('INSERT INTO "%s" (%s) VALUES (%s)'%(cls.__table__.name,
+            ','.join(TRANS_COLUMNS),','.join('?'*len(TRANS_COLUMNS))),
+            [tuple(trans_dict.get(col) for col in TRANS_COLUMNS[:-1])+\
+                (process_extra(trans_dict.get('extra',{})),) for trans_dict in TRANS_DICTS])
+
+    if LLST_VS_TRANS:
+        conn.executemany('INSERT OR IGNORE INTO "%s" (linelist_id,transition_id) VALUES (?,?)'%\
+            linelist_vs_transition.name,
+            [(item['linelist_id'],item['transition_id']) for item in LLST_VS_TRANS])
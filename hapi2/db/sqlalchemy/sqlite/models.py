@@ -2,12 +2,14 @@
 
 from ..base import BLOB, String, Float, Integer, Date, Table
 
-from ..base import declarative_base, Column, deferred, PickleType
+from ..base import declarative_base, Column, deferred, PickleType, Index
 
 from ..base import make_session_default
 
 from ..base import commit, query
 
+from ..base import sqlite_insert
+
 from hapi2.db.sqlalchemy import models
 
 BLOBTYPE = BLOB
@@ -27,6 +29,14 @@ IS_NULLABLE = True
 def search_string(query,cls,field,pattern):
     return query.filter(getattr(cls,field).ilike(pattern+'\0%'))
 
+def insert_ignore_statement(table):
+    return table.insert().prefix_with('OR IGNORE')
+
+def upsert_statement(table,colnames):
+    stmt = sqlite_insert(table)
+    return stmt.on_conflict_do_update(index_elements=[table.c.id],
+        set_={colname:stmt.excluded[colname] for colname in colnames})
+
 class PartitionFunction(models.PartitionFunction, models.CRUD_Generic, Base):
 
     id = Column(INTTYPE,primary_key=True)
@@ -173,9 +183,10 @@ class ParameterMeta(models.ParameterMeta, models.CRUD_Generic, Base):
     )
 
 linelist_vs_transition = Table('linelist_vs_transition', Base.metadata,
-    Column('linelist_id', INTTYPE), #, ForeignKey('linelist.id')
-    Column('transition_id', INTTYPE), #, ForeignKey('transition.id')
-    #Index('linelist_vs_transition__linelist_id','linelist_id'), # fast search for transitions for given linelist
+    Column('linelist_id', INTTYPE, primary_key=True), #, ForeignKey('linelist.id')
+    Column('transition_id', INTTYPE, primary_key=True), #, ForeignKey('transition.id')
+    # primary key also serves the fast search for transitions for given linelist
+    Index('linelist_vs_transition__transition_id','transition_id'), # fast search for linelists for given transition
 )
 
 class Linelist(models.Linelist, models.CRUD_Generic, Base):
@@ -216,7 +227,8 @@ class Transition(models.Transition, models.CRUD_Dotpar, Base):
     extra = deferred(Column('extra',PickleType,default={}))
 
     __table_args__ = (
-        #Index('transition__isotopologue_alias_id', isotopologue_alias_id),
+        Index('transition__nu', nu), # wavenumber range filters
+        Index('transition__isotopologue_alias_id__nu', isotopologue_alias_id, nu), # also search by isotopologue
     )
 
 class IsotopologueAlias(models.IsotopologueAlias, models.CRUD_Generic, Base):
@@ -1,8 +1,13 @@
+from time import time
 from itertools import islice
+from contextlib import nullcontext, closing
 
 from hapi2.config import SETTINGS, VARSPACE
+from hapi2.utils.pipeline import iter_threaded
+from hapi2.format.streamers.dotpar import columns_to_transition_dicts_
 
-from .base import sql, query, commit, bindparam
+from .base import sql, query, commit, bindparam, MetaData, Table, Column, String
+from .columnar import save_columns, read_columnar_header
 
 def get_first_available_(cls,col,local=True):
     """
@@ -35,11 +40,93 @@ def chunks(lst,n=CHUNK_SIZE): # needed to avoid the SQLite error ("too many SQL
     for i in range(0,len(lst),n):
         yield lst[i:i+n]            
 
+MAX_RANGES = 250 # maximum number of BETWEEN terms in a single query (SQLite limits the expression depth)
+
+def id_ranges(ids):
+    """
+    Collapse the ids into the sorted list of contiguous ranges [first,last].
+    """
+    RANGES = []
+    for id_ in sorted(set(ids)):
+        if RANGES and id_==RANGES[-1][1]+1:
+            RANGES[-1][1] = id_
+        else:
+            RANGES.append([id_,id_])
+    return RANGES
+
+def id_conditions(col,ids,n=CHUNK_SIZE,nranges=MAX_RANGES):
+    """
+    Yield the conditions on the integer column, which together select all given ids.
+    Contiguous runs of ids are collapsed into BETWEEN ranges, isolated ids
+    are collected to the IN list. Each condition has at most n parameters.
+    """
+    SINGLES = []; BETWEENS = []; npars = 0
+    for first,last in id_ranges(ids):
+        if first==last:
+            SINGLES.append(first); npars += 1
+        else:
+            BETWEENS.append((first,last)); npars += 2
+        if npars>=n-1 or len(BETWEENS)>=nranges:
+            yield sql.or_(col.in_(SINGLES),*[col.between(*r) for r in BETWEENS])
+            SINGLES = []; BETWEENS = []; npars = 0
+    if SINGLES or BETWEENS:
+        yield sql.or_(col.in_(SINGLES),*[col.between(*r) for r in BETWEENS])
+
+def select_by_keys(stmt,col,keys,n=CHUNK_SIZE):
+    """
+    Execute the select statement restricted to the rows with col values in keys.
+    If the keys don't fit in a single query, they are joined as a temporary table.
+    """
+    session = VARSPACE['session']
+    if len(keys)<=n:
+        return list(session.execute(stmt.where(col.in_(keys))))
+    conn = session.connection()
+    tmp = Table('tmp_lookup_keys',MetaData(),
+        Column('key',String(255),primary_key=True),prefixes=['TEMPORARY'])
+    tmp.create(conn)
+    try:
+        session.execute(tmp.insert(),[{'key':key} for key in set(keys)])
+        return list(session.execute(stmt.join(tmp,col==tmp.c.key)))
+    finally:
+        tmp.drop(conn)
+
 TRANS_ATTRS = ['molec_id','local_iso_id','nu','sw','a','gamma_air','gamma_self','elower',
     'n_air','delta_air','global_upper_quanta','global_lower_quanta','local_upper_quanta',
     'local_lower_quanta','ierr','iref','line_mixing_flag','gp','gpp']
             
-def insert_transition_dicts_core_(cls,TRANS_DICTS,linelist_id,local,initial=False):
+def lookup_extras_(cls,ids):
+    """
+    Get the list of (id,extra) tuples of the transitions found in the database by ids.
+    """
+    session = VARSPACE['session']
+    DB_LOOKUP = []
+    for ids_condition in id_conditions(cls.__table__.c.id,ids):
+        stmt = sql.select(
+                *[cls.__table__.c.id, 
+                cls.__table__.c.extra]
+            ).\
+            where(
+                ids_condition
+            ) # retrieve only ids and extra parameters (because the latter should be updated with the new data)
+        DB_LOOKUP += session.execute(stmt)
+    return DB_LOOKUP
+
+def merge_extras_(cls,TRANS_DICTS):
+    """
+    Merge the non-empty extra parameters of the transition dicts (with "id" field)
+    into the extra parameters stored for the same transitions.
+    Returns the dicts {'id_':...,'extra':...} for the stored transitions whose extra changed.
+    """
+    TRANS_DICTS_LOOKUP = {trans_dict['id']:trans_dict for trans_dict in TRANS_DICTS if trans_dict.get('extra')}
+    EXTRA_DICTS = []
+    for id,extra in lookup_extras_(cls,list(TRANS_DICTS_LOOKUP)):
+        merged = dict(extra or {})
+        merged.update(TRANS_DICTS_LOOKUP[id]['extra'])
+        if merged!=extra:
+            EXTRA_DICTS.append({'id_':id,'extra':merged})
+    return EXTRA_DICTS
+
+def insert_transition_dicts_core_(cls,TRANS_DICTS,linelist_id,local,initial=False,bulk=False,upsert=False):
     """
     Helper function inserting the block of transitions in dictionary format in the database. 
     INPUT: 
@@ -47,7 +134,16 @@ def insert_transition_dicts_core_(cls,TRANS_DICTS,linelist_id,local,initial=Fals
         linelist_id: id of the linelist to attach the transitions to
         local: flag to separate "global" (i.e. those from HITRANonline) transitions and "local" ones
         initial: True means that some lookups are omitted, which speeds up the initial line addition
+        bulk: insert new transitions with the bulk loader of the backend (implies initial=True),
+              should be called inside the bulk_load_context_
+        upsert: merge transitions with the existing ones by the single INSERT ... ON CONFLICT UPDATE 
+                statement instead of looking them up (implies initial=True); 
+                the non-empty extra parameters are merged with the stored ones (see merge_extras_)
     """
+    if bulk and upsert:
+        raise Exception('bulk and upsert modes are mutually exclusive')
+    if bulk or upsert: initial = True
+
     session = VARSPACE['session']    
     
     #Transition = VARSPACE['db_backend'].models.Transition
@@ -113,11 +209,10 @@ def insert_transition_dicts_core_(cls,TRANS_DICTS,linelist_id,local,initial=Fals
     isoal_names = list(ISOTOPOLOGUE_ALIASES.keys())
     
     # lookup in the database
-    DB_LOOKUP = session.execute(sql.select(*[
+    DB_LOOKUP = select_by_keys(sql.select(*[
         IsotopologueAlias.__table__.c.alias,
         IsotopologueAlias.__table__.c.id,
-    ]).where(IsotopologueAlias.__table__.c.alias.in_ (isoal_names)))
-    DB_LOOKUP = list(DB_LOOKUP) # !!!
+    ]),IsotopologueAlias.__table__.c.alias,isoal_names)
     
     isoal_names_found = [e[0] for e in DB_LOOKUP]
     isoal_names_not_found = list(set(isoal_names)-set(isoal_names_found))
@@ -147,33 +242,22 @@ def insert_transition_dicts_core_(cls,TRANS_DICTS,linelist_id,local,initial=Fals
     
     # The total lookup is split into several because the default engine (SQLite) doesn't support huge amounts of 
     # parameters passes in a single SQL query.
-    # THIS CAN BE FURTHER OPTIMIZED BY APPLYING THE "COMPRESSION" TECHNIQUES ON ARRAYS OF NUMBERS,
-    # SUCH AS CONVERTING ARRAY TO RANGE IN ORDER TO MINIMIZE THE NUMBER OF SUB-LOOKUPS. 
-    # TO BE DONE.
+    # To minimize the number of sub-lookups, contiguous runs of ids are collapsed into ranges (see id_conditions).
     
     DB_LOOKUP = []
     total_read = 0
     
     if not initial:
         
-        for i,ids_chunk in enumerate(chunks(ids_for_lookup)):
-            n_chunk = len(ids_chunk)
-            stmt = sql.select(
-                    *[Transition.__table__.c.id, 
-                    Transition.__table__.c.extra]
-                ).\
-                where(
-                    Transition.__table__.c.id.in_(ids_chunk)
-                ) # retrieve only ids and extra parameters (because the latter should be updated with the new data)
-            total_read += n_chunk
-        
-            DB_LOOKUP += session.execute(stmt) # list of tuples (id,extra)
+        DB_LOOKUP = lookup_extras_(Transition,ids_for_lookup) # list of tuples (id,extra)
+        total_read += len(ids_for_lookup)
                 
     # Create group 2 and merge the new extra parameters there.
     for id,extra in DB_LOOKUP:
         trans_dict = TRANS_DICTS_LOOKUP[id]
         if extra is not None:
-            trans_dict['extra'] = extra.update(trans_dict['extra'])
+            extra.update(trans_dict['extra'])
+            trans_dict['extra'] = extra
         TRANS_DICTS_2.append(trans_dict)
         TRANS_DICTS_LOOKUP.pop(id) # delete item from lookup, leaving only items from group 1B.
         
@@ -229,9 +313,26 @@ def insert_transition_dicts_core_(cls,TRANS_DICTS,linelist_id,local,initial=Fals
     if ISOAL_DICTS: 
         session.execute(IsotopologueAlias.__table__.insert(),ISOAL_DICTS) 
     
-    # ---> add new transitions (groups 1A and 1B)
-    if TRANS_DICTS_1A_1B:
-        session.execute(Transition.__table__.insert(),TRANS_DICTS_1A_1B) 
+    # ---> add new transitions (groups 1A and 1B) and their line list mappings
+    if bulk:
+        VARSPACE['db_backend'].insert_transition_dicts_bulk_(Transition,TRANS_DICTS_1A_1B,LLST_VS_TRANS)
+        LLST_VS_TRANS = []
+    elif TRANS_DICTS_1A_1B:
+        if upsert:
+            # extra is inserted for the new transitions only, the existing ones are merged below
+            EXTRA_DICTS = merge_extras_(Transition,TRANS_DICTS_1A_1B)
+            stmt = VARSPACE['db_backend'].models.upsert_statement(
+                Transition.__table__,TRANS_ATTRS)
+        else:
+            stmt = Transition.__table__.insert()
+        session.execute(stmt,TRANS_DICTS_1A_1B) 
+        if upsert and EXTRA_DICTS:
+            stmt = Transition.__table__.update().\
+                where(
+                    Transition.__table__.c.id == bindparam('id_')
+                ).\
+                values({'extra':bindparam('extra')})
+            session.execute(stmt,EXTRA_DICTS)
     
     # ---> update existing transitions
     if TRANS_DICTS_2:
@@ -244,9 +345,10 @@ def insert_transition_dicts_core_(cls,TRANS_DICTS,linelist_id,local,initial=Fals
             values(insert_values)
         session.execute(stmt,TRANS_DICTS_2)
         
-    # ---> update line list mappings for existing transitions
+    # ---> update line list mappings for existing transitions (already existing mappings are skipped)
     if LLST_VS_TRANS:
-        session.execute(linelist_vs_transition.insert(),LLST_VS_TRANS) 
+        session.execute(VARSPACE['db_backend'].models.insert_ignore_statement(linelist_vs_transition),
+            LLST_VS_TRANS) 
     
     session.commit() # COMMIT ALL CHANGES!!
     
@@ -271,6 +373,28 @@ def __create_linelist_TMP__(llst_name):
     
     return llst   
 
+def bulk_load_context_(cls,bulk):
+    """
+    Get the bulk load context from the database backend. 
+    Returns the empty context if bulk is False.
+    """
+    if not bulk:
+        return nullcontext()
+    db_backend = VARSPACE['db_backend']
+    if not hasattr(db_backend,'bulk_load'):
+        raise Exception('bulk load is not supported by "%s" backend'%SETTINGS['engine'])
+    return db_backend.bulk_load(cls)
+
+def save_columns_on_ingest_(llst_name,columnar):
+    """
+    Write the columnar store of the linelist after the ingest if columnar is True.
+    By default, the store is written if SETTINGS['columnar_store'] is set 
+    or the linelist already has the store (which would be outdated otherwise).
+    """
+    if columnar is None: 
+        columnar = SETTINGS.get('columnar_store') or read_columnar_header(llst_name) is not None
+    if columnar: save_columns(llst_name)
+
 def get_transitions_by_ids(ids):
     """
     Return generator returning transitions by ids.
@@ -279,32 +403,110 @@ def get_transitions_by_ids(ids):
 
 NBULK = 150000 # EACH BULK CORRESPONDS TO SEPARATE TRANSACTION
 
-def __insert_transitions_core__(cls,stream,local=True,llst_name='default',**argv):
+def __insert_transitions_writer__(cls,gen,local=True,llst_name='default',columnar=None,label=None,
+        batch_size=NBULK,**argv):
     """
-    Update and commit exclusively for cross-section headers. Will not work for other types of objects!!!
-    The name of the HAPI table should be supplied with the llst_name parameter.
-    THIS VERSION USES SQLALCHEMY ORM FOR LINELIST AND CORE FOR TRANSITIONS
+    Single-writer loop of the transition ingest: insert the transition dicts 
+    from the iterator in batches (each batch is a separate transaction).
+        gen - iterator of the transition dicts (closed when the loop stops)
+        batch_size - maximum number of the transitions inserted at once
+        columnar - write the columnar store of the linelist (see save_columns_on_ingest_)
+        label - name of the ingest mode for the final summary (no summary if None)
     """
     
     llst = __create_linelist_TMP__(llst_name)
         
     ids = []
     ntot = 0
+    t0 = time()
     
-    gen = stream.__iter__()
     print('==================================')
-    while True:
-        TRANS_DICTS = list(islice(gen,NBULK))
-        if not TRANS_DICTS: break
-        
-        ntot += len(TRANS_DICTS)            
-        ids += insert_transition_dicts_core_(cls,TRANS_DICTS,llst.id,local=local,**argv)
+    try:
+        with bulk_load_context_(cls,argv.get('bulk')):
+            while True:
+                TRANS_DICTS = list(islice(gen,batch_size))
+                if not TRANS_DICTS: break
+                
+                ntot += len(TRANS_DICTS)            
+                ids += insert_transition_dicts_core_(cls,TRANS_DICTS,llst.id,local=local,**argv)
 
-        print('Total lines processed: %d'%ntot)
-        print('==================================')
+                print('Total lines processed: %d (%.0f lines/sec)'%(ntot,ntot/(time()-t0)))
+                print('==================================')
+    finally:
+        if hasattr(gen,'close'): gen.close()
+    
+    if label:
+        print('%s ingest: %d lines in %.2f sec (%.0f lines/sec)'%\
+            (label,ntot,time()-t0,ntot/(time()-t0)))
+
+    save_columns_on_ingest_(llst_name,columnar)
                     
     return get_transitions_by_ids(ids) # BETTER WAY OF RETURNING LINES!! (TODO)
 
+def __insert_transitions_core__(cls,stream,local=True,llst_name='default',columnar=None,**argv):
+    """
+    Update and commit exclusively for cross-section headers. Will not work for other types of objects!!!
+    The name of the HAPI table should be supplied with the llst_name parameter.
+    THIS VERSION USES SQLALCHEMY ORM FOR LINELIST AND CORE FOR TRANSITIONS
+        columnar - write the columnar store of the linelist (see save_columns_on_ingest_)
+    """
+    return __insert_transitions_writer__(cls,stream.__iter__(),local,llst_name,columnar,**argv)
+
+def __insert_transitions_parallel_core__(cls,stream,local=True,llst_name='default',
+        nworkers=None,queue_depth=None,columnar=None,**argv):
+    """
+    Parallel version of __insert_transitions_core__ for the HAPI .data streams.
+    The data file is split into shards which are parsed in the process pool 
+    (see DotparStreamer.iter_columns_parallel), while the transitions are written 
+    to the database by the single writer in the file order, so the ID assignment 
+    and the linelist mapping are the same as in the serial version.
+        nworkers - number of parsing processes (default: SETTINGS['ingest_workers'])
+        queue_depth - maximum number of shards parsed ahead of the writer 
+                      (default: SETTINGS['ingest_queue_depth'])
+        columnar - write the columnar store of the linelist (see save_columns_on_ingest_)
+    """
+    if nworkers is None: nworkers = SETTINGS.get('ingest_workers')
+    if queue_depth is None: queue_depth = SETTINGS.get('ingest_queue_depth')
+    
+    def iter_trans_dicts():
+        with closing(stream.iter_columns_parallel(nworkers,queue_depth)) as SHARDS:
+            for COLUMNS in SHARDS:
+                yield from columns_to_transition_dicts_(COLUMNS)
+    
+    return __insert_transitions_writer__(cls,iter_trans_dicts(),local,llst_name,columnar,
+        label='Parallel',**argv)
+
+PIPELINE_BLOCK_SIZE = 4*1024*1024 # bytes of the data parsed at once in the pipelined mode
+PIPELINE_NBULK = 25000 # transitions inserted at once in the pipelined mode (about one parsed block)
+
+def __insert_transitions_pipelined_core__(cls,stream,chunks,local=True,llst_name='default',
+        queue_depth=None,block_size=PIPELINE_BLOCK_SIZE,columnar=None,**argv):
+    """
+    Pipelined version of __insert_transitions_core__ for the .data content 
+    arriving as the stream of byte chunks (e.g. from the download in progress).
+    The chunks are parsed to the transition batches in the background thread,
+    while the batches are written to the database by the calling thread,
+    so the download, parsing and insertion overlap.
+        chunks - iterable of bytes objects of arbitrary size
+        queue_depth - maximum number of batches parsed ahead of the writer 
+                      (default: SETTINGS['ingest_queue_depth'] or 2)
+        block_size - minimum number of bytes parsed at once
+        columnar - write the columnar store of the linelist (see save_columns_on_ingest_)
+    """
+    if queue_depth is None: queue_depth = SETTINGS.get('ingest_queue_depth') or 2
+    
+    def parse(emit):
+        for COLUMNS in stream.iter_columns_from_chunks(chunks,block_size):
+            emit(columns_to_transition_dicts_(COLUMNS))
+    
+    def iter_trans_dicts():
+        with closing(iter_threaded(parse,queue_depth,name='parse-%s'%llst_name)) as BATCHES:
+            for TRANS_DICTS in BATCHES:
+                yield from TRANS_DICTS
+    
+    return __insert_transitions_writer__(cls,iter_trans_dicts(),local,llst_name,columnar,
+        label='Pipelined',batch_size=PIPELINE_NBULK,**argv)
+
 def __insert_base_items_core__(cls,ITEM_DICTS,local=True):
     """
     Main procedure for inserting base item dicts using core.
@@ -360,22 +562,19 @@ def __insert_base_items_core__(cls,ITEM_DICTS,local=True):
         
     # The total lookup is split into several because the default engine (SQLite) doesn't support huge amounts of 
     # parameters passes in a single SQL query.
-    # THIS CAN BE FURTHER OPTIMIZED BY APPLYING THE "COMPRESSION" TECHNIQUES ON ARRAYS OF NUMBERS,
-    # SUCH AS CONVERTING ARRAY TO RANGE IN ORDER TO MINIMIZE THE NUMBER OF SUB-LOOKUPS. 
-    # TO BE DONE.
+    # To minimize the number of sub-lookups, contiguous runs of ids are collapsed into ranges (see id_conditions).
     
     DB_LOOKUP = []
     total_read = 0
 
-    for ids_chunk in chunks(ids_for_lookup):
-        n_chunk = len(ids_chunk)        
+    for ids_condition in id_conditions(cls.__table__.c.id,ids_for_lookup):
         args = [cls.__table__.c.id,]
         stmt = sql.select(*args).\
             where(
-                cls.__table__.c.id.in_(ids_chunk)
+                ids_condition
             ) 
-        total_read += n_chunk            
         DB_LOOKUP += [id_ for id_, in session.execute(stmt)]
+    total_read += len(ids_for_lookup)
             
     lookup_ids = set(ITEM_DICTS_LOOKUP.keys())
     lookup_ids_1a_1b = lookup_ids-set(DB_LOOKUP)
@@ -459,23 +658,15 @@ def __insert_alias_items_core__(cls,ITEM_DICTS,local=True):
     
     keys_for_lookup = list(ITEM_DICTS_LOOKUP.keys()) # get the ids to lookup
     
-    # The total lookup is split into several because the default engine (SQLite) doesn't support huge amounts of 
-    # parameters passes in a single SQL query.
-    # THIS CAN BE FURTHER OPTIMIZED BY APPLYING THE "COMPRESSION" TECHNIQUES ON ARRAYS OF NUMBERS,
-    # SUCH AS CONVERTING ARRAY TO RANGE IN ORDER TO MINIMIZE THE NUMBER OF SUB-LOOKUPS. 
-    # TO BE DONE.
+    # The default engine (SQLite) doesn't support huge amounts of parameters passes in a single SQL query,
+    # so the large sets of keys are joined as a temporary table (see select_by_keys).
     
     DB_LOOKUP = []
     total_read = 0
 
-    for vals_chunk in chunks(keys_for_lookup):
-        n_chunk = len(vals_chunk)        
-        stmt = sql.select(*[getattr(cls.__table__.c,key) for key,_ in cls.__keys__]).\
-            where(
-                sql.func.lower(cls.__table__.c.alias).in_(vals_chunk)
-            )
-        total_read += n_chunk            
-        DB_LOOKUP += session.execute(stmt)
+    stmt = sql.select(*[getattr(cls.__table__.c,key) for key,_ in cls.__keys__])
+    DB_LOOKUP += select_by_keys(stmt,sql.func.lower(cls.__table__.c.alias),keys_for_lookup)
+    total_read += len(keys_for_lookup)
                             
     # Split the initial items into two major categories.
 
@@ -1,3 +1,5 @@
+import numpy as np
+
 def parse_iso(par_line):
     """
     Parse iso token accounting for non-numerical entries (A,B,...)    
@@ -48,3 +50,66 @@ class HITRAN_DotparParser:
         return {
             pname:self.PARAMETER_MAP[pname](self.par_line) for pname in self.PARAMETER_MAP.keys()
         }
+
+
+# Fixed-width layout of the 160-character par_line: (name, start, end, type).
+# Must be kept consistent with HITRAN_DotparParser.PARAMETER_MAP.
+PAR_LINE_LENGTH = 160
+PAR_LINE_LAYOUT = (
+    ('molec_id',             0,   2, 'int'),
+    ('local_iso_id',         2,   3, 'iso'),
+    ('nu',                   3,  15, 'float'),
+    ('sw',                  15,  25, 'float'),
+    ('a',                   25,  35, 'float'),
+    ('gamma_air',           35,  40, 'float'),
+    ('gamma_self',          40,  45, 'float'),
+    ('elower',              45,  55, 'float'),
+    ('n_air',               55,  59, 'float'),
+    ('delta_air',           59,  67, 'float'),
+    ('global_upper_quanta', 67,  82, 'str'),
+    ('global_lower_quanta', 82,  97, 'str'),
+    ('local_upper_quanta',  97, 112, 'str'),
+    ('local_lower_quanta', 112, 127, 'str'),
+    ('ierr',               127, 133, 'str'),
+    ('iref',               133, 145, 'str'),
+    ('line_mixing_flag',   145, 146, 'str'),
+    ('gp',                 146, 153, 'intfloat'),
+    ('gpp',                153, 160, 'intfloat'),
+)
+
+def parse_iso_column(tokens):
+    """
+    Vectorized version of parse_iso.
+    INPUT: uint8 array of iso tokens (3rd character of par_line).
+    """
+    tokens = tokens.astype(np.int64)
+    iso = 11 + tokens - ord('A')
+    iso[tokens==ord('0')] = 10
+    digits = (tokens>=ord('1')) & (tokens<=ord('9'))
+    iso[digits] = tokens[digits] - ord('0')
+    return iso
+
+def parse_par_lines(PAR_LINES):
+    """
+    Vectorized parser of the block of par_lines.
+    INPUT: 
+        PAR_LINES: uint8 array of shape (N,160), one par_line per row.
+    OUTPUT: 
+        dict of typed numpy arrays, one per parameter of PARAMETER_MAP.
+    Raises ValueError if any of the numerical fields can't be converted.
+    """
+    COLUMNS = {}
+    for pname,i1,i2,ptype in PAR_LINE_LAYOUT:
+        if ptype=='iso':
+            COLUMNS[pname] = parse_iso_column(PAR_LINES[:,i1])
+            continue
+        tokens = np.ascontiguousarray(PAR_LINES[:,i1:i2]).view('S%d'%(i2-i1)).ravel()
+        if ptype=='int':
+            COLUMNS[pname] = tokens.astype(np.int64)
+        elif ptype=='float':
+            COLUMNS[pname] = tokens.astype(np.float64)
+        elif ptype=='intfloat':
+            COLUMNS[pname] = tokens.astype(np.float64).astype(np.int64)
+        else:
+            COLUMNS[pname] = tokens.astype('U%d'%(i2-i1))
+    return COLUMNS
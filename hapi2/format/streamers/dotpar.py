@@ -6,10 +6,16 @@ with "extended" (non-standard) sets of parameters.
 import os
 import re
 import json
+import multiprocessing
+from itertools import islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 
 from hapi2.format.streamer import AbstractStreamer
 
-from ..hitran.lbl import HITRAN_DotparParser
+from ..hitran.lbl import HITRAN_DotparParser, parse_par_lines, PAR_LINE_LENGTH
 
 def parse_hapi_line_(line,HAPI_HEADER,TYPES,par_line_flag=True):
     """
@@ -135,9 +141,327 @@ def stream_hapi_transition_data_(tmpdir,filestem,par_line_flag=True):
                         
             yield DCT
 
+# ===================================================================================
+# COLUMNAR PARSING MODE
+# ===================================================================================
+
+COLUMNAR_CHUNK_SIZE = 16*1024*1024 # number of bytes read from the data file at once
+
+NUMPY_TYPES = {int:np.int64, float:np.float64, str:str}
+
+def parse_hapi_block_(buf,HAPI_HEADER,TYPES,par_line_flag=True):
+    """
+    Vectorized counterpart of parse_hapi_line_ for a block of complete lines.
+    INPUT: 
+        buf: bytes containing whole lines, each terminated by the newline.
+    OUTPUT: 
+        dict of typed column arrays. Extra parameters containing the 
+        missing values ('#') are returned as masked arrays.
+    Raises ValueError if the block contains malformed lines.
+    """
+    data = np.frombuffer(buf,dtype=np.uint8)
+    ends = np.flatnonzero(data==ord('\n'))
+    starts = np.concatenate(([0],ends[:-1]+1))
+    nonempty = ends>starts
+    starts = starts[nonempty]; ends = ends[nonempty]
+    nlines = len(starts)
+    
+    COLUMNS = {}
+    
+    # Fixed-width par_line part.
+    di = 0
+    if par_line_flag:
+        if nlines and np.min(ends-starts)<PAR_LINE_LENGTH:
+            raise ValueError('par_line is shorter than %d characters'%PAR_LINE_LENGTH)
+        PAR_LINES = data[starts[:,None]+np.arange(PAR_LINE_LENGTH)]
+        COLUMNS.update(parse_par_lines(PAR_LINES))
+        di = PAR_LINE_LENGTH+1 # skip the separator following the par_line
+        
+    # Separated "extra" part.
+    EXTRA = HAPI_HEADER['extra']
+    if EXTRA and nlines:
+        mask = np.ones(len(data),dtype=bool)
+        if di: mask[(starts[:,None]+np.arange(di)).ravel()] = False
+        mask[data==ord('\n')] = False
+        tail = data.copy()
+        tail[ends] = ord(',')
+        mask[ends] = True
+        tokens = tail[mask].tobytes().split(b',')[:-1]
+        if len(tokens)!=nlines*len(EXTRA):
+            raise ValueError('wrong number of extra parameters')
+        tokens = np.array(tokens).reshape(nlines,len(EXTRA))
+        for i,par in enumerate(EXTRA):
+            column = tokens[:,i]
+            if i==len(EXTRA)-1: column = np.char.rstrip(column)
+            missing = column==b'#'
+            if np.any(missing):
+                column = column.copy(); column[missing] = b'0'
+                COLUMNS[par] = np.ma.array(
+                    column.astype(NUMPY_TYPES[TYPES[par]]),mask=missing)
+            else:
+                COLUMNS[par] = column.astype(NUMPY_TYPES[TYPES[par]])
+    elif EXTRA:
+        for par in EXTRA:
+            COLUMNS[par] = np.array([],dtype=NUMPY_TYPES[TYPES[par]])
+    
+    return COLUMNS
+
+def check_hapi_line_(line,HAPI_HEADER,TYPES,par_line_flag=True):
+    """
+    Check if the line can be parsed by the per-line parser.
+    """
+    try:
+        PARAMS = parse_hapi_line_(line,HAPI_HEADER,TYPES,par_line_flag)
+        if 'par_line' in PARAMS:
+            HITRAN_DotparParser(PARAMS['par_line']).all()
+    except (ValueError,IndexError) as e:
+        print('\n!!! FAILED TO PARSE PAR_LINE (SKIPPING)>>>')
+        print(line)
+        print(e,'\n')
+        return False
+    return True
+
+def parse_hapi_block_safe_(buf,HAPI_HEADER,TYPES,par_line_flag=True):
+    """
+    Same as parse_hapi_block_, but malformed lines are skipped
+    as in the per-line parser.
+    """
+    try:
+        return parse_hapi_block_(buf,HAPI_HEADER,TYPES,par_line_flag)
+    except ValueError:
+        pass
+    lines = buf.decode('utf-8').splitlines(keepends=True)
+    lines = [line for line in lines if line.strip() and \
+        check_hapi_line_(line,HAPI_HEADER,TYPES,par_line_flag)]
+    return parse_hapi_block_(''.join(lines).encode('utf-8'),
+        HAPI_HEADER,TYPES,par_line_flag)
+
+def read_hapi_blocks_(data_full_path,chunk_size=COLUMNAR_CHUNK_SIZE,offset=0,stop=None):
+    """
+    Read the HAPI .data file by large chunks aligned to line boundaries.
+    Optional offset and stop (in bytes) should also be aligned to line boundaries.
+    OUTPUT: lazy stream of bytes objects containing complete lines.
+    """
+    def read_chunks():
+        with open(data_full_path,'rb') as f:
+            f.seek(offset)
+            pos = offset
+            while True:
+                size = chunk_size if stop is None else min(chunk_size,stop-pos)
+                chunk = f.read(size) if size>0 else b''
+                if not chunk: break
+                pos += len(chunk)
+                yield chunk
+    return align_hapi_blocks_(read_chunks())
+
+def align_hapi_blocks_(chunks,min_size=0):
+    """
+    Align the stream of byte chunks (e.g. received from the network) to line boundaries.
+        min_size - join the chunks until the block has at least min_size bytes
+    OUTPUT: lazy stream of bytes objects containing complete lines.
+    """
+    tail = b''
+    for chunk in chunks:
+        buf = tail+chunk
+        i = buf.rfind(b'\n')
+        if i<0 or i+1<min_size:
+            tail = buf; continue
+        tail = buf[i+1:]
+        yield buf[:i+1]
+    if tail.strip():
+        yield tail+b'\n'
+
+def stream_hapi_transition_columns_(tmpdir,filestem,par_line_flag=True,
+        chunk_size=COLUMNAR_CHUNK_SIZE):
+    """
+    Columnar counterpart of stream_hapi_transition_data_.
+    OUTPUT: lazy stream of column batches (dicts of typed numpy arrays)
+            with parameters named as in the HAPI header and PARAMETER_MAP.
+    """
+    header_full_path = os.path.join(tmpdir,filestem+'.header')
+    data_full_path = os.path.join(tmpdir,filestem+'.data')
+    
+    # Read HAPI header
+    with open(header_full_path) as f:
+        HAPI_HEADER  = json.load(f)
+        
+    # Prepare type table for converting parameters
+    TYPES = prepare_type_table_(HAPI_HEADER)
+    
+    for buf in read_hapi_blocks_(data_full_path,chunk_size):
+        yield parse_hapi_block_safe_(buf,HAPI_HEADER,TYPES,par_line_flag)
+
+def stream_hapi_transition_columns_from_chunks_(tmpdir,filestem,chunks,par_line_flag=True,
+        chunk_size=COLUMNAR_CHUNK_SIZE):
+    """
+    Same as stream_hapi_transition_columns_, but the content of the .data file
+    is given by the stream of byte chunks of arbitrary size (e.g. the download in progress).
+    Chunks are joined to the blocks of at least chunk_size bytes.
+    """
+    header_full_path = os.path.join(tmpdir,filestem+'.header')
+    
+    # Read HAPI header
+    with open(header_full_path) as f:
+        HAPI_HEADER  = json.load(f)
+        
+    # Prepare type table for converting parameters
+    TYPES = prepare_type_table_(HAPI_HEADER)
+    
+    for buf in align_hapi_blocks_(chunks,chunk_size):
+        yield parse_hapi_block_safe_(buf,HAPI_HEADER,TYPES,par_line_flag)
+
+def columns_to_transition_dicts_(COLUMNS):
+    """
+    Convert the column batch to the list of transition dicts 
+    in the same format as given by stream_hapi_transition_data_.
+    """
+    COLUMNS = COLUMNS.copy()
+    nlines = len(next(iter(COLUMNS.values()))) if COLUMNS else 0
+    
+    # split columns to transition attributes and the rest of parameters
+    ATTRS = {attr:COLUMNS.pop(attr).tolist() for attr in TRANS_ATTRS if attr in COLUMNS}
+    EXTRA = {par:COLUMNS[par].tolist() for par in COLUMNS} # masked values become None
+    
+    # establish isotopologue aliases
+    if 'isotopologue_alias' in EXTRA:
+        ISOALS = EXTRA.pop('isotopologue_alias')
+    elif 'iso_id' in EXTRA:
+        ISOALS = ['HITRAN-iso-%d'%i for i in EXTRA.pop('iso_id')]
+    elif 'global_iso_id' in EXTRA:
+        ISOALS = ['HITRAN-iso-%d'%i for i in EXTRA.pop('global_iso_id')]
+    elif 'molec_id' in ATTRS and 'local_iso_id' in ATTRS:
+        ISOALS = ['HITRAN-iso-%d-%d'%MI for MI in zip(ATTRS['molec_id'],ATTRS['local_iso_id'])]
+    else:
+        ISOALS = ['unknown_alias']*nlines
+    IDS = EXTRA.pop('trans_id',None)
+        
+    TRANS_DICTS = []
+    for i in range(nlines):
+        DCT = {attr:ATTRS[attr][i] for attr in ATTRS}
+        if IDS is not None: DCT['id_'] = IDS[i]
+        DCT['isotopologue_alias'] = ISOALS[i]
+        DCT['extra'] = {par:EXTRA[par][i] for par in EXTRA if EXTRA[par][i] is not None}
+        TRANS_DICTS.append(DCT)
+    
+    return TRANS_DICTS
+
+# ===================================================================================
+# PARALLEL (SHARDED) PARSING MODE
+# ===================================================================================
+
+def shard_hapi_data_file_(data_full_path,shard_size=COLUMNAR_CHUNK_SIZE):
+    """
+    Split the HAPI .data file into byte ranges aligned to line boundaries.
+    OUTPUT: list of (offset,stop) tuples.
+    """
+    size = os.path.getsize(data_full_path)
+    SHARDS = []
+    offset = 0
+    with open(data_full_path,'rb') as f:
+        while offset<size:
+            stop = offset+shard_size
+            if stop<size:
+                f.seek(stop-1)
+                f.readline() # move to the end of the current line
+                stop = f.tell()
+            else:
+                stop = size
+            SHARDS.append((offset,stop))
+            offset = stop
+    return SHARDS
+
+def parse_hapi_shard_(data_full_path,offset,stop,HAPI_HEADER,TYPES,par_line_flag=True,
+        chunk_size=COLUMNAR_CHUNK_SIZE):
+    """
+    Parse one shard of the HAPI .data file (executed in the worker process).
+    OUTPUT: list of column batches.
+    """
+    return [parse_hapi_block_safe_(buf,HAPI_HEADER,TYPES,par_line_flag) \
+        for buf in read_hapi_blocks_(data_full_path,chunk_size,offset,stop)]
+
+def get_mp_context_():
+    """
+    Workers are spawned rather than forked: forking the process in which 
+    the numba threading layer is already launched (this happens when the parallel 
+    kernels from hapi2.opacity are compiled) makes the processes hang on exit.
+    """
+    return multiprocessing.get_context('spawn')
+
+def stream_hapi_transition_columns_parallel_(tmpdir,filestem,nworkers=None,queue_depth=None,
+        par_line_flag=True,shard_size=COLUMNAR_CHUNK_SIZE):
+    """
+    Parallel counterpart of stream_hapi_transition_columns_.
+    The data file is split into shards aligned to line boundaries, 
+    which are parsed in the process pool with nworkers processes. 
+    Column batches are yielded in the file order; at most queue_depth 
+    shards are parsed ahead of the consumer.
+    """
+    header_full_path = os.path.join(tmpdir,filestem+'.header')
+    data_full_path = os.path.join(tmpdir,filestem+'.data')
+    
+    # Read HAPI header
+    with open(header_full_path) as f:
+        HAPI_HEADER  = json.load(f)
+        
+    # Prepare type table for converting parameters
+    TYPES = prepare_type_table_(HAPI_HEADER)
+    
+    if nworkers is None: nworkers = os.cpu_count()
+    if queue_depth is None: queue_depth = 2*nworkers
+    
+    SHARDS = iter(shard_hapi_data_file_(data_full_path,shard_size))
+    
+    PENDING = deque() # futures of the shards being parsed
+    
+    with ProcessPoolExecutor(max_workers=nworkers,mp_context=get_mp_context_()) as pool:
+        
+        def submit(nshards):
+            for offset,stop in islice(SHARDS,nshards):
+                PENDING.append(pool.submit(parse_hapi_shard_,data_full_path,offset,stop,
+                    HAPI_HEADER,TYPES,par_line_flag,shard_size))
+        
+        submit(queue_depth)
+        while PENDING:
+            BLOCKS = PENDING.popleft().result()
+            submit(1)
+            for COLUMNS in BLOCKS:
+                yield COLUMNS
+
 class DotparStreamer(AbstractStreamer):
     def __iter__(self):
         tmpdir = self.__basedir__
         filestem = self.__header__['content']['linelist']
         for item in stream_hapi_transition_data_(tmpdir,filestem,par_line_flag=True):
             yield item
+            
+    def iter_columns(self,chunk_size=COLUMNAR_CHUNK_SIZE):
+        """
+        Columnar parsing mode: yield batches of typed column arrays.
+        """
+        tmpdir = self.__basedir__
+        filestem = self.__header__['content']['linelist']
+        for columns in stream_hapi_transition_columns_(tmpdir,filestem,
+                par_line_flag=True,chunk_size=chunk_size):
+            yield columns
+
+    def iter_columns_from_chunks(self,chunks,chunk_size=COLUMNAR_CHUNK_SIZE):
+        """
+        Columnar parsing mode for the data given by the stream of byte chunks
+        instead of the .data file (the .header file must exist).
+        """
+        tmpdir = self.__basedir__
+        filestem = self.__header__['content']['linelist']
+        for columns in stream_hapi_transition_columns_from_chunks_(tmpdir,filestem,chunks,
+                par_line_flag=True,chunk_size=chunk_size):
+            yield columns
+
+    def iter_columns_parallel(self,nworkers=None,queue_depth=None,shard_size=COLUMNAR_CHUNK_SIZE):
+        """
+        Sharded columnar parsing mode: yield batches of typed column arrays
+        parsed in the process pool.
+        """
+        tmpdir = self.__basedir__
+        filestem = self.__header__['content']['linelist']
+        for columns in stream_hapi_transition_columns_parallel_(tmpdir,filestem,
+                nworkers=nworkers,queue_depth=queue_depth,par_line_flag=True,shard_size=shard_size):
+            yield columns
@@ -6,4 +6,14 @@ def init():
 
     opacity = importlib.import_module('hapi2.opacity.models')
 
-    VARSPACE['opacity'] = opacity
\ No newline at end of file
+    # hapi2.opacity is the models module (see hapi2/__init__.py)
+    opacity.warmup = warmup
+
+    VARSPACE['opacity'] = opacity
+
+def warmup():
+    """
+    Compile the LBL kernels ahead of time (see SETTINGS['numba_cache']).
+    """
+    from .lbl.numba.fast_abscoef import warmup
+    return warmup()
\ No newline at end of file
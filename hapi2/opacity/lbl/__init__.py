@@ -1,3 +1,5 @@
 from . import numba
 from . import numpy
-from .calc_xsc import LBL_CALC
\ No newline at end of file
+from .calc_xsc import LBL_CALC
+from .calc_xsc import LBL_CALC_MULTI
+from .lut import LUT, build_lut
\ No newline at end of file
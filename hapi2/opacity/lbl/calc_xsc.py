@@ -4,10 +4,11 @@ import hapi
 import numpy as np
 
 from functools import reduce
-from sqlalchemy import func
+from sqlalchemy import func, cast, Integer
 
-from hapi2.config import VARSPACE
+from hapi2.config import SETTINGS, VARSPACE
 from hapi2.db.sqlalchemy.legacy import storage2cache
+from hapi2.db.sqlalchemy.columnar import columns2cache, load_columns
 
 from . import numba
 
@@ -44,13 +45,9 @@ def create_components(isos,mixture):
 def get_pfunction_lambda(src):
     """ Get the input lambda partition function for the given set of isotopologues """
     
-    iso_hash = {}
-    for pfunc in src.partition_functions:
-        M = pfunc.isotopologue.molecule.id
-        I = pfunc.isotopologue.isoid
-        iso_hash[(M,I)] = pfunc
+    tables = models.PartitionFunction.get_tables(src)
     
-    pfunc_lambda = lambda M,I,T: iso_hash[(M,I)].Q(T)
+    pfunc_lambda = lambda M,I,T: tables[(M,I)](T)
     
     return pfunc_lambda
 
@@ -66,6 +63,142 @@ def get_wavenumber_grid(options,linelist):
         WavenumberGrid = hapi.arange_(*WavenumberRange,WavenumberStep)
     return WavenumberGrid
 
+LBL_WINDOW_BINS = 10000 # resolution of the line center histogram used for windowing
+LBL_WING_PARNAMES = ['nu','gamma_air','gamma_self','n_air','delta_air']
+
+class LinesFromDatabase:
+    """ Transitions of the query loaded from the database by the wavenumber windows. """
+
+    def __init__(self,query):
+        self.query = query
+
+    def get_limits(self):
+        """ Get (min,max) of the parameters needed for estimating the line wings. """
+        cols = [getattr(models.Transition,parname) for parname in LBL_WING_PARNAMES]
+        row = self.query.with_entities(
+            *[func.min(col) for col in cols],*[func.max(col) for col in cols]).first()
+        n = len(cols)
+        return {parname:(row[i],row[n+i]) for i,parname in enumerate(LBL_WING_PARNAMES)}
+
+    def get_histogram(self,edges):
+        """ Count line centers in the bins with the given (uniform) edges. """
+        nu = models.Transition.nu
+        width = (edges[-1]-edges[0])/(len(edges)-1)
+        ibin = cast((nu-edges[0])/width,Integer)
+        counts = np.zeros(len(edges)-1,dtype=np.int64)
+        for i,count in self.query.filter(nu>=edges[0],nu<=edges[-1]).\
+                with_entities(ibin,func.count()).group_by(ibin):
+            counts[min(i,len(counts)-1)] += count
+        return counts
+
+    def load(self,tablename,wnrange=None):
+        """ Put the lines with centers within wnrange to the HAPI table cache. """
+        query = self.query
+        if wnrange is not None:
+            query = query.filter(models.Transition.nu>=wnrange[0],models.Transition.nu<=wnrange[1])
+        storage2cache(tablename,query=query)
+
+class LinesFromColumns:
+    """ Transitions of the linelist mapped from the columnar store by the wavenumber windows. """
+
+    def __init__(self,llst_name,isoal_ids=None):
+        self.llst_name = llst_name
+        self.isoal_ids = isoal_ids
+
+    def get_limits(self):
+        """ Get (min,max) of the parameters needed for estimating the line wings. """
+        header,data = load_columns(self.llst_name,LBL_WING_PARNAMES)
+        limits = {}
+        for parname in LBL_WING_PARNAMES:
+            col = header['columns'][parname]
+            if col.get('min') is None: # store written without the limits
+                col['min'],col['max'] = np.nanmin(data[parname]),np.nanmax(data[parname])
+            limits[parname] = (col['min'],col['max'])
+        return limits
+
+    def get_histogram(self,edges):
+        """ Count line centers in the bins with the given edges. """
+        NU = load_columns(self.llst_name,['nu'])[1]['nu']
+        return np.diff(np.searchsorted(NU,edges,side='left')).astype(np.int64)
+
+    def load(self,tablename,wnrange=None):
+        """ Put the lines with centers within wnrange to the HAPI table cache. """
+        columns2cache(tablename,self.llst_name,isoal_ids=self.isoal_ids,wnrange=wnrange)
+
+def get_lines(linelist,isoal_ids):
+    """ Get the transitions of the linelist for the given isotopologue aliases. """
+    if load_columns(linelist.name,['nu'])[0] is not None:
+        return LinesFromColumns(linelist.name,isoal_ids)
+    return LinesFromDatabase(linelist.transitions.filter(
+        models.Transition.isotopologue_alias_id.in_(isoal_ids)))
+
+def get_max_wing(limits,options,Environment,Diluent):
+    """ 
+    Get the upper bound of the line wing used by the kernels,
+    i.e. max(OmegaWing,OmegaWingHW*GammaL,OmegaWingHW*GammaD) plus the line shift.
+    The Doppler width is taken for the lightest possible mass (1 amu).
+    """
+    T = Environment['T']; p = Environment['p']; Tref = 296.0; pref = 1.0
+    wing = options.get('WavenumberWing',options.get('OmegaWing')) or 0.0
+    wing_hw = options.get('WavenumberWingHW',options.get('OmegaWingHW',hapi.DefaultOmegaWingHW))
+    fraction = max(1.0,sum(Diluent.values()))
+    n_min,n_max = [val or 0.0 for val in limits['n_air']]
+    gamma_max = max([limits[parname][1] or 0.0 for parname in ('gamma_air','gamma_self')])
+    gamma_l = fraction*gamma_max*p/pref*(Tref/T)**(n_max if T<Tref else n_min)
+    TD = max(T,options.get('TDoppler') or T)
+    gamma_d = np.sqrt(2*hapi.cBolts*TD*np.log(2)/(1.66053873e-24)/hapi.cc**2)*limits['nu'][1]
+    shift = fraction*p/pref*max([abs(val or 0.0) for val in limits['delta_air']])
+    return max(wing,wing_hw*gamma_l,wing_hw*gamma_d)+shift
+
+def get_grid_windows(wngrid,edges,counts,wing,line_budget):
+    """
+    Split the wavenumber grid into windows, so that each window 
+    extended by the wings holds at most line_budget lines 
+    according to the histogram of line centers (edges,counts).
+    Returns the list of (start,stop) grid indexes.
+    """
+    CUMSUM = np.concatenate(([0],np.cumsum(counts)))
+    width = (edges[-1]-edges[0])/(len(edges)-1)
+    nbins = len(counts)
+    windows = []
+    j0 = 0
+    while j0<len(wngrid):
+        lower = min(max(int((wngrid[j0]-wing-edges[0])//width),0),nbins-1)
+        # last bin which can be covered by the window without exceeding the budget
+        upper = np.searchsorted(CUMSUM,CUMSUM[lower]+line_budget,side='right')-2
+        if upper>=nbins-1:
+            j1 = len(wngrid)
+        else:
+            j1 = np.searchsorted(wngrid,edges[upper+1]-wing,side='left')
+        if j1<=j0:
+            raise Exception('line budget %d is too small for the line density near %f cm-1'%\
+                (line_budget,wngrid[j0]))
+        windows.append((j0,j1))
+        j0 = j1
+    return windows
+
+def calc_windows(lines,wngrid,calc,line_budget=None,wing=0.0,tablename='~scratch',nlayers=None):
+    """
+    Calculate the cross-section on the wavenumber grid loading the lines by the windows
+    (see get_grid_windows) to keep at most line_budget lines in RAM. 
+    The lines are loaded all at once if line_budget is None.
+        lines - line source (LinesFromDatabase or LinesFromColumns)
+        calc - function calculating cross-section for the given table name and grid
+        nlayers - number of layers if calc returns 2D array [nlayers,len(grid)]
+    """
+    if line_budget is None:
+        lines.load(tablename)
+        return calc(tablename,wngrid)
+    xsc = np.zeros(len(wngrid) if nlayers is None else (nlayers,len(wngrid)))
+    edges = np.linspace(wngrid[0]-wing,wngrid[-1]+wing,LBL_WINDOW_BINS+1)
+    counts = lines.get_histogram(edges)
+    for j0,j1 in get_grid_windows(wngrid,edges,counts,wing,line_budget):
+        lines.load(tablename,(wngrid[j0]-wing,wngrid[j1-1]+wing))
+        if len(hapi.LOCAL_TABLE_CACHE[tablename]['data']['nu'])>0:
+            xsc[...,j0:j1] += calc(tablename,wngrid[j0:j1])
+        del hapi.LOCAL_TABLE_CACHE[tablename]
+    return xsc
+
 @provenance.track(nout=1,cache=False,autosave=False)
 def LBL_CALC(
         linelist,
@@ -80,6 +213,9 @@ def LBL_CALC(
     
     # Calculate abscoefs for each molecule separately to avoid the "self" bug.
     
+    # Set LineBudget option to calculate out-of-core by the wavenumber windows 
+    # keeping at most LineBudget lines in RAM (see calc_windows).
+    
     Environment = conditions.dict
       
     wngrid = get_wavenumber_grid(options,linelist)
@@ -92,6 +228,7 @@ def LBL_CALC(
     pfunc = get_pfunction_lambda(pfunction_source)
 
     options_ = options.copy()
+    line_budget = options_.pop('LineBudget',SETTINGS.get('lbl_line_budget'))
     options_.update(dict(
         partitionFunction=pfunc,
         Environment=Environment,
@@ -115,15 +252,19 @@ def LBL_CALC(
         
         isoals = reduce(lambda x,y:x+y,[iso.aliases for iso in isos])
         isoal_ids = [al.id for al in isoals]
-        query = linelist.transitions.filter(
-            models.Transition.isotopologue_alias_id.in_(isoal_ids))
-        storage2cache(SourceTables,query=query)
+        # Use the memory-mapped columnar store of the linelist if it exists.
+        lines = get_lines(linelist,isoal_ids)
+        
+        def calc(tablename,grid):
+            _,xsc_ = lbl_backend.absorptionCoefficient_Generic(**dict(options_,WavenumberGrid=grid),
+                Components=Components,SourceTables=tablename,Diluent=Diluent,
+                profile=profile,calcpars=calcpars)
+            return xsc_
         
-        _,xsc_ = lbl_backend.absorptionCoefficient_Generic(**options_,
-            Components=Components,SourceTables=SourceTables,Diluent=Diluent,
-            profile=profile,calcpars=calcpars)
+        wing = get_max_wing(lines.get_limits(),options,Environment,Diluent) \
+            if line_budget is not None else 0.0
         
-        xsc += xsc_
+        xsc += calc_windows(lines,options_['WavenumberGrid'],calc,line_budget,wing,SourceTables)
 
     # The pure molecule can not be assigned if the linelist contains 
     # lines of multiple molecules mixed together. 
@@ -147,3 +288,89 @@ def LBL_CALC(
     xs.set_data(wngrid,xsc)
     
     return xs
+
+def get_layers(conditions,mixtures):
+    """
+    Get the lists of per-layer environments and mixtures.
+        conditions - list of Conditions, or dictionary of arrays {'T':...,'p':...}
+        mixtures - list of Mixtures, or one Mixture for all layers
+    """
+    if type(conditions) is dict:
+        TS,PS = np.broadcast_arrays(conditions['T'],conditions['p'])
+        Environments = [dict(T=float(T),p=float(p)) for T,p in zip(TS.ravel(),PS.ravel())]
+    else:
+        Environments = [cond.dict for cond in conditions]
+    if type(mixtures) not in (list,tuple):
+        mixtures = [mixtures]*len(Environments)
+    if len(mixtures)!=len(Environments):
+        raise Exception('numbers of conditions and mixtures must be equal')
+    return Environments,mixtures
+
+def LBL_CALC_MULTI(
+        linelist,
+        mixtures,
+        conditions,
+        pfunction_source,
+        profile,
+        calcpars,
+        lbl_backend,
+        options,
+    ):
+    """
+    Calculate the cross-sections of the linelist on the common grid for multiple layers
+    (see get_layers), loading the lines and partition functions once.
+    Layers are calculated in one kernel launch if the backend has absorptionCoefficient_Multi,
+    otherwise absorptionCoefficient_Generic is called for each layer.
+    Per-layer VMR can be given by scaling the mixture, e.g. [mixture*vmr for vmr in VMR].
+    Returns the wavenumber grid and 2D array of cross-sections [n_layers,n_grid].
+    """
+    Environments,mixtures = get_layers(conditions,mixtures)
+    nlayers = len(Environments)
+    
+    wngrid = get_wavenumber_grid(options,linelist)
+    xsc = np.zeros((nlayers,len(wngrid)))
+    
+    mols = sorted(linelist.molecules,key=lambda mol:mol.id)
+
+    pfunc = get_pfunction_lambda(pfunction_source)
+
+    options_ = options.copy()
+    line_budget = options_.pop('LineBudget',SETTINGS.get('lbl_line_budget'))
+    options_.update(dict(
+        partitionFunction=pfunc,
+        WavenumberGrid=np.array(wngrid),
+    ))
+
+    linelist_isos = linelist.isotopologues
+    
+    calc_multi = getattr(lbl_backend,'absorptionCoefficient_Multi',None)
+
+    for mol in mols:
+        
+        isos = set(linelist_isos).intersection(mol.isotopologues)
+        Diluents = [create_diluent(mixture.get_component_name(mol),mixture) for mixture in mixtures]
+        
+        isoals = reduce(lambda x,y:x+y,[iso.aliases for iso in isos])
+        isoal_ids = [al.id for al in isoals]
+        lines = get_lines(linelist,isoal_ids)
+        
+        def calc(tablename,grid):
+            if calc_multi is not None:
+                _,xsc_ = calc_multi(**dict(options_,WavenumberGrid=grid),
+                    SourceTables=tablename,Environments=Environments,Diluents=Diluents,
+                    profile=profile,calcpars=calcpars)
+                return xsc_
+            xsc_ = np.zeros((nlayers,len(grid)))
+            for i in range(nlayers):
+                _,xsc_[i] = lbl_backend.absorptionCoefficient_Generic(**dict(options_,WavenumberGrid=grid),
+                    Environment=Environments[i],SourceTables=tablename,Diluent=Diluents[i],
+                    profile=profile,calcpars=calcpars)
+            return xsc_
+        
+        wing = max([get_max_wing(lines.get_limits(),options,Environment,Diluent) \
+            for Environment,Diluent in zip(Environments,Diluents)]) \
+            if line_budget is not None else 0.0
+        
+        xsc += calc_windows(lines,options_['WavenumberGrid'],calc,line_budget,wing,'~scratch',nlayers)
+        
+    return wngrid,xsc
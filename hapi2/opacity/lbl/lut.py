@@ -0,0 +1,223 @@
+""" Precomputed look-up tables (LUT) of the absorption cross-sections """
+
+import os
+import json
+
+import numpy as np
+
+from hapi2.config import VARSPACE
+
+from .calc_xsc import LBL_CALC_MULTI
+
+LUT_HEADER = 'header.json'
+LUT_GRID = 'wngrid.npy'
+LUT_DTYPE = 'float32'
+
+def get_lut_name_(linelist):
+    """
+    Get the default LUT array name for the linelist (name of its only molecule).
+    """
+    mols = linelist.molecules
+    if len(mols)!=1:
+        raise Exception('linelist %s contains %d molecules, LUT name must be given explicitly'%\
+            (linelist.name,len(mols)))
+    return mols[0].common_name
+
+def get_interp_weights_(NODES,X):
+    """
+    Get the lower node indexes and the linear interpolation weights
+    of the upper nodes for the points X.
+    """
+    X = np.asarray(X,dtype=np.float64)
+    if len(NODES)==1:
+        if np.any(X!=NODES[0]):
+            raise Exception('LUT has the only node %f'%NODES[0])
+        return np.zeros(X.shape,dtype=np.int64),np.zeros(X.shape)
+    if np.any(X<NODES[0]) or np.any(X>NODES[-1]):
+        raise Exception('values are out of the LUT range [%f,%f]'%(NODES[0],NODES[-1]))
+    INDEX = np.clip(np.searchsorted(NODES,X,side='right')-1,0,len(NODES)-2)
+    WEIGHT = (X-NODES[INDEX])/(NODES[INDEX+1]-NODES[INDEX])
+    return INDEX,WEIGHT
+
+class LUT:
+    """
+    Look-up table of the cross-sections on the grid of temperatures, pressures,
+    and (optionally) the VMR of the varying component, e.g. H2O.
+    The table is stored in the folder with the JSON header, the wavenumber grid,
+    and one memory-mapped array [nvmr,np,nT,ngrid] per molecule,
+    which is filled by chunks [nT,ngrid] (see build).
+    Completed chunks are marked in the array <name>.done.npy to resume
+    the interrupted builds.
+    """
+
+    def __init__(self,dirname):
+        self.dirname = dirname
+        with open(os.path.join(dirname,LUT_HEADER)) as f:
+            self.header = json.load(f)
+        self.wngrid = np.load(os.path.join(dirname,LUT_GRID))
+        self.temperatures = np.array(self.header['temperatures'])
+        self.pressures = np.array(self.header['pressures'])
+        self.vmrs = np.array(self.header['vmrs'])
+        self.__arrays__ = {}
+
+    @classmethod
+    def create(cls,dirname,wngrid,temperatures,pressures,vmrs=None,vmr_component=None,dtype=LUT_DTYPE):
+        """
+        Create the empty LUT, or open the existing one if it has the same grids.
+            temperatures - temperature nodes (K)
+            pressures - pressure nodes (atm), interpolated in log scale
+            vmrs - VMR nodes of the varying component (vmr_component)
+        """
+        if vmrs is None: vmrs = [0.0]
+        header = {
+            'temperatures':[float(T) for T in temperatures],
+            'pressures':[float(p) for p in pressures],
+            'vmrs':[float(vmr) for vmr in vmrs],
+            'vmr_component':vmr_component,
+            'dtype':np.dtype(dtype).str,
+            'npnts':len(wngrid),
+            'molecules':[],
+        }
+        for key in ('temperatures','pressures','vmrs'):
+            if np.any(np.diff(header[key])<=0):
+                raise Exception('LUT %s must be strictly increasing'%key)
+        if min(header['pressures'])<=0:
+            raise Exception('LUT pressures must be positive')
+        header_path = os.path.join(dirname,LUT_HEADER)
+        if os.path.exists(header_path):
+            lut = cls(dirname)
+            header['molecules'] = lut.header['molecules']
+            if lut.header!=header or not np.array_equal(lut.wngrid,wngrid):
+                raise Exception('LUT %s exists and has different grids'%dirname)
+            return lut
+        os.makedirs(dirname,exist_ok=True)
+        np.save(os.path.join(dirname,LUT_GRID),np.asarray(wngrid,dtype=np.float64))
+        with open(header_path,'w') as f:
+            json.dump(header,f,indent=2)
+        return cls(dirname)
+
+    def save_header_(self):
+        header_path = os.path.join(self.dirname,LUT_HEADER)
+        with open(header_path+'.tmp','w') as f:
+            json.dump(self.header,f,indent=2)
+        os.replace(header_path+'.tmp',header_path)
+
+    def get_shape_(self):
+        return (len(self.vmrs),len(self.pressures),len(self.temperatures),len(self.wngrid))
+
+    def get_array(self,name,mode='r'):
+        """
+        Get the memory-mapped table of the molecule (created if mode is 'r+').
+        """
+        key = (name,mode)
+        if key not in self.__arrays__:
+            path = os.path.join(self.dirname,name+'.npy')
+            if name not in self.header['molecules']:
+                if mode=='r':
+                    raise Exception('LUT %s has no table for %s'%(self.dirname,name))
+                np.lib.format.open_memmap(path,mode='w+',dtype=self.header['dtype'],
+                    shape=self.get_shape_())
+                np.lib.format.open_memmap(path[:-4]+'.done.npy',mode='w+',dtype=np.bool_,
+                    shape=self.get_shape_()[:2])
+                self.header['molecules'].append(name)
+                self.save_header_()
+            self.__arrays__[key] = (np.load(path,mmap_mode=mode),
+                np.load(path[:-4]+'.done.npy',mmap_mode=mode))
+        return self.__arrays__[key]
+
+    def is_complete(self,name):
+        """
+        Check if all chunks of the molecule's table are calculated.
+        """
+        return name in self.header['molecules'] and bool(self.get_array(name)[1].all())
+
+    def build(self,name,calc):
+        """
+        Fill the missing chunks of the molecule's table.
+            calc - function calculating the cross-sections [nT,ngrid]
+                   for the given list of environments {'T':...,'p':...} and VMR
+        Each chunk is flushed to disk before it is marked as done,
+        so the interrupted build can be resumed by calling build again.
+        Returns the number of calculated chunks.
+        """
+        DATA,DONE = self.get_array(name,'r+')
+        nchunks = 0
+        for ivmr,vmr in enumerate(self.vmrs):
+            for ip,p in enumerate(self.pressures):
+                if DONE[ivmr,ip]: continue
+                Environments = [{'T':float(T),'p':float(p)} for T in self.temperatures]
+                DATA[ivmr,ip] = calc(Environments,float(vmr))
+                DATA.flush()
+                DONE[ivmr,ip] = True
+                DONE.flush()
+                nchunks += 1
+                print('LUT %s: chunk p=%g atm, vmr=%g is done (%d of %d)'%\
+                    (name,p,vmr,DONE.sum(),DONE.size))
+        return nchunks
+
+    def interpolate(self,name,T,p,vmr=None):
+        """
+        Interpolate the cross-sections of the molecule linearly in T, log(p), and VMR.
+        T, p and vmr are scalars or arrays of the same shape.
+        Returns the array of cross-sections [...,ngrid].
+        """
+        if not self.is_complete(name):
+            raise Exception('LUT %s for %s is incomplete'%(self.dirname,name))
+        DATA,_ = self.get_array(name)
+        T,p = np.broadcast_arrays(np.asarray(T,dtype=np.float64),np.asarray(p,dtype=np.float64))
+        vmr = np.broadcast_to(np.asarray(self.vmrs[0] if vmr is None else vmr,dtype=np.float64),T.shape)
+        IT,WT = get_interp_weights_(self.temperatures,T.ravel())
+        IP,WP = get_interp_weights_(np.log(self.pressures),np.log(p.ravel()))
+        IV,WV = get_interp_weights_(self.vmrs,vmr.ravel())
+        XSC = np.zeros((T.size,len(self.wngrid)))
+        for dv in (0,1):
+            if len(self.vmrs)==1 and dv: continue
+            for dp in (0,1):
+                if len(self.pressures)==1 and dp: continue
+                for dT in (0,1):
+                    if len(self.temperatures)==1 and dT: continue
+                    W = (WV if dv else 1-WV)*(WP if dp else 1-WP)*(WT if dT else 1-WT)
+                    XSC += W[:,None]*DATA[IV+dv,IP+dp,IT+dT]
+        return XSC.reshape(T.shape+(len(self.wngrid),))
+
+    def cross_section(self,name,T,p,vmr=None):
+        """
+        Interpolate the cross-section of the molecule at the given conditions
+        and return it as the transient CrossSection object (see interpolate).
+        """
+        models = VARSPACE['db_backend'].models
+        xsc = self.interpolate(name,float(T),float(p),vmr)
+        xs = models.CrossSection(
+            molecule=models.Molecule(name),source=models.Source('LUT'),
+            temperature=T,
+            pressure=p,
+            npnts=len(self.wngrid),
+            sigma_max=max(xsc),
+        )
+        xs.set_data(self.wngrid,xsc)
+        return xs
+
+def build_lut(lut,linelist,mixture,pfunction_source,profile,calcpars,lbl_backend,options,name=None):
+    """
+    Build (or resume building) the LUT table for the linelist with LBL_CALC_MULTI.
+    Each chunk is one batched calculation for all temperatures of the LUT,
+    so the cores are busy with the layer-parallel kernel.
+    The varying component (lut.header['vmr_component']) is mixed into
+    the mixture as mixture*(1-vmr)+component*vmr.
+        lut - LUT object (see LUT.create)
+        name - name of the table (default: molecule of the linelist)
+    """
+    opacity = VARSPACE['opacity']
+    if name is None: name = get_lut_name_(linelist)
+    options = dict(options,WavenumberGrid=lut.wngrid)
+    vmr_component = lut.header['vmr_component']
+
+    def calc(Environments,vmr):
+        mixture_ = mixture
+        if vmr_component is not None:
+            mixture_ = mixture*(1-vmr)+opacity.Mixture(vmr_component)*vmr
+        _,xsc = LBL_CALC_MULTI(linelist,mixture_,{'T':[env['T'] for env in Environments],
+            'p':[env['p'] for env in Environments]},pfunction_source,profile,calcpars,lbl_backend,options)
+        return xsc
+
+    return lut.build(name,calc)
@@ -1,4 +1,5 @@
 from .fast_abscoef import absorptionCoefficient_Voigt
 from .fast_abscoef import absorptionCoefficient_Lorentz
 from .fast_abscoef import absorptionCoefficient_Doppler
-from .fast_abscoef import absorptionCoefficient_Generic
\ No newline at end of file
+from .fast_abscoef import absorptionCoefficient_Generic
+from .fast_abscoef import absorptionCoefficient_Multi
\ No newline at end of file
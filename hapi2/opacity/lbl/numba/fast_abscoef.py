@@ -12,6 +12,9 @@ from time import time
 
 from .settings import FASTMATH
 from .settings import PARALLEL
+from .settings import ADAPTIVE_CORE_HW
+from .settings import CACHE
+from . import settings
 
 from hapi import PYTIPS,DefaultIntensityThreshold,DefaultOmegaWingHW,\
                  listOfTuples,getDefaultValuesForXsect
@@ -22,7 +25,6 @@ PROFILE = PROFILE_SDVOIGT # numba version
 
 from .pCqSDHC_ import pcqsdhc as pcqsdhc_new, PROFILE_HT
 
-CACHE = False
 
 import warnings
 from functools import wraps
@@ -281,7 +283,7 @@ def GET_ISOS_DEFAULT_ABUN(N,MOLEC_ID,LOCAL_ISO_ID):
     # https://docs.scipy.org/doc/numpy-1.13.0/reference/generated/numpy.full.html
     ABUN = np.full(N,fill_value=-1.,dtype=np.float64)
     # https://stackoverflow.com/questions/44409084/how-to-zip-two-1d-numpy-array-to-2d-numpy-array
-    ZIPPED = np.array(list(zip(MOLEC_ID,LOCAL_ISO_ID,ABUN)))
+    ZIPPED = np.column_stack((np.ma.filled(MOLEC_ID,-1),np.ma.filled(LOCAL_ISO_ID,-1),ABUN))
     # https://stackoverflow.com/questions/16970982/find-unique-rows-in-numpy-array
     ISOS = np.unique(ZIPPED,axis=0)
     return ISOS
@@ -411,7 +413,8 @@ def absorptionCoefficient_Voigt(Components=None,SourceTables=None,partitionFunct
                                 WavenumberRange=None,WavenumberStep=None,WavenumberWing=None,
                                 WavenumberWingHW=None,WavenumberGrid=None,
                                 Diluent={},EnvDependences=None,NCORES=1,TDoppler=None,
-                                atomicadd=True):
+                                atomicadd=True,reduction=None,WingTolerance=None,
+                                RelativeIntensityThreshold=None):
     """
     ======================================================================
     FAST NUMBA IMPLEMENTATION OF THE ABSORPTION CROSS-SECTION CALCULATION
@@ -436,6 +439,9 @@ def absorptionCoefficient_Voigt(Components=None,SourceTables=None,partitionFunct
         HITRAN_units:  use cm2/molecule (True) or cm-1 (False) for absorption coefficient
         File:   write output to file (if specified)
         Format:  c-format of file output (accounts for significant digits in WavenumberStep)
+        WingTolerance:  relative tolerance of the line wings calculated on the coarse grid 
+                        (adaptive mode for the uniform grids, None means exact calculation)
+        RelativeIntensityThreshold:  threshold for intensities relative to the strongest line
     OUTPUT PARAMETERS: 
         Wavenum: wavenumber grid with respect to parameters WavenumberRange and WavenumberStep
         Xsect: absorption coefficient calculated on the grid
@@ -470,6 +476,9 @@ def absorptionCoefficient_Voigt(Components=None,SourceTables=None,partitionFunct
     if WavenumberWing is not None:   OmegaWing=WavenumberWing
     if WavenumberWingHW is not None: OmegaWingHW=WavenumberWingHW
     if WavenumberGrid is not None:   OmegaGrid=WavenumberGrid
+    
+    # Take the range from the grid to avoid scanning the line centers in Python.
+    if OmegaRange is None and OmegaGrid is not None: OmegaRange=(OmegaGrid[0],OmegaGrid[-1])
 
     # "bug" with 1-element list
     Components = listOfTuples(Components)
@@ -545,7 +554,11 @@ def absorptionCoefficient_Voigt(Components=None,SourceTables=None,partitionFunct
         profile=1,
         test=False,
         NCORES=NCORES,
-        atomicadd=atomicadd
+        IntensityThreshold=IntensityThreshold,
+        RelativeIntensityThreshold=RelativeIntensityThreshold,
+        atomicadd=atomicadd,
+        reduction=reduction,
+        WingTolerance=WingTolerance
     )
                  
     #print('  ~~ %f seconds elapsed for calc'%(time()-t))
@@ -556,6 +569,88 @@ def absorptionCoefficient_Voigt(Components=None,SourceTables=None,partitionFunct
 def absorptionCoefficient_Generic(profile,calcpars,*args,**kwargs):
     return absorptionCoefficient_Voigt(*args,**kwargs)
 
+def absorptionCoefficient_Multi(profile,calcpars,SourceTables=None,partitionFunction=PYTIPS,
+                                Environments=None,Diluents=None,
+                                WavenumberGrid=None,WavenumberWing=None,
+                                WavenumberWingHW=None,TDoppler=None,
+                                OmegaGrid=None,OmegaWing=None,OmegaWingHW=DefaultOmegaWingHW,
+                                layout=None,**kwargs):
+    """
+    Calculate the Voigt absorption coefficient of one table for multiple layers at once.
+    The line parameters are read once, all layers are calculated in one kernel launch.
+    INPUT PARAMETERS: 
+        SourceTables:  table name (the only one)
+        Environments:  list of the per-layer dictionaries {'T':...,'p':...}
+        Diluents:  list of the per-layer Diluent dictionaries, or one for all layers
+        WavenumberGrid, WavenumberWing, WavenumberWingHW, TDoppler:  see absorptionCoefficient_Voigt
+        layout:  parallel layout of the kernel ('auto','layers','lines')
+    Other parameters of absorptionCoefficient_Voigt are accepted and ignored.
+    OUTPUT PARAMETERS: 
+        Wavenum: wavenumber grid
+        Xsect: absorption coefficients, 2D array [len(Environments),len(Wavenum)]
+    """
+    if WavenumberWing is not None:   OmegaWing=WavenumberWing
+    if WavenumberWingHW is not None: OmegaWingHW=WavenumberWingHW
+    if WavenumberGrid is not None:   OmegaGrid=WavenumberGrid
+    SourceTables = listOfTuples(SourceTables)
+    if len(SourceTables)>1: raise NotImplementedError('handling more than one table is not implemented for the Numba version')
+    if Diluents is None: Diluents = {'air':1.}
+    if type(Diluents) is dict: Diluents = [Diluents]*len(Environments)
+    TABLE_NAME = SourceTables[0]
+    MOLEC_ID,LOCAL_ISO_ID = h.getColumns(TABLE_NAME,['molec_id','local_iso_id'])
+    NLINES = len(MOLEC_ID)
+    ISOS = GET_ISOS_DEFAULT_ABUN(NLINES,MOLEC_ID,LOCAL_ISO_ID)
+    return ABSCOEF_FAST_MULTI(NLINES,TABLE_NAME,ISOS,[list(Diluent.items()) for Diluent in Diluents],
+        Omegas=np.asarray(OmegaGrid,dtype=np.float64),
+        OmegaWing=OmegaWing or 0.0,OmegaWingHW=OmegaWingHW,
+        TS=[Environment['T'] for Environment in Environments],Tref=296.0,
+        TDopplers=None if TDoppler is None else [TDoppler]*len(Environments),
+        PS=[Environment['p'] for Environment in Environments],pref=1.0,
+        partsum=partitionFunction,profile=1,layout=layout)
+
+def warmup():
+    """
+    Compile the kernels ahead of time by calculating the small synthetic linelist
+    with all profiles, reduction strategies, and grid types.
+    If SETTINGS['numba_cache'] is on, the compiled kernels are saved to disk
+    and loaded by the next processes instead of compiling.
+    Returns the elapsed time.
+    """
+    t = time()
+    TABLE_NAME = '~warmup'
+    h.LOCAL_TABLE_CACHE[TABLE_NAME] = {'header':h.HITRAN_DEFAULT_HEADER,'data':{
+        'molec_id':np.array([2,2],dtype=np.int64),
+        'local_iso_id':np.array([1,2],dtype=np.int64),
+        'nu':np.array([2000.0,2000.5]),
+        'sw':np.array([1e-20,1e-21]),
+        'elower':np.array([100.0,200.0]),
+        'gamma_air':np.array([0.07,0.07]),
+        'gamma_self':np.array([0.09,0.09]),
+        'n_air':np.array([0.7,0.7]),
+        'delta_air':np.array([-0.001,-0.001]),
+    }}
+    Diluent = {'air':0.9,'self':0.1}
+    GRID_UNIFORM = arange_(1999.,2002.,0.01)
+    GRID_NONUNIFORM = np.concatenate((GRID_UNIFORM[:150],GRID_UNIFORM[150::2]))
+    try:
+        for Grid in (GRID_UNIFORM,GRID_NONUNIFORM):
+            for reduction in ('atomic','private','tiled'):
+                absorptionCoefficient_Voigt(SourceTables=TABLE_NAME,WavenumberGrid=Grid,
+                    Diluent=Diluent,reduction=reduction)
+            absorptionCoefficient_Voigt(SourceTables=TABLE_NAME,WavenumberGrid=Grid,
+                Diluent=Diluent,atomicadd=False)
+            absorptionCoefficient_Multi(1,None,SourceTables=TABLE_NAME,WavenumberGrid=Grid,
+                Environments=[{'T':296.,'p':1.},{'T':250.,'p':0.1}],Diluents=Diluent)
+        absorptionCoefficient_Voigt(SourceTables=TABLE_NAME,WavenumberGrid=GRID_UNIFORM,
+            Diluent=Diluent,WingTolerance=1e-3)
+        absorptionCoefficient_Lorentz(SourceTables=TABLE_NAME,WavenumberGrid=GRID_UNIFORM,Diluent=Diluent)
+        absorptionCoefficient_Doppler(SourceTables=TABLE_NAME,WavenumberGrid=GRID_UNIFORM,Diluent=Diluent)
+    finally:
+        del h.LOCAL_TABLE_CACHE[TABLE_NAME]
+    elapsed_time = time()-t
+    print('Numba kernels are compiled in %f sec. (cache: %s)'%(elapsed_time,CACHE))
+    return elapsed_time
+
 #========================================================================
 # INTERFACE FOR BACKWARDS COMPATIBILITY WITH HAPI v1.0 (LORENTZ PROFILE)
 #========================================================================
@@ -626,6 +721,9 @@ def absorptionCoefficient_Lorentz(Components=None,SourceTables=None,partitionFun
     if WavenumberWing is not None:   OmegaWing=WavenumberWing
     if WavenumberWingHW is not None: OmegaWingHW=WavenumberWingHW
     if WavenumberGrid is not None:   OmegaGrid=WavenumberGrid
+    
+    # Take the range from the grid to avoid scanning the line centers in Python.
+    if OmegaRange is None and OmegaGrid is not None: OmegaRange=(OmegaGrid[0],OmegaGrid[-1])
 
     # "bug" with 1-element list
     Components = listOfTuples(Components)
@@ -683,7 +781,8 @@ def absorptionCoefficient_Lorentz(Components=None,SourceTables=None,partitionFun
                  partsum=partitionFunction,
                  profile=2,
                  test=False,
-                 NCORES=NCORES)
+                 NCORES=NCORES,
+                 IntensityThreshold=IntensityThreshold)
                  
     #print('  ~~ %f seconds elapsed for calc'%(time()-t))
 
@@ -759,6 +858,9 @@ def absorptionCoefficient_Doppler(Components=None,SourceTables=None,partitionFun
     if WavenumberWing is not None:   OmegaWing=WavenumberWing
     if WavenumberWingHW is not None: OmegaWingHW=WavenumberWingHW
     if WavenumberGrid is not None:   OmegaGrid=WavenumberGrid
+    
+    # Take the range from the grid to avoid scanning the line centers in Python.
+    if OmegaRange is None and OmegaGrid is not None: OmegaRange=(OmegaGrid[0],OmegaGrid[-1])
 
     # "bug" with 1-element list
     Components = listOfTuples(Components)
@@ -816,7 +918,8 @@ def absorptionCoefficient_Doppler(Components=None,SourceTables=None,partitionFun
                  partsum=partitionFunction,
                  profile=3,
                  test=False,
-                 NCORES=NCORES)
+                 NCORES=NCORES,
+                 IntensityThreshold=IntensityThreshold)
                  
     #print('  ~~ %f seconds elapsed for calc'%(time()-t))
 
@@ -844,18 +947,92 @@ def absorptionCoefficient_Doppler(Components=None,SourceTables=None,partitionFun
 #        
 #    return CALC_(DATA,NLINES,OmegaRange,OmegaStep,OmegaWing,OmegaWingHW,reflect)
      
+def get_column_(TABLE_NAME,parname,fill_value):
+    """
+    Get the column from the HAPI table cache as the plain Numpy array 
+    accepted by Numba. The masked values are replaced with fill_value,
+    the memory-mapped columns (see columns2cache) are not copied.
+    """
+    return np.asarray(np.ma.filled(h.LOCAL_TABLE_CACHE[TABLE_NAME]['data'][parname],fill_value))
+
+def ENV_DEPENDENCE_LINES(NLINES,TABLE_NAME,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,
+                         ISOS,DILUENT,T,Tref,TDoppler,p,pref,partsum,get_column=get_column_):
+    """
+    Get the line parameters at the given conditions: 
+    intensities, Doppler and Lorentz widths, and shifts.
+    Broadening columns are taken with get_column(TABLE_NAME,parname,fill_value).
+    """
+    # Calculate additional parameters in ISO_INDEX: abundances (depend on isotopic constitution)
+    # and partition sums (depend on PS routine, reference temperatures and current mixture temperature)
+    ISO_INDEX = ISO_INDEX_DEFAULT.copy() # copy iso index in order to avoid side effects
+    ENV_DEPENDENCE_ISO_INDEX(ISO_INDEX,ISOS,T,Tref,partsum) # go through ISO_INDEX  and change partition sums and current abundances
+    
+    # Get intensities and account for T-dependences and isotopic abundances    
+    SW = ENV_DEPENDENCE_SW(NLINES,SW,T,Tref,ELOWER,NU,ISOS,MOLEC_ID,LOCAL_ISO_ID,ISO_INDEX,MOL_INDEX)
+    
+    # Calculate Doppler broadening
+    if TDoppler:
+        TDoppler = np.float64(TDoppler)
+        GAMMA_D = calculate_GammaD(NLINES,TDoppler,NU,MOLEC_ID,LOCAL_ISO_ID,ISO_INDEX,MOL_INDEX)
+    else:
+        GAMMA_D = calculate_GammaD(NLINES,T,NU,MOLEC_ID,LOCAL_ISO_ID,ISO_INDEX,MOL_INDEX)
+    
+    # Get Lorentzian broadening parameters and account for their T- and p-dependences
+    GAMMA_L = np.zeros(NLINES)
+    for broadener,fraction in DILUENT:
+        
+        GAMMA_BR = get_column(TABLE_NAME,'gamma_%s'%broadener,np.nan)
+        if broadener=='self': # !!! THIS SHOULD BE REDONE !!!
+            N_BR = get_column(TABLE_NAME,'n_air',np.nan)
+        else:
+            N_BR = get_column(TABLE_NAME,'n_%s'%broadener.lower(),np.nan)
+        GAMMA_BR = ENV_DEPENDENCE_GAMMA0(NLINES,GAMMA_BR,T,Tref,p,pref,N_BR)
+        GAMMA_L += GAMMA_BR*fraction
+
+    # Get shifting parameters and account for their T- and p-dependences
+    DELTA = np.zeros(NLINES)
+    for broadener,fraction in DILUENT:
+        if broadener=='self': # !!! THIS SHOULD BE REDONE !!!
+            DELTA_BR = np.zeros(NLINES)
+        else:
+            DELTA_BR = get_column(TABLE_NAME,'delta_%s'%broadener,np.nan)
+        DELTA_BR = ENV_DEPENDENCE_DELTA0(NLINES,DELTA_BR,p,pref)
+        DELTA += DELTA_BR*fraction
+        
+    return SW,GAMMA_D,GAMMA_L,DELTA
+
+def PREFILTER_LINES(Omegas,NU,SW,GAMMA_L,GAMMA_D,OmegaWing,OmegaWingHW,
+                    IntensityThreshold=0.0,RelativeIntensityThreshold=None):
+    """
+    Get the indexes of the lines which contribute to the grid: 
+    the center extended by the line wing (same as in the kernel bounds) 
+    overlaps the grid, and the intensity is not less than IntensityThreshold
+    and RelativeIntensityThreshold*(maximal intensity of these lines).
+    """
+    WING = np.maximum(OmegaWing,OmegaWingHW*np.maximum(GAMMA_L,GAMMA_D))
+    MASK = (NU+WING>=Omegas[0])&(NU-WING<=Omegas[-1])
+    if IntensityThreshold:
+        MASK &= SW>=IntensityThreshold
+    if RelativeIntensityThreshold and MASK.any():
+        MASK &= SW>=RelativeIntensityThreshold*SW[MASK].max()
+    return np.flatnonzero(MASK)
+
 # NEW VERSION
 #@jit  # ENABLING JIT MAKES ALL CODE RUN ~TWO TIMES SLOWER!!!
 def ABSCOEF_FAST(NLINES,TABLE_NAME,ISOS,DILUENT,
                  Omegas,
-                 OmegaWing=None,OmegaWingHW=None,reflect=True,
+                 OmegaWing=None,OmegaWingHW=None,reflect=False,
                  T=296.0,Tref=296.0, TDoppler=None,
                  p=1.0,pref=1.0,
                  partsum=h.PYTIPS,
                  profile=1,
                  test=False,
                  NCORES=1,
-                 atomicadd=True
+                 atomicadd=True,
+                 reduction=None,
+                 WingTolerance=None,
+                 IntensityThreshold=0.0,
+                 RelativeIntensityThreshold=None
                  ):
     """
     ==================
@@ -868,6 +1045,15 @@ def ABSCOEF_FAST(NLINES,TABLE_NAME,ISOS,DILUENT,
           Isotopologues not mentioned in ISOS will be ignored!!!
     DILUENT: List of tuples containing broadening agents:
              E.g.: [('air',0.3),('self',0.7)]
+    reflect: calculate the half of each line profile and mirror it to the other half
+             (approximate, supported only by CALC_ and CALCat_, see CALC_REDUCE_).
+             Default is False: the full profiles are calculated 
+             (the default was True before the reduction kernels were added).
+    WingTolerance: relative tolerance of the line wings interpolated 
+             from the coarse grid (see CALCad_); None means exact calculation
+    IntensityThreshold, RelativeIntensityThreshold: 
+             absolute and relative (to the strongest line) thresholds 
+             for the intensities at the current conditions (see PREFILTER_LINES)
     """
         
     # Do some type conversions for safety reasons (except for the arrays from HAPI)
@@ -889,53 +1075,29 @@ def ABSCOEF_FAST(NLINES,TABLE_NAME,ISOS,DILUENT,
         
     # ATTENTION!!! 
     # Current "long-term" version of HAPI used masked arrays
-    # which are not supported by Numba.
+    # which are not supported by Numba (see get_column_).
         
     # Get molecule and isotopologue local HITRAN ids
-    MOLEC_ID = h.LOCAL_TABLE_CACHE[TABLE_NAME]['data']['molec_id'].filled(-1)
-    LOCAL_ISO_ID = h.LOCAL_TABLE_CACHE[TABLE_NAME]['data']['local_iso_id'].filled(-1)
+    MOLEC_ID = get_column_(TABLE_NAME,'molec_id',-1)
+    LOCAL_ISO_ID = get_column_(TABLE_NAME,'local_iso_id',-1)
         
     # Get centers, intensities, and lower states
-    NU = h.LOCAL_TABLE_CACHE[TABLE_NAME]['data']['nu'].filled(np.nan)
-    SW = h.LOCAL_TABLE_CACHE[TABLE_NAME]['data']['sw'].filled(np.nan)
-    ELOWER = h.LOCAL_TABLE_CACHE[TABLE_NAME]['data']['elower'].filled(np.nan)
+    NU = get_column_(TABLE_NAME,'nu',np.nan)
+    SW = get_column_(TABLE_NAME,'sw',np.nan)
+    ELOWER = get_column_(TABLE_NAME,'elower',np.nan)
 
-    # Calculate additional parameters in ISO_INDEX: abundances (depend on isotopic constitution)
-    # and partition sums (depend on PS routine, reference temperatures and current mixture temperature)
-    ISO_INDEX = ISO_INDEX_DEFAULT.copy() # copy iso index in order to avoid side effects
-    ENV_DEPENDENCE_ISO_INDEX(ISO_INDEX,ISOS,T,Tref,partsum) # go through ISO_INDEX  and change partition sums and current abundances
+    # Get intensities, broadening and shifting parameters at the current conditions
+    SW,GAMMA_D,GAMMA_L,DELTA = ENV_DEPENDENCE_LINES(NLINES,TABLE_NAME,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,
+        ISOS,DILUENT,T,Tref,TDoppler,p,pref,partsum)
     
-    # Get intensities and account for T-dependences and isotopic abundances    
-    SW = ENV_DEPENDENCE_SW(NLINES,SW,T,Tref,ELOWER,NU,ISOS,MOLEC_ID,LOCAL_ISO_ID,ISO_INDEX,MOL_INDEX)
-    
-    # Calculate Doppler broadening
-    if TDoppler:
-        TDoppler = np.float64(TDoppler)
-        GAMMA_D = calculate_GammaD(NLINES,TDoppler,NU,MOLEC_ID,LOCAL_ISO_ID,ISO_INDEX,MOL_INDEX)
-    else:
-        GAMMA_D = calculate_GammaD(NLINES,T,NU,MOLEC_ID,LOCAL_ISO_ID,ISO_INDEX,MOL_INDEX)
-    
-    # Get Lorentzian broadening parameters and account for their T- and p-dependences
-    GAMMA_L = np.zeros(NLINES)
-    for broadener,fraction in DILUENT:
-        
-        GAMMA_BR = h.LOCAL_TABLE_CACHE[TABLE_NAME]['data']['gamma_%s'%broadener].filled(np.nan)
-        if broadener=='self': # !!! THIS SHOULD BE REDONE !!!
-            N_BR = h.LOCAL_TABLE_CACHE[TABLE_NAME]['data']['n_air'].filled(np.nan)
-        else:
-            N_BR = h.LOCAL_TABLE_CACHE[TABLE_NAME]['data']['n_%s'%broadener.lower()].filled(np.nan)
-        GAMMA_BR = ENV_DEPENDENCE_GAMMA0(NLINES,GAMMA_BR,T,Tref,p,pref,N_BR)
-        GAMMA_L += GAMMA_BR*fraction
-
-    # Get shifting parameters and account for their T- and p-dependences
-    DELTA = np.zeros(NLINES)
-    for broadener,fraction in DILUENT:
-        if broadener=='self': # !!! THIS SHOULD BE REDONE !!!
-            DELTA_BR = np.zeros(NLINES)
-        else:
-            DELTA_BR = h.LOCAL_TABLE_CACHE[TABLE_NAME]['data']['delta_%s'%broadener].filled(np.nan)
-        DELTA_BR = ENV_DEPENDENCE_DELTA0(NLINES,DELTA_BR,p,pref)
-        DELTA += DELTA_BR*fraction
+    # Drop the weak lines and the lines out of the grid before the kernel launch
+    INDEX = PREFILTER_LINES(Omegas,NU,SW,GAMMA_L,GAMMA_D,OmegaWing,OmegaWingHW,
+        IntensityThreshold,RelativeIntensityThreshold)
+    if len(INDEX)<NLINES:
+        print('ABSCOEF_FAST: %d of %d lines are removed by the prefilter'%(NLINES-len(INDEX),NLINES))
+        NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA = [np.ascontiguousarray(ARR[INDEX]) \
+            for ARR in (NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA)]
+        NLINES = np.int64(len(INDEX))
         
     #print('ABSCOEF_FAST: %f sec elapsed for transforming parameters'%(time()-t))
     
@@ -978,8 +1140,8 @@ def ABSCOEF_FAST(NLINES,TABLE_NAME,ISOS,DILUENT,
             Xsect = CALC_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES,
                         OmegaWing,OmegaWingHW,reflect,profile)    
         else:
-            Xsect = CALCat_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES,
-                        OmegaWing,OmegaWingHW,reflect,profile)                
+            Xsect = CALC_REDUCE_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES,
+                        OmegaWing,OmegaWingHW,reflect,profile,reduction,WingTolerance)                
         #Xsect = CALC1_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES,
         #            OmegaWing,OmegaWingHW,reflect,profile)    
         #Xsect = CALC0_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES,
@@ -990,6 +1152,66 @@ def ABSCOEF_FAST(NLINES,TABLE_NAME,ISOS,DILUENT,
     #print('ABSCOEF_FAST: %f sec elapsed for executing CALC_'%(time()-t))
 
     return Omegas,Xsect
+
+def ABSCOEF_FAST_MULTI(NLINES,TABLE_NAME,ISOS,DILUENTS,
+                 Omegas,
+                 OmegaWing=None,OmegaWingHW=None,
+                 TS=[296.0],Tref=296.0,TDopplers=None,
+                 PS=[1.0],pref=1.0,
+                 partsum=h.PYTIPS,
+                 profile=1,
+                 layout=None
+                 ):
+    """
+    Batched version of ABSCOEF_FAST calculating the cross-sections 
+    of the same lines on the same grid for multiple layers.
+    ==================
+    INPUT PARAMETERS:
+    ==================
+    DILUENTS: list of the per-layer DILUENT parameters (see ABSCOEF_FAST)
+    TS,PS: per-layer temperatures and pressures
+    TDopplers: per-layer Doppler temperatures (optional)
+    layout: parallel layout of the kernel (see choose_layout)
+    ==================
+    OUTPUT PARAMETERS:
+    ==================
+    Omegas, Xsect[NLAYERS,len(Omegas)]
+    """
+    NLINES = np.int64(NLINES)
+    OmegaWing = np.float64(OmegaWing)
+    OmegaWingHW = np.float64(OmegaWingHW)
+    NLAYERS = len(TS)
+    if TDopplers is None: TDopplers = [None]*NLAYERS
+    if len(PS)!=NLAYERS or len(DILUENTS)!=NLAYERS or len(TDopplers)!=NLAYERS:
+        raise Exception('numbers of temperatures, pressures and diluents must be equal')
+
+    # Get the columns from the cache only once for all layers
+    COLUMNS = {}
+    def get_column(TABLE_NAME,parname,fill_value):
+        if parname not in COLUMNS:
+            COLUMNS[parname] = get_column_(TABLE_NAME,parname,fill_value)
+        return COLUMNS[parname]
+    
+    MOLEC_ID = get_column(TABLE_NAME,'molec_id',-1)
+    LOCAL_ISO_ID = get_column(TABLE_NAME,'local_iso_id',-1)
+    NU = get_column(TABLE_NAME,'nu',np.nan)
+    SW = get_column(TABLE_NAME,'sw',np.nan)
+    ELOWER = get_column(TABLE_NAME,'elower',np.nan)
+
+    SW2 = np.empty((NLAYERS,NLINES))
+    GAMMA_D2 = np.empty((NLAYERS,NLINES))
+    GAMMA_L2 = np.empty((NLAYERS,NLINES))
+    DELTA2 = np.empty((NLAYERS,NLINES))
+    for i in range(NLAYERS):
+        SW2[i],GAMMA_D2[i],GAMMA_L2[i],DELTA2[i] = ENV_DEPENDENCE_LINES(NLINES,TABLE_NAME,
+            NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,ISOS,list(DILUENTS[i]),
+            np.float64(TS[i]),Tref,TDopplers[i],np.float64(PS[i]),pref,partsum,get_column)
+
+    NCHUNKS = choose_layout(NLAYERS,numba.get_num_threads(),layout)
+    Xsect = CALCml_(Omegas,NU,SW2,GAMMA_L2,GAMMA_D2,DELTA2,NLINES,
+        OmegaWing,OmegaWingHW,profile,is_uniform_grid(Omegas),NCHUNKS)
+
+    return Omegas,Xsect
     
 # PROBLEMS WITH THE "EXPERIMENTAL" PARALLEL=TRUE FEATURE
 # https://github.com/numba/numba/issues/2804
@@ -1009,7 +1231,7 @@ def ABSCOEF_FAST(NLINES,TABLE_NAME,ISOS,DILUENT,
        numba.float64[:],numba.float64[:],numba.float64[:],numba.int64,
 #        OmegaWing    OmegaWingHW    reflect       profile=1
        numba.float64,numba.float64,numba.boolean,numba.int64)],
-       parallel=PARALLEL,fastmath=FASTMATH)
+       parallel=PARALLEL,fastmath=FASTMATH,cache=CACHE)
 def CALC_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES,
           OmegaWing=None,OmegaWingHW=None,reflect=True,profile=1):
     # THIS FUNCTION SUFFERS FROM THE PARALLELIZATION BUG IN NUMBA 
@@ -1084,7 +1306,7 @@ def CALC_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES
        numba.float64[:],numba.float64[:],numba.float64[:],numba.int64,
 #        OmegaWing    OmegaWingHW    reflect       profile=1
        numba.float64,numba.float64,numba.boolean,numba.int64)],
-       parallel=PARALLEL,fastmath=FASTMATH)
+       parallel=PARALLEL,fastmath=FASTMATH,cache=CACHE)
 def CALCat_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES,
           OmegaWing=None,OmegaWingHW=None,reflect=True,profile=1):
     # THIS FUNCTION SUFFERS FROM THE PARALLELIZATION BUG IN NUMBA 
@@ -1154,6 +1376,382 @@ def CALCat_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLIN
         
     return Xsect
 
+@njit(fastmath=FASTMATH,cache=CACHE)
+def line_profile_value(profile,LineCenterDB,GammaD,Gamma0,Shift0,omega):
+    """
+    Scalar value of the line shape (1 - Voigt, 2 - Lorentz, 3 - Doppler).
+    """
+    if profile==1:
+        return pcqsdhc_new(LineCenterDB,GammaD,Gamma0,0.0,Shift0,0.0,0.0,0.0,omega)[0]
+    elif profile==2:
+        return PROFILE_LORENTZ(LineCenterDB+Shift0,Gamma0,omega)
+    elif profile==3:
+        return PROFILE_DOPPLER(LineCenterDB,GammaD,omega)
+    return 0.0
+
+UNIFORM_GRID_TOLERANCE = 1e-6 # maximum deviation of the grid nodes from the uniform ones (in steps)
+
+@njit(cache=CACHE)
+def is_uniform_grid(Omegas):
+    """
+    Check if the grid is uniform (e.g. produced by arange_).
+    """
+    n = len(Omegas)
+    if n<2: return False
+    step = (Omegas[n-1]-Omegas[0])/(n-1)
+    if step<=0: return False
+    for i in range(n):
+        if np.abs(Omegas[i]-Omegas[0]-i*step)>UNIFORM_GRID_TOLERANCE*step:
+            return False
+    return True
+
+@njit(cache=CACHE)
+def uniform_grid_index(Omega0,OmegaStep,npnts,omega):
+    """
+    Number of the nodes of the uniform grid which are not greater than omega,
+    i.e. the O(1) equivalent of np.searchsorted(Omegas,omega,side='right').
+    """
+    index = np.floor((omega-Omega0)/OmegaStep)+1
+    if index<0: return 0
+    if index>npnts: return npnts
+    return np.int64(index)
+
+# Version of CALCat_ for the uniform grids: the index bounds of the lines are calculated
+# arithmetically, the line shapes are added directly to the output 
+# without the per-line arrays. The full profile is calculated (no reflect option).
+@njit([numba.float64[:](numba.float64[:],numba.float64[:],numba.float64[:],
+#        ELOWER           MOLEC_ID       LOCAL_ISO_ID
+       numba.float64[:],numba.int64[:],numba.int64[:],
+#        GAMMA_L          GAMMA_D          DELTA             NLINES   
+       numba.float64[:],numba.float64[:],numba.float64[:],numba.int64,
+#        OmegaWing    OmegaWingHW    profile=1
+       numba.float64,numba.float64,numba.int64)],
+       parallel=PARALLEL,fastmath=FASTMATH,cache=CACHE)
+def CALCu_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES,
+          OmegaWing=None,OmegaWingHW=None,profile=1):
+    
+    # PROFILES: 1 - Voigt, 2 - Lorentz, 3 - Doppler
+
+    number_of_points = len(Omegas)
+    Xsect = np.zeros(number_of_points,dtype=np.float64)
+    
+    Omega0 = Omegas[0]
+    OmegaStep = (Omegas[number_of_points-1]-Omegas[0])/(number_of_points-1)
+    
+    for RowID in prange(NLINES):
+        
+        LineCenterDB = NU[RowID]
+        LineIntensity = SW[RowID]
+        Gamma0 = GAMMA_L[RowID]
+        GammaD = GAMMA_D[RowID]
+        Shift0 = DELTA[RowID]
+        
+        # get final wing of the line according to Gamma0, OmegaWingHW and OmegaWing
+        OmegaWingF = max(OmegaWing,OmegaWingHW*Gamma0,OmegaWingHW*GammaD)
+        
+        # the lines out of the grid have the empty index range (see line_index_bounds)
+        BoundIndexLower = uniform_grid_index(Omega0,OmegaStep,number_of_points,LineCenterDB-OmegaWingF)
+        BoundIndexUpper = uniform_grid_index(Omega0,OmegaStep,number_of_points,LineCenterDB+OmegaWingF)
+        
+        for i in range(BoundIndexLower,BoundIndexUpper):
+            lineshape_val = line_profile_value(profile,LineCenterDB,GammaD,Gamma0,Shift0,Omegas[i])
+            atomic_add(Xsect,i,LineIntensity*lineshape_val)
+        
+    return Xsect
+
+@njit(fastmath=FASTMATH,cache=CACHE)
+def line_index_bounds(Omegas,uniform,Omega0,OmegaStep,LineCenterDB,OmegaWingF):
+    """
+    Get the grid index range [lower,upper) of the line (empty if the line is out of grid).
+    Unlike CALC_ and CALCat_, the lines are not pruned by the shifted centers, 
+    so the contribution of the line to the grid node does not depend on the grid ends
+    (the lines out of the grid are dropped beforehand, see PREFILTER_LINES).
+    """
+    number_of_points = len(Omegas)
+    if uniform:
+        return uniform_grid_index(Omega0,OmegaStep,number_of_points,LineCenterDB-OmegaWingF),\
+               uniform_grid_index(Omega0,OmegaStep,number_of_points,LineCenterDB+OmegaWingF)
+    return np.searchsorted(Omegas,LineCenterDB-OmegaWingF,side='right'),\
+           np.searchsorted(Omegas,LineCenterDB+OmegaWingF,side='right')
+
+# Reduction with the private output buffers: the lines are split between NTHREADS 
+# contiguous chunks, each chunk is accumulated in its own copy of the output 
+# (no atomics and no false sharing), the copies are summed in the end.
+@njit(parallel=PARALLEL,fastmath=FASTMATH,cache=CACHE)
+def CALCpriv_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES,
+          OmegaWing,OmegaWingHW,profile,uniform,NTHREADS):
+    
+    number_of_points = len(Omegas)
+    Omega0 = Omegas[0]
+    OmegaStep = (Omegas[number_of_points-1]-Omegas[0])/max(number_of_points-1,1)
+    XsectPrivate = np.zeros((NTHREADS,number_of_points),dtype=np.float64)
+    chunk = (NLINES+NTHREADS-1)//NTHREADS
+    
+    for ThreadID in prange(NTHREADS):
+        for RowID in range(ThreadID*chunk,min((ThreadID+1)*chunk,NLINES)):
+            LineCenterDB = NU[RowID]
+            Gamma0 = GAMMA_L[RowID]
+            GammaD = GAMMA_D[RowID]
+            Shift0 = DELTA[RowID]
+            OmegaWingF = max(OmegaWing,OmegaWingHW*Gamma0,OmegaWingHW*GammaD)
+            BoundIndexLower,BoundIndexUpper = line_index_bounds(Omegas,uniform,Omega0,OmegaStep,
+                LineCenterDB,OmegaWingF)
+            for i in range(BoundIndexLower,BoundIndexUpper):
+                XsectPrivate[ThreadID,i] += SW[RowID]*\
+                    line_profile_value(profile,LineCenterDB,GammaD,Gamma0,Shift0,Omegas[i])
+    
+    Xsect = np.zeros(number_of_points,dtype=np.float64)
+    for i in prange(number_of_points):
+        total = 0.0
+        for ThreadID in range(NTHREADS):
+            total += XsectPrivate[ThreadID,i]
+        Xsect[i] = total
+        
+    return Xsect
+
+# Reduction with the grid-tiled ownership: the grid is split into tiles,
+# each tile is owned by one thread and accumulates all lines reaching it.
+# The lines are ordered by their lower index bound to find them by the binary search.
+@njit(parallel=PARALLEL,fastmath=FASTMATH,cache=CACHE)
+def CALCtile_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES,
+          OmegaWing,OmegaWingHW,profile,uniform,NTILES):
+    
+    number_of_points = len(Omegas)
+    Omega0 = Omegas[0]
+    OmegaStep = (Omegas[number_of_points-1]-Omegas[0])/max(number_of_points-1,1)
+    Xsect = np.zeros(number_of_points,dtype=np.float64)
+    
+    LOWER = np.zeros(NLINES,dtype=np.int64)
+    UPPER = np.zeros(NLINES,dtype=np.int64)
+    for RowID in prange(NLINES):
+        OmegaWingF = max(OmegaWing,OmegaWingHW*GAMMA_L[RowID],OmegaWingHW*GAMMA_D[RowID])
+        LOWER[RowID],UPPER[RowID] = line_index_bounds(Omegas,uniform,Omega0,OmegaStep,
+            NU[RowID],OmegaWingF)
+    ORDER = np.argsort(LOWER)
+    LOWER_SORTED = LOWER[ORDER]
+    max_width = 0
+    for RowID in range(NLINES):
+        max_width = max(max_width,UPPER[RowID]-LOWER[RowID])
+    
+    tile_size = (number_of_points+NTILES-1)//NTILES
+    for TileID in prange(NTILES):
+        tile_lower = TileID*tile_size
+        tile_upper = min(tile_lower+tile_size,number_of_points)
+        start = np.searchsorted(LOWER_SORTED,tile_lower-max_width,side='left')
+        stop = np.searchsorted(LOWER_SORTED,tile_upper,side='left')
+        for k in range(start,stop):
+            RowID = ORDER[k]
+            lower = max(LOWER[RowID],tile_lower)
+            upper = min(UPPER[RowID],tile_upper)
+            for i in range(lower,upper):
+                Xsect[i] += SW[RowID]*line_profile_value(profile,NU[RowID],GAMMA_D[RowID],
+                    GAMMA_L[RowID],DELTA[RowID],Omegas[i])
+    
+    return Xsect
+
+# Batched kernel for multiple layers: the work is split in NLAYERS*NCHUNKS tasks,
+# each task accumulates a contiguous chunk of lines for one layer in its own buffer.
+# NCHUNKS=1 maps layers to threads, NCHUNKS>1 also splits the lines of each layer.
+@njit(parallel=PARALLEL,fastmath=FASTMATH,cache=CACHE)
+def CALCml_(Omegas,NU,SW2,GAMMA_L2,GAMMA_D2,DELTA2,NLINES,
+          OmegaWing,OmegaWingHW,profile,uniform,NCHUNKS):
+    
+    NLAYERS = SW2.shape[0]
+    number_of_points = len(Omegas)
+    Omega0 = Omegas[0]
+    OmegaStep = (Omegas[number_of_points-1]-Omegas[0])/max(number_of_points-1,1)
+    XsectPrivate = np.zeros((NLAYERS*NCHUNKS,number_of_points),dtype=np.float64)
+    chunk = (NLINES+NCHUNKS-1)//NCHUNKS
+    
+    for TaskID in prange(NLAYERS*NCHUNKS):
+        LayerID = TaskID//NCHUNKS
+        ChunkID = TaskID%NCHUNKS
+        for RowID in range(ChunkID*chunk,min((ChunkID+1)*chunk,NLINES)):
+            LineCenterDB = NU[RowID]
+            Gamma0 = GAMMA_L2[LayerID,RowID]
+            GammaD = GAMMA_D2[LayerID,RowID]
+            Shift0 = DELTA2[LayerID,RowID]
+            OmegaWingF = max(OmegaWing,OmegaWingHW*Gamma0,OmegaWingHW*GammaD)
+            BoundIndexLower,BoundIndexUpper = line_index_bounds(Omegas,uniform,Omega0,OmegaStep,
+                LineCenterDB,OmegaWingF)
+            for i in range(BoundIndexLower,BoundIndexUpper):
+                XsectPrivate[TaskID,i] += SW2[LayerID,RowID]*\
+                    line_profile_value(profile,LineCenterDB,GammaD,Gamma0,Shift0,Omegas[i])
+    
+    if NCHUNKS==1:
+        return XsectPrivate
+    
+    Xsect = np.zeros((NLAYERS,number_of_points),dtype=np.float64)
+    for LayerID in prange(NLAYERS):
+        for ChunkID in range(NCHUNKS):
+            Xsect[LayerID,:] += XsectPrivate[LayerID*NCHUNKS+ChunkID,:]
+        
+    return Xsect
+
+def choose_layout(nlayers,nthreads,layout=None):
+    """
+    Get the number of line chunks per layer for the batched kernel (see settings.LAYOUT):
+        'layers' - one task per layer, 
+        'lines' - each layer is split into nthreads line chunks,
+        'auto' - layers are mapped to threads if there are enough of them,
+                 otherwise the lines are split to occupy all threads.
+    """
+    if layout is None: layout = settings.LAYOUT
+    if layout=='layers': return 1
+    if layout=='lines': return nthreads
+    if layout=='auto': return max(1,-(-nthreads//nlayers))
+    raise Exception('Unknown layout: %s'%layout)
+
+@njit(fastmath=FASTMATH,cache=CACHE)
+def adaptive_coarse_factor(OmegaStep,OmegaWingF,WidthV,WingTolerance):
+    """
+    Get the coarse step (in the fine steps) and the core half-width of the line for the adaptive kernel.
+    The relative error of the linear interpolation of the Lorentzian wing with the step h 
+    at the distance x from the center is 0.75*(h/x)**2, so the core half-width is 
+    h*sqrt(0.75/WingTolerance), and h minimizes the total number of the profile evaluations.
+    """
+    ratio = np.sqrt(0.75/WingTolerance)
+    factor = max(1,np.int64(np.sqrt(OmegaWingF/(OmegaStep*ratio))))
+    CoreHW = max(factor*OmegaStep*ratio,ADAPTIVE_CORE_HW*WidthV)
+    return factor,CoreHW
+
+@njit(fastmath=FASTMATH,cache=CACHE)
+def accumulate_(Xsect,BufferID,i,value,shared):
+    """
+    Add the value to the node i of the output buffer 
+    (atomically if the buffer is shared between the threads).
+    """
+    if shared:
+        atomic_add(Xsect,(BufferID,i),value)
+    else:
+        Xsect[BufferID,i] += value
+
+# Adaptive two-level version of CALCpriv_ for the uniform grids: the line cores 
+# are calculated on the fine grid, the wings are calculated on the coarse nodes 
+# (every factor-th node of the fine grid, see adaptive_coarse_factor) 
+# and interpolated linearly to the fine grid. 
+# If shared is True, the threads accumulate the single output buffer with the atomic additions
+# instead of the per-thread buffers (used when the latter exceed settings.PRIVATE_BUFFER_LIMIT).
+@njit(parallel=PARALLEL,fastmath=FASTMATH,cache=CACHE)
+def CALCad_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES,
+          OmegaWing,OmegaWingHW,profile,NTHREADS,WingTolerance,shared):
+    
+    number_of_points = len(Omegas)
+    Omega0 = Omegas[0]
+    OmegaStep = (Omegas[number_of_points-1]-Omegas[0])/max(number_of_points-1,1)
+    NBUFFERS = 1 if shared else NTHREADS
+    XsectPrivate = np.zeros((NBUFFERS,number_of_points),dtype=np.float64)
+    chunk = (NLINES+NTHREADS-1)//NTHREADS
+    
+    for ThreadID in prange(NTHREADS):
+        BufferID = 0 if shared else np.int64(ThreadID)
+        for RowID in range(ThreadID*chunk,min((ThreadID+1)*chunk,NLINES)):
+            LineCenterDB = NU[RowID]
+            LineIntensity = SW[RowID]
+            Gamma0 = GAMMA_L[RowID]
+            GammaD = GAMMA_D[RowID]
+            Shift0 = DELTA[RowID]
+            OmegaWingF = max(OmegaWing,OmegaWingHW*Gamma0,OmegaWingHW*GammaD)
+            BoundIndexLower,BoundIndexUpper = line_index_bounds(Omegas,True,Omega0,OmegaStep,
+                LineCenterDB,OmegaWingF)
+            if BoundIndexLower>=BoundIndexUpper: continue
+            WidthV = 0.5346*Gamma0+np.sqrt(0.2166*Gamma0**2+GammaD**2) # Olivero approximation
+            factor,CoreHW = adaptive_coarse_factor(OmegaStep,OmegaWingF,WidthV,WingTolerance)
+            if factor==1:
+                CoreIndexLower = BoundIndexLower
+                CoreIndexUpper = BoundIndexUpper
+            else:
+                Center = LineCenterDB+Shift0
+                CoreIndexLower = min(max(uniform_grid_index(Omega0,OmegaStep,number_of_points,Center-CoreHW),
+                    BoundIndexLower),BoundIndexUpper)
+                CoreIndexUpper = min(max(uniform_grid_index(Omega0,OmegaStep,number_of_points,Center+CoreHW),
+                    CoreIndexLower),BoundIndexUpper)
+            # core on the fine grid
+            for i in range(CoreIndexLower,CoreIndexUpper):
+                accumulate_(XsectPrivate,BufferID,i,LineIntensity*\
+                    line_profile_value(profile,LineCenterDB,GammaD,Gamma0,Shift0,Omegas[i]),shared)
+            # left wing: coarse nodes CoreIndexLower-m*factor, m=0,1,...
+            i_right = CoreIndexLower
+            if i_right>BoundIndexLower:
+                value_right = line_profile_value(profile,LineCenterDB,GammaD,Gamma0,Shift0,Omega0+i_right*OmegaStep)
+            while i_right>BoundIndexLower:
+                i_left = i_right-factor
+                value_left = line_profile_value(profile,LineCenterDB,GammaD,Gamma0,Shift0,Omega0+i_left*OmegaStep)
+                for i in range(max(i_left,BoundIndexLower),i_right):
+                    accumulate_(XsectPrivate,BufferID,i,LineIntensity*\
+                        (value_left+(value_right-value_left)*(i-i_left)/factor),shared)
+                i_right = i_left; value_right = value_left
+            # right wing: coarse nodes CoreIndexUpper-1+m*factor, m=0,1,...
+            i_left = CoreIndexUpper-1
+            if i_left<BoundIndexUpper-1:
+                value_left = line_profile_value(profile,LineCenterDB,GammaD,Gamma0,Shift0,Omega0+i_left*OmegaStep)
+            while i_left<BoundIndexUpper-1:
+                i_right = i_left+factor
+                value_right = line_profile_value(profile,LineCenterDB,GammaD,Gamma0,Shift0,Omega0+i_right*OmegaStep)
+                for i in range(i_left+1,min(i_right+1,BoundIndexUpper)):
+                    accumulate_(XsectPrivate,BufferID,i,LineIntensity*\
+                        (value_left+(value_right-value_left)*(i-i_left)/factor),shared)
+                i_left = i_right; value_left = value_right
+    
+    if shared:
+        return XsectPrivate[0]
+    
+    Xsect = np.zeros(number_of_points,dtype=np.float64)
+    for i in prange(number_of_points):
+        total = 0.0
+        for ThreadID in range(NTHREADS):
+            total += XsectPrivate[ThreadID,i]
+        Xsect[i] = total
+        
+    return Xsect
+
+def choose_reduction(number_of_points,nthreads,reduction=None):
+    """
+    Choose the reduction strategy of the parallel kernel (see settings.REDUCTION):
+        'private' - if the per-thread output buffers fit settings.PRIVATE_BUFFER_LIMIT,
+        'tiled' - if the grid has at least settings.TILE_MIN_POINTS points per thread,
+        'atomic' - otherwise (shared output with the atomic additions).
+    """
+    if reduction is None: reduction = settings.REDUCTION
+    if reduction!='auto': return reduction
+    if nthreads*number_of_points*8<=settings.PRIVATE_BUFFER_LIMIT:
+        return 'private'
+    if number_of_points>=settings.TILE_MIN_POINTS*nthreads:
+        return 'tiled'
+    return 'atomic'
+
+def CALC_REDUCE_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES,
+          OmegaWing,OmegaWingHW,reflect,profile,reduction=None,WingTolerance=None):
+    """
+    Run the parallel kernel with the given reduction strategy (default: settings.REDUCTION).
+    If WingTolerance is given and the grid is uniform, the adaptive kernel CALCad_ is used,
+    with the per-thread buffers for the 'private' reduction and the shared atomic buffer otherwise.
+    The half-profile reflection is implemented only in CALCat_, 
+    so reflect=True always selects it (reduction and WingTolerance are ignored).
+    """
+    if reflect:
+        return CALCat_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES,
+            OmegaWing,OmegaWingHW,reflect,profile)
+    nthreads = numba.get_num_threads()
+    uniform = is_uniform_grid(Omegas)
+    reduction = choose_reduction(len(Omegas),nthreads,reduction)
+    if WingTolerance and uniform:
+        return CALCad_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES,
+            OmegaWing,OmegaWingHW,profile,nthreads,np.float64(WingTolerance),reduction!='private')
+    if reduction=='private':
+        return CALCpriv_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES,
+            OmegaWing,OmegaWingHW,profile,uniform,nthreads)
+    elif reduction=='tiled':
+        return CALCtile_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES,
+            OmegaWing,OmegaWingHW,profile,uniform,nthreads*settings.TILES_PER_THREAD)
+    elif reduction=='atomic':
+        if uniform:
+            return CALCu_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES,
+                OmegaWing,OmegaWingHW,profile)
+        return CALCat_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES,
+            OmegaWing,OmegaWingHW,reflect,profile)
+    raise Exception('Unknown reduction: %s'%reduction)
+
 #@njit(parallel=PARALLEL, fastmath=FASTMATH, cache=CACHE)
 @njit([numba.float64[:](numba.float64[:],numba.float64[:],numba.float64[:],
 #        ELOWER           MOLEC_ID       LOCAL_ISO_ID
@@ -1162,7 +1760,7 @@ def CALCat_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLIN
        numba.float64[:],numba.float64[:],numba.float64[:],numba.int64,
 #        OmegaWing    OmegaWingHW    reflect       profile=1
        numba.float64,numba.float64,numba.boolean,numba.int64)],
-       parallel=PARALLEL,fastmath=FASTMATH)
+       parallel=PARALLEL,fastmath=FASTMATH,cache=CACHE)
 def CALC1_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES,
            OmegaWing=None,OmegaWingHW=None,reflect=True,profile=1):
     # PROFILES: 1 - Voigt, 2 - Lorentz, 3 - Doppler
@@ -1215,7 +1813,7 @@ def CALC1_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINE
 
     return Xsect
 
-@njit(parallel=PARALLEL,fastmath=FASTMATH)
+@njit(parallel=PARALLEL,fastmath=FASTMATH,cache=CACHE)
 def CALC0_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES,
           OmegaWing=None,OmegaWingHW=None,reflect=True,profile=1,NCORES=1):
     # THIS VERSION OF CALC USES DIFFERENT PARALLELIZATION SCHEME...
@@ -1332,7 +1930,7 @@ def CALC0_(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINE
 ##       OmegaStep      OmegaWing    OmegaWingHW    reflect       profile=1
 #       numba.float64,numba.float64,numba.float64,numba.boolean,numba.int64)],
 #       parallel=PARALLEL,fastmath=FASTMATH)
-@njit(parallel=PARALLEL,fastmath=FASTMATH)
+@njit(parallel=PARALLEL,fastmath=FASTMATH,cache=CACHE)
 def CALC_test(Omegas,NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,NLINES,
               OmegaRange=None,OmegaStep=None,OmegaWing=None,OmegaWingHW=None,reflect=True,profile=1):
           
@@ -1,2 +1,34 @@
+import os
+import hashlib
+
+from hapi2.config import VARSPACE
+
+import numba
+
 FASTMATH = True
-PARALLEL = True # experimental feature, keep inactive
\ No newline at end of file
+PARALLEL = True # experimental feature, keep inactive
+REDUCTION = 'auto' # accumulation of the line shapes in parallel kernels: 'auto', 'atomic', 'private', or 'tiled'
+PRIVATE_BUFFER_LIMIT = 2**27 # maximum size (bytes) of the per-thread output buffers for 'private' reduction
+TILE_MIN_POINTS = 4096 # minimum number of grid points per thread for 'tiled' reduction
+TILES_PER_THREAD = 8 # number of grid tiles per thread (for load balancing) in 'tiled' reduction
+LAYOUT = 'auto' # parallel layout of the batched multi-layer kernel: 'auto', 'layers', or 'lines'
+ADAPTIVE_CORE_HW = 3.0 # minimum half-width of the line core calculated on the fine grid in the adaptive mode (in Voigt half-widths)
+
+def get_cache_key_():
+    """
+    Hash of the constants compiled into the kernels.
+    """
+    constants = (FASTMATH,PARALLEL,ADAPTIVE_CORE_HW)
+    return hashlib.sha256(repr(constants).encode('utf-8')).hexdigest()[:16]
+
+# On-disk cache of the compiled kernels (see hapi2.opacity.warmup). 
+# Numba invalidates the cache only when the source files of the kernels change, 
+# so the kernels compiled with the other constants of this module are kept in the separate folder
+# (in numba_cache_dir, or in __pycache__ of the kernels by default).
+# The kernels can be imported before hapi2.init, so the config file is read here if needed.
+SETTINGS = VARSPACE['settings']
+CACHE = SETTINGS.get('numba_cache',False)
+if CACHE:
+    numba.config.CACHE_DIR = os.path.join(
+        SETTINGS.get('numba_cache_dir') or os.path.join(os.path.dirname(__file__),'__pycache__'),
+        'kernels-%s'%get_cache_key_())
\ No newline at end of file
@@ -0,0 +1,55 @@
+""" Threaded stages of the producer-consumer pipelines """
+
+import queue
+import threading
+
+class PipelineClosed(Exception):
+    """ Raised in the producer thread when the consumer has stopped. """
+
+END_OF_STAGE = object()
+
+def iter_threaded(produce,maxsize=1,name=None):
+    """
+    Run the producer in the background thread and yield its items
+    through the bounded queue.
+        produce - function produce(emit) calling emit(item) for each item;
+                  emit blocks while the queue is full (backpressure)
+        maxsize - maximum number of the items produced ahead of the consumer
+    Exceptions of the producer are re-raised in the consumer.
+    If the consumer stops early (error or closed generator),
+    emit raises PipelineClosed in the producer, and the thread is joined.
+    """
+    QUEUE = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        while True:
+            if stop.is_set(): raise PipelineClosed()
+            try:
+                QUEUE.put(item,timeout=0.1); return
+            except queue.Full:
+                pass
+
+    def run():
+        try:
+            produce(lambda item: put((item,None)))
+            put((END_OF_STAGE,None))
+        except PipelineClosed:
+            pass
+        except BaseException as e:
+            try:
+                put((None,e))
+            except PipelineClosed:
+                pass
+
+    thread = threading.Thread(target=run,name=name,daemon=True)
+    thread.start()
+    try:
+        while True:
+            item,e = QUEUE.get()
+            if e is not None: raise e
+            if item is END_OF_STAGE: break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
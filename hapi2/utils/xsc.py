@@ -2,6 +2,11 @@ import zlib
 import json
 import pickle
 import struct
+import importlib
+
+import numpy as np
+
+from hapi2.config import SETTINGS
 # ___________________________________
 # COMPRESSION
 
@@ -36,6 +41,85 @@ def unpack_double(buf):
     # 8-byte double
     return struct.unpack('%dd'%(len(buf)/8),buf) 
 
+# ___________________________________
+# ARRAY PACKING
+#
+# Array blob is the header followed by the compressed array buffer:
+#   ARRAY_MAGIC (3 bytes), version (1 byte), compressor (1 byte), 
+#   byte shuffle flag (1 byte), dtype string (4 bytes, e.g. "<f8").
+# Blobs without the header are legacy zlib-compressed native doubles (see pack_double).
+
+ARRAY_MAGIC = b'\xffH2' # 0xff is never the first byte of the zlib stream
+ARRAY_VERSION = 1
+ARRAY_HEADER = struct.Struct('<3sBBB4s')
+ARRAY_COMPRESSORS = ['none','zlib','zstd','lz4'] # index is the compressor id in the header
+
+def get_compressor_module_(compressor):
+    """
+    Import the optional compression package.
+    """
+    module = {'zstd':'zstandard','lz4':'lz4.frame'}[compressor]
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        raise Exception('compressor "%s" needs the %s package to be installed'%(compressor,module))
+
+def compress_(compressor,data):
+    if compressor=='none':
+        return bytes(data)
+    elif compressor=='zlib':
+        return zlib.compress(data)
+    elif compressor=='zstd':
+        return get_compressor_module_(compressor).ZstdCompressor().compress(data)
+    elif compressor=='lz4':
+        return get_compressor_module_(compressor).compress(data)
+    raise Exception('unknown compressor: %s'%compressor)
+
+def decompress_(compressor,data):
+    if compressor=='none':
+        return data
+    elif compressor=='zlib':
+        return zlib.decompress(data)
+    elif compressor=='zstd':
+        return get_compressor_module_(compressor).ZstdDecompressor().decompress(data)
+    elif compressor=='lz4':
+        return get_compressor_module_(compressor).decompress(data)
+    raise Exception('unknown compressor: %s'%compressor)
+
+def pack_array(arr,dtype='<f8',compressor=None,shuffle=None):
+    """
+    Pack the array to the blob.
+        dtype - stored data type
+        compressor - one of ARRAY_COMPRESSORS (default: SETTINGS['blob_compressor'])
+        shuffle - group the bytes of the same significance together, 
+                  which makes the floats compress better (default: SETTINGS['blob_shuffle'])
+    """
+    if compressor is None: compressor = SETTINGS.get('blob_compressor','zlib')
+    if shuffle is None: shuffle = SETTINGS.get('blob_shuffle',True)
+    dtype = np.dtype(dtype)
+    ARR = np.ascontiguousarray(arr,dtype=dtype).ravel()
+    if shuffle:
+        ARR = ARR.view(np.uint8).reshape(-1,dtype.itemsize).T.copy()
+    header = ARRAY_HEADER.pack(ARRAY_MAGIC,ARRAY_VERSION,ARRAY_COMPRESSORS.index(compressor),
+        int(bool(shuffle)),dtype.str.encode('ascii'))
+    return header+compress_(compressor,memoryview(ARR).cast('B'))
+
+def unpack_array(blob):
+    """
+    Unpack the array from the blob made by pack_array, or from the legacy blob.
+    Unshuffled arrays are the read-only views of the decompressed buffer.
+    """
+    if blob[:len(ARRAY_MAGIC)]!=ARRAY_MAGIC:
+        return np.frombuffer(decompress_zlib(blob),dtype=np.float64)
+    _,version,compressor,shuffle,dtype = ARRAY_HEADER.unpack_from(blob)
+    if version>ARRAY_VERSION:
+        raise Exception('array blob version %d is not supported'%version)
+    dtype = np.dtype(dtype.rstrip(b'\x00').decode('ascii'))
+    buf = decompress_(ARRAY_COMPRESSORS[compressor],memoryview(blob)[ARRAY_HEADER.size:])
+    if shuffle:
+        return np.frombuffer(buf,dtype=np.uint8).reshape(dtype.itemsize,-1).T.copy().view(dtype).ravel()
+    return np.frombuffer(buf,dtype=dtype)
+
 # ___________________________________
 # JSON PACKING
     
@@ -2,8 +2,14 @@ import os
 import re
 import sys
 import json
+import time
+import zlib
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from hapi2.config import SETTINGS, VARSPACE
+from hapi2.utils.pipeline import iter_threaded
 db_backend = VARSPACE['db_backend']
 
 #from ..formats import read_xsc
@@ -53,6 +59,68 @@ class Q(object):
         q.string = self.string+'&'+q.string
         return q
             
+DOWNLOAD_CHUNK = 1024 * 1024 # size of the download buffer
+
+def open_url_(url,headers=None,gzip=None,method=None):
+    """
+    Open the URL, asking for the gzip transfer if gzip is set
+    (default: SETTINGS['fetch_gzip']).
+    """
+    # Proxy handling # https://stackoverflow.com/questions/1450132/proxy-with-urllib2
+    if SETTINGS['proxy']:
+        print('Using proxy '+str(SETTINGS['proxy']))
+        proxy = urllib2.ProxyHandler(SETTINGS['proxy'])
+        opener = urllib2.build_opener(proxy)
+        urllib2.install_opener(opener)            
+    headers = dict(headers or {})
+    if gzip is None: gzip = SETTINGS.get('fetch_gzip',True)
+    if gzip:
+        headers['Accept-Encoding'] = 'gzip'
+    return urllib2.urlopen(urllib2.Request(url,headers=headers,method=method))
+
+def download_(req,path,progress=None,chunk_size=DOWNLOAD_CHUNK,append=False,sink=None):
+    """
+    Stream the response to the file as raw bytes through the bounded buffer.
+    The gzip content encoding is decompressed on the fly.
+        progress - callback progress(nbytes,nbytes_total) called after each chunk,
+                   nbytes are the received bytes, nbytes_total is the content length
+                   (None if unknown)
+        append - append to the existing file (e.g. resumed by the Range request)
+        sink - callback sink(data) receiving a copy of each piece of data written to the file
+    Returns the number of the bytes written to the file.
+    """
+    length = req.headers.get('Content-Length')
+    nbytes_total = int(length) if length else None
+    gzipped = req.headers.get('Content-Encoding','').lower()=='gzip'
+    decomp = zlib.decompressobj(16+zlib.MAX_WBITS) if gzipped else None
+    buf = bytearray(chunk_size); view = memoryview(buf)
+    nbytes = 0; nbytes_written = 0
+    if not append and os.path.exists(path):
+        os.remove(path) # the file can be the hard link to the cached one (see DownloadCache)
+    with open(path,'ab' if append else 'wb') as fp:
+        while True:
+            n = req.readinto(buf)
+            if not n: break
+            nbytes += n
+            if decomp is None:
+                nbytes_written += fp.write(view[:n])
+                if sink is not None: sink(bytes(view[:n]))
+            else:
+                data = decomp.decompress(view[:n],chunk_size)
+                while True:
+                    nbytes_written += fp.write(data)
+                    if sink is not None and data: sink(data)
+                    if not decomp.unconsumed_tail: break
+                    data = decomp.decompress(decomp.unconsumed_tail,chunk_size)
+            if progress is not None: progress(nbytes,nbytes_total)
+        if decomp is not None:
+            data = decomp.flush()
+            nbytes_written += fp.write(data)
+            if sink is not None and data: sink(data)
+    if nbytes_total is not None and nbytes!=nbytes_total:
+        raise http.client.IncompleteRead(b'',nbytes_total-nbytes)
+    return nbytes_written
+
 def fetch_header(api_section,query=None,need_headfile=False):
     # check if api key is supplied
     if not SETTINGS['api_key']:
@@ -70,28 +138,15 @@ def fetch_header(api_section,query=None,need_headfile=False):
     # Download data by chunks.
     if SETTINGS['display_fetch_url']: print(url+'\n')
     try:
-        # Proxy handling # https://stackoverflow.com/questions/1450132/proxy-with-urllib2
-        if SETTINGS['proxy']:
-            print('Using proxy '+str(SETTINGS['proxy']))
-            proxy = urllib2.ProxyHandler(SETTINGS['proxy'])
-            opener = urllib2.build_opener(proxy)
-            urllib2.install_opener(opener)            
-        req = urllib2.urlopen(url)
-    except urllib2.HTTPError:
-        raise Exception('Failed to retrieve data for given parameters.')
+        req = open_url_(url)
+    except urllib2.HTTPError as e:
+        raise Exception('Failed to retrieve data for given parameters.') from e
     #except urllib2.URLError:
     #    raise Exception('Cannot connect to %s. Try again or edit host variable.' % SETTINGS['host'])
-    #CHUNK = 64 * 1024
-    CHUNK = 1024 * 1024
     print('BEGIN DOWNLOAD: '+api_section)
     headfile = os.path.join(SETTINGS['tmpdir'],uuid()+'.json')
-    with open_(headfile,'w') as fp:
-       while True:
-          chunk = req.read(CHUNK)
-          if not chunk: break
-          fp.write(chunk.decode('utf-8'))
-          print('  %d bytes written to %s' % (CHUNK,headfile))
-    print('END DOWNLOAD')
+    nbytes = download_(req,headfile)
+    print('END DOWNLOAD: %d bytes written to %s'%(nbytes,headfile))
     with open_(os.path.join(headfile)) as fp:
         HEADER = json.load(fp)
     print('PROCESSED')
@@ -100,44 +155,104 @@ def fetch_header(api_section,query=None,need_headfile=False):
     else:
         return HEADER
 
-def fetch_file(prefix,filename_server,filename_local=None):
-    if filename_local is None: filename_local = filename_server
-    print('\nFile %s is fetched from %s\n'%(filename_server,prefix))
-    url = '{host}/{prefix}/{filename}'.format(
+def get_file_url_(prefix,filename_server):
+    return '{host}/{prefix}/{filename}'.format(
         host=SETTINGS['host'].strip('/'),
         prefix=prefix,filename=filename_server)
+
+def fetch_file(prefix,filename_server,filename_local=None,progress=None):
+    """
+    Download the file from the server to SETTINGS['tmpdir'].
+        progress - callback progress(nbytes,nbytes_total), see download_
+    """
+    if filename_local is None: filename_local = filename_server
+    print('\nFile %s is fetched from %s\n'%(filename_server,prefix))
+    url = get_file_url_(prefix,filename_server)
     # Download data by chunks.
     if SETTINGS['display_fetch_url']: print(url+'\n')
+    print('BEGIN DOWNLOAD: '+filename_server)
+    headfile = os.path.join(SETTINGS['tmpdir'],filename_local)
+    from .cache import get_download_cache
+    cache = get_download_cache()
     try:
-        # Proxy handling # https://stackoverflow.com/questions/1450132/proxy-with-urllib2
-        if SETTINGS['proxy']:
-            print('Using proxy '+str(SETTINGS['proxy']))
-            proxy = urllib2.ProxyHandler(SETTINGS['proxy'])
-            opener = urllib2.build_opener(proxy)
-            urllib2.install_opener(opener)            
-        req = urllib2.urlopen(url)
-    except urllib2.HTTPError:
-        raise Exception('Failed to retrieve data for given parameters.')
+        if cache is not None:
+            nbytes = cache.fetch(url,headfile,progress)
+        else:
+            nbytes = download_(open_url_(url),headfile,progress)
+    except urllib2.HTTPError as e:
+        raise Exception('Failed to retrieve data for given parameters.') from e
     #except urllib2.URLError:
     #    raise Exception('Cannot connect to %s. Try again or edit host variable.' % SETTINGS['host'])
-    #CHUNK = 64 * 1024
-    #CHUNK = 4 * 1024 * 1024
-    CHUNK = 64 * 1024 * 1024
-    print('BEGIN DOWNLOAD: '+filename_server)
-    headfile = os.path.join(SETTINGS['tmpdir'],filename_local)
-    with open_(headfile,'w') as fp:
-       while True:
-          chunk = req.read(CHUNK)
-          if not chunk: break
-          fp.write(chunk.decode('utf-8'))
-          print('  %d bytes written to %s' % (CHUNK,headfile))
-    print('END DOWNLOAD')
+    print('END DOWNLOAD: %d bytes downloaded to %s'%(nbytes,headfile))
     #with open_(os.path.join(headfile)) as fp:
     #    HEADER = json.load(fp)
     print('PROCESSED')
     #return HEADER    
     return headfile
 
+def is_retriable_(e):
+    """
+    Check if the failed download can be retried: 
+    network errors, server-side HTTP errors, and "too many requests".
+    """
+    cause = e.__cause__ if e.__cause__ is not None else e
+    if isinstance(cause,urllib2.HTTPError):
+        return cause.code>=500 or cause.code==429
+    return isinstance(cause,(OSError,http.client.HTTPException))
+
+def fetch_file_retry_(prefix,filename_server,filename_local,semaphore,retries,backoff):
+    for attempt in range(retries+1):
+        try:
+            with semaphore:
+                return fetch_file(prefix,filename_server,filename_local)
+        except Exception as e:
+            if attempt==retries or not is_retriable_(e): raise
+            delay = backoff*2**attempt
+            print('RETRY %s in %.1f sec: %s'%(filename_server,delay,e))
+            time.sleep(delay)
+
+def fetch_files(tasks,workers=None,host_limit=None,retries=None,backoff=None):
+    """
+    Fetch the files concurrently (see fetch_file).
+        tasks - list of (prefix,filename_server) or (prefix,filename_server,filename_local)
+        workers - number of download threads (default: SETTINGS['fetch_workers'])
+        host_limit - maximum number of simultaneous downloads from one host 
+                     (default: SETTINGS['fetch_host_limit'])
+        retries - number of retries of the failed download (default: SETTINGS['fetch_retries'])
+        backoff - delay before the first retry in seconds, doubled for each next retry
+                  (default: SETTINGS['fetch_backoff'])
+    Returns the list of the local file paths in the order of tasks.
+    """
+    if workers is None: workers = SETTINGS.get('fetch_workers',8)
+    if host_limit is None: host_limit = SETTINGS.get('fetch_host_limit',4)
+    if retries is None: retries = SETTINGS.get('fetch_retries',3)
+    if backoff is None: backoff = SETTINGS.get('fetch_backoff',1.0)
+    tasks = [(task+(None,))[:3] for task in map(tuple,tasks)]
+    if not tasks: return []
+    SEMAPHORES = {}
+    for prefix,filename_server,_ in tasks:
+        host = urllib.parse.urlsplit(get_file_url_(prefix,filename_server)).netloc
+        if host not in SEMAPHORES: 
+            SEMAPHORES[host] = threading.BoundedSemaphore(host_limit)
+    PATHS = [None]*len(tasks)
+    nbytes = 0; t = time.time()
+    with ThreadPoolExecutor(max_workers=max(1,min(workers,len(tasks)))) as executor:
+        futures = {}
+        for i,(prefix,filename_server,filename_local) in enumerate(tasks):
+            host = urllib.parse.urlsplit(get_file_url_(prefix,filename_server)).netloc
+            futures[executor.submit(fetch_file_retry_,prefix,filename_server,filename_local,
+                SEMAPHORES[host],retries,backoff)] = i
+        for future in as_completed(futures):
+            try:
+                PATHS[futures[future]] = future.result()
+            except Exception:
+                for future_ in futures: future_.cancel()
+                raise
+            nbytes += os.path.getsize(PATHS[futures[future]])
+            print('FETCHED %d of %d files, %.1f MB in %.1f sec'%\
+                (sum(path is not None for path in PATHS),len(tasks),nbytes/2**20,time.time()-t))
+    return PATHS
+
 def save_hapi_header(HAPI1_HEADER,HEADER_TRANSITIONS):
     tmpdir = SETTINGS['tmpdir']
     llst_name = HEADER_TRANSITIONS['content']['linelist']
@@ -228,8 +343,8 @@ def fetch_cross_section_spectra(xss):
     """
     Fetch actual spectra using the pre-fetched headers.
     """
-    for xs in xss:
-        fetch_file('data/xsec',xs.filename)
+    fetch_files([('data/xsec',filename) for filename in 
+        sorted(set(xs.filename for xs in xss))])
 
     attach_data_to_cross_sections(xss,SETTINGS['tmpdir'])
     # TODO: attach_data back to the updaters.
@@ -302,7 +417,7 @@ def fetch_cia_cross_section_spectra(xss):
     """
     Fetch actual spectra using the pre-fetched headers.
     """
-    FETCHED = set()
+    FETCHED = {}
     for xs in xss:
         if xs.status=='main':
             global_path = 'data/CIA'
@@ -310,10 +425,8 @@ def fetch_cia_cross_section_spectra(xss):
             global_path = 'data/CIA/supplementary'
         else:
             raise Exception('unknown cross-section status: "%s"'%xs.status)
-        filename = xs.filename
-        if filename not in FETCHED:
-            fetch_file(global_path,filename)
-            FETCHED.add(filename)
+        FETCHED.setdefault(xs.filename,global_path)
+    fetch_files([(global_path,filename) for filename,global_path in FETCHED.items()])
 
     attach_data_to_cia_cross_sections(xss,SETTINGS['tmpdir'])
     # TODO: attach_data back to the updaters.
@@ -367,9 +480,11 @@ def fetch_molecule_categories(pattern=None):
     """
     pass
     
-def fetch_transitions(isos,numin,numax,llst_name):
+def fetch_transitions(isos,numin,numax,llst_name,pipelined=None):
     """
     Fetch transitions using isotopologue objects as an input.
+        pipelined - parse and insert the transitions while they are downloaded
+                    (default: SETTINGS['fetch_pipelined']), see fetch_transitions_pipelined_
     """
     if type(isos) not in [list,tuple]:
         isos = [isos]
@@ -404,18 +519,50 @@ def fetch_transitions(isos,numin,numax,llst_name):
     filename = HEADER_TRANSITIONS['content']['data']
     prefix = VARSPACE['server_info']['content']['data']['results_dir']
 
-    fetch_file(prefix,filename,llst_name+'.data')
-    
     # prepare and save HAPI header for transitions.
     HAPI1_HEADER = prepareHeader(parlist=parlist) # add parameter list in later release
     save_hapi_header(HAPI1_HEADER,HEADER_TRANSITIONS)
 
+    if pipelined is None: pipelined = SETTINGS.get('fetch_pipelined',False)
+    if pipelined:
+        return fetch_transitions_pipelined_(HEADER_TRANSITIONS,prefix,filename,llst_name)
+
+    fetch_file(prefix,filename,llst_name+'.data')
+
     # update and commit
     #transs = update_and_commit_transitions_plain_core(HEADER_TRANSITIONS,llst_name)
     transs = db_backend.models.Transition.update(HEADER_TRANSITIONS,local=False,llst_name=llst_name)
         
     return transs
 
+def fetch_transitions_pipelined_(header,prefix,filename_server,llst_name,queue_depth=None):
+    """
+    Download the transitions file and insert the transitions at the same time.
+    The downloader thread writes the file to SETTINGS['tmpdir'] and feeds
+    the bounded queue of the byte chunks, which are parsed to the batches
+    and inserted by Transition.update (see __insert_transitions_pipelined_core__).
+    The total time approaches the slowest of the download, parsing and insertion
+    instead of their sum. The download cache is bypassed.
+        queue_depth - maximum number of chunks downloaded ahead of the parser
+                      (default: SETTINGS['fetch_pipeline_depth'])
+    """
+    if queue_depth is None: queue_depth = SETTINGS.get('fetch_pipeline_depth',16)
+    url = get_file_url_(prefix,filename_server)
+    if SETTINGS['display_fetch_url']: print(url+'\n')
+    print('BEGIN PIPELINED DOWNLOAD: '+filename_server)
+    headfile = os.path.join(SETTINGS['tmpdir'],llst_name+'.data')
+    
+    def download(emit):
+        try:
+            req = open_url_(url)
+        except urllib2.HTTPError as e:
+            raise Exception('Failed to retrieve data for given parameters.') from e
+        nbytes = download_(req,headfile,sink=emit)
+        print('END DOWNLOAD: %d bytes downloaded to %s'%(nbytes,headfile))
+    
+    chunks = iter_threaded(download,queue_depth,name='download-%s'%llst_name)
+    return db_backend.models.Transition.update(header,local=False,llst_name=llst_name,chunks=chunks)
+
 TIPS_LOOKUP_TABLE = {
     '2011': {
         'ISOT_HASH':lambda M,I: hapi.Tdat, 
@@ -0,0 +1,249 @@
+""" Persistent download cache of the web API files """
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import urllib.request as urllib2
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError: # no file locks (Windows): the cache is safe only within one process
+    fcntl = None
+
+from hapi2.config import SETTINGS
+
+from .api import open_url_, download_, DOWNLOAD_CHUNK
+
+CACHE_INDEX = 'index.json'
+
+def get_url_key_(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+@contextmanager
+def file_lock_(path):
+    """
+    Exclusive lock of the file shared by the processes (no-op without fcntl).
+    """
+    with open(path,'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f,fcntl.LOCK_EX)
+        yield
+
+def hash_file_(path,chunk_size=DOWNLOAD_CHUNK):
+    h = hashlib.sha256()
+    with open(path,'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size),b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class DownloadCache:
+    """
+    Persistent cache of the downloaded files.
+    Files are stored by the SHA-256 hash of their content (objects/<hash>),
+    and the index maps the URLs to the objects and the server metadata
+    (ETag, Last-Modified, size).
+    Cached files are revalidated by the conditional requests (304 Not Modified),
+    or by the size from the HEAD request if the server gives no validators.
+    Interrupted downloads are kept in partial/ and resumed with the Range requests.
+    The least recently used objects are evicted when the cache exceeds max_size.
+    The cache folder can be shared by the threads and the processes:
+    the downloads of the same URL are serialized by the per-URL locks, and
+    the index is re-read, updated and saved under the file lock.
+    """
+
+    def __init__(self,dirname,max_size):
+        self.dirname = dirname
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.url_locks = {}
+        os.makedirs(os.path.join(dirname,'objects'),exist_ok=True)
+        os.makedirs(os.path.join(dirname,'partial'),exist_ok=True)
+        self.load_index_()
+
+    def load_index_(self):
+        self.index = {}
+        path = os.path.join(self.dirname,CACHE_INDEX)
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.index = json.load(f)
+
+    @contextmanager
+    def locked_index_(self):
+        """
+        Lock the index for the other threads and processes, re-read it 
+        (merging the updates made by the other processes) and save it after the update.
+        """
+        with self.lock, file_lock_(os.path.join(self.dirname,CACHE_INDEX+'.lock')):
+            self.load_index_()
+            yield
+            self.save_index_()
+
+    @contextmanager
+    def locked_url_(self,url):
+        """
+        Lock the download of the URL for the other threads and processes.
+        """
+        with self.lock:
+            lock = self.url_locks.setdefault(url,threading.Lock())
+        with lock, file_lock_(self.get_partial_path_(url)+'.lock'):
+            yield
+
+    def save_index_(self):
+        path = os.path.join(self.dirname,CACHE_INDEX)
+        with open(path+'.tmp','w') as f:
+            json.dump(self.index,f,indent=1)
+        os.replace(path+'.tmp',path)
+
+    def get_object_path_(self,hashval):
+        return os.path.join(self.dirname,'objects',hashval)
+
+    def get_partial_path_(self,url):
+        return os.path.join(self.dirname,'partial',get_url_key_(url))
+
+    def get_entry_(self,url):
+        entry = self.index.get(url)
+        if entry is not None and not os.path.isfile(self.get_object_path_(entry['hash'])):
+            del self.index[url]
+            entry = None
+        return entry
+
+    def deliver_(self,url,path):
+        """
+        Put the cached file to path (hard link if possible) and mark it as used.
+        """
+        entry = self.index[url]
+        entry['atime'] = time.time()
+        if os.path.exists(path): os.remove(path)
+        try:
+            os.link(self.get_object_path_(entry['hash']),path)
+        except OSError:
+            shutil.copyfile(self.get_object_path_(entry['hash']),path)
+
+    def deliver_valid_(self,url,path,progress):
+        """
+        Deliver the revalidated file, or download it again if the other process has evicted it meanwhile.
+        """
+        with self.locked_index_():
+            if self.get_entry_(url) is not None:
+                self.deliver_(url,path)
+                return 0
+        return self.fetch_(url,path,progress)
+
+    def evict_(self):
+        """
+        Remove the least recently used objects until the cache fits max_size.
+        """
+        OBJECTS = {}
+        for entry in self.index.values():
+            size,atime = OBJECTS.get(entry['hash'],(entry['size'],0))
+            OBJECTS[entry['hash']] = (size,max(atime,entry['atime']))
+        total = sum(size for size,_ in OBJECTS.values())
+        for hashval in sorted(OBJECTS,key=lambda hashval:OBJECTS[hashval][1]):
+            if total<=self.max_size: break
+            print('EVICTED %s from the download cache'%hashval)
+            os.remove(self.get_object_path_(hashval))
+            for url in [url for url,entry in self.index.items() if entry['hash']==hashval]:
+                del self.index[url]
+            total -= OBJECTS[hashval][0]
+
+    def revalidate_(self,url,entry):
+        """
+        Check if the cached file is up to date. Returns (valid,headers for the GET request).
+        """
+        if entry.get('etag'):
+            return False,{'If-None-Match':entry['etag']}
+        if entry.get('last_modified'):
+            return False,{'If-Modified-Since':entry['last_modified']}
+        req = open_url_(url,gzip=False,method='HEAD')
+        length = req.headers.get('Content-Length')
+        req.close()
+        return length is not None and int(length)==entry['size'],{}
+
+    def fetch(self,url,path,progress=None):
+        """
+        Put the file from the URL to path, downloading it only if the cached one is stale.
+            progress - callback progress(nbytes,nbytes_total), see download_
+        Returns the number of the downloaded bytes (0 if the cached file is used).
+        """
+        with self.locked_url_(url):
+            return self.fetch_(url,path,progress)
+
+    def fetch_(self,url,path,progress):
+        with self.locked_index_():
+            entry = self.get_entry_(url)
+        partial = self.get_partial_path_(url)
+        headers = {}; meta = None
+        if entry is not None:
+            valid,headers = self.revalidate_(url,entry)
+            if valid:
+                return self.deliver_valid_(url,path,progress)
+        elif os.path.isfile(partial) and os.path.isfile(partial+'.json'):
+            with open(partial+'.json') as f:
+                meta = json.load(f)
+            validator = meta['etag'] or meta['last_modified']
+            offset = os.path.getsize(partial)
+            if validator and offset>0:
+                headers = {'Range':'bytes=%d-'%offset,'If-Range':validator}
+        try:
+            # Byte ranges of the gzipped content can't be resumed after decompression.
+            req = open_url_(url,headers,gzip=False if 'Range' in headers else None)
+        except urllib2.HTTPError as e:
+            if e.code==416: # the partial file is stale
+                os.remove(partial)
+                return self.fetch_(url,path,progress)
+            if e.code!=304: raise
+            return self.deliver_valid_(url,path,progress)
+        resumed = req.getcode()==206
+        if resumed:
+            if not req.headers.get('Content-Range','').startswith('bytes %d-'%offset):
+                raise Exception('unexpected range of the resumed download: %s'%req.headers.get('Content-Range'))
+            print('RESUMED %s from byte %d'%(url,offset))
+        else:
+            meta = {
+                'etag':req.headers.get('ETag'),
+                'last_modified':req.headers.get('Last-Modified'),
+            }
+            # Only the plain content can be resumed by the byte ranges.
+            if os.path.exists(partial+'.json'): os.remove(partial+'.json')
+            if not req.headers.get('Content-Encoding'):
+                with open(partial+'.json','w') as f:
+                    json.dump(meta,f)
+        nbytes = download_(req,partial,progress,append=resumed)
+        hashval = hash_file_(partial)
+        with self.locked_index_():
+            if os.path.exists(self.get_object_path_(hashval)):
+                os.remove(partial)
+            else:
+                os.replace(partial,self.get_object_path_(hashval))
+            if os.path.exists(partial+'.json'): os.remove(partial+'.json')
+            old_entry = self.index.get(url)
+            self.index[url] = {'hash':hashval,'size':os.path.getsize(self.get_object_path_(hashval)),
+                'etag':meta['etag'],'last_modified':meta['last_modified']}
+            self.deliver_(url,path)
+            # Remove the stale object if no other URL refers to it.
+            if old_entry is not None and old_entry['hash']!=hashval and \
+                    all(entry['hash']!=old_entry['hash'] for entry in self.index.values()):
+                os.remove(self.get_object_path_(old_entry['hash']))
+            self.evict_()
+        return nbytes
+
+CACHES = {}
+CACHES_LOCK = threading.Lock()
+
+def get_download_cache():
+    """
+    Get the download cache of the process (None if SETTINGS['fetch_cache'] is off).
+    """
+    if not SETTINGS.get('fetch_cache',True):
+        return None
+    dirname = SETTINGS.get('fetch_cache_dir') or os.path.join(SETTINGS['tmpdir'],'cache')
+    with CACHES_LOCK:
+        key = os.path.abspath(dirname)
+        if key not in CACHES:
+            CACHES[key] = DownloadCache(dirname,SETTINGS.get('fetch_cache_size',10*2**30))
+        CACHES[key].max_size = SETTINGS.get('fetch_cache_size',10*2**30)
+        return CACHES[key]
@@ -0,0 +1,544 @@
+"""
+Local stand-in of the HITRANonline API for the offline tests and benchmarks.
+Serves the /api/<version>/<api_key>/<section> headers used by fetch_header
+and the data files used by fetch_file, filled with the synthetic molecules,
+isotopologues, sources, cross-sections and transitions.
+
+Usage:
+    python -m hapi2.web.server serve --port 8000
+    python -m hapi2.web.server benchmark --line-density 100 --nruns 3
+The benchmark fills the database of the local configuration (config.json),
+so it should be run in an empty folder.
+"""
+
+import os
+import json
+import time
+import zlib
+import shutil
+import hashlib
+import tempfile
+import argparse
+import threading
+import http.server
+import urllib.parse
+from contextlib import contextmanager
+
+import numpy as np
+
+from hapi2.config import SETTINGS
+from hapi2.collect import uuid
+from hapi2.utils.formula import molweight
+
+API_KEY = 'local'
+RESULTS_DIR = 'results'
+XSEC_DIR = 'data/xsec'
+SEND_CHUNK = 64*1024 # bytes written to the socket at once
+
+# (id, common name, formula), molecules with the line-by-line data
+LBL_MOLECULES = [
+    (1,'Water','H2O'), (2,'Carbon Dioxide','CO2'), (3,'Ozone','O3'),
+    (4,'Nitrous Oxide','N2O'), (5,'Carbon Monoxide','CO'), (6,'Methane','CH4'),
+    (7,'Oxygen','O2'), (8,'Nitric Oxide','NO'), (9,'Sulfur Dioxide','SO2'),
+]
+
+# (id, common name, formula, extra aliases), molecules with the cross-sections
+XSC_MOLECULES = [
+    (1001,'Carbon Tetrachloride','CCl4',['CFC-10']),
+    (1002,'Sulfur Hexafluoride','SF6',[]),
+    (1003,'Trichlorofluoromethane','CCl3F',['CFC-11']),
+]
+
+ISO_CHARS = '1234567890AB' # local isotopologue ids in the par_line
+
+MAX_LINE_DENSITY = 1000 # transitions per cm-1 per isotopologue, bounded by the id layout
+
+PAR_LINE_FORMAT = '%2d%1s%12.6f%10.3E%10.3E%5.3f%5.3f%10.4f%4.2f%8.6f%15s%15s%15s%15s%6s%12s%1s%7.1f%7.1f'
+
+PARLIST = ['par_line','trans_id','global_iso_id']
+
+class SyntheticDatabase:
+    """
+    Deterministic synthetic content of the HITRANonline database.
+        nmolecules - number of the molecules with transitions (at most len(LBL_MOLECULES))
+        nisotopologues - isotopologues per molecule (at most len(ISO_CHARS))
+        nsources - number of the sources
+        ncross_sections - cross-sections per molecule (for len(XSC_MOLECULES) molecules)
+        xsc_npnts - number of points in each cross-section
+        line_density - transitions per cm-1 per isotopologue
+        seed - seed of the random generator
+    The transitions of each isotopologue are generated by 1 cm-1 bins
+    with the bin-specific seeds, so the overlapping requests return the same lines.
+    The ids of the isotopologues and transitions don't depend on the sizes,
+    so the databases of the different sizes can be fetched to the same HAPI2 database.
+    """
+
+    def __init__(self,nmolecules=3,nisotopologues=3,nsources=10,ncross_sections=4,
+            xsc_npnts=10000,line_density=20,seed=0):
+        if nmolecules>len(LBL_MOLECULES):
+            raise Exception('at most %d molecules are supported'%len(LBL_MOLECULES))
+        if nisotopologues>len(ISO_CHARS):
+            raise Exception('at most %d isotopologues are supported'%len(ISO_CHARS))
+        if line_density>MAX_LINE_DENSITY:
+            raise Exception('at most %d lines per cm-1 are supported'%MAX_LINE_DENSITY)
+        self.nmolecules = nmolecules
+        self.nisotopologues = nisotopologues
+        self.ncross_sections = ncross_sections
+        self.xsc_npnts = xsc_npnts
+        self.line_density = line_density
+        self.seed = seed
+        self.molecules = [self.make_molecule_(id,name,formula,[])
+            for id,name,formula in LBL_MOLECULES[:nmolecules]]+\
+            [self.make_molecule_(id,name,formula,aliases)
+            for id,name,formula,aliases in XSC_MOLECULES]
+        self.isotopologues = []
+        for M,(id,_,formula) in enumerate(LBL_MOLECULES[:nmolecules],start=1):
+            for I in range(1,nisotopologues+1):
+                self.isotopologues.append(self.make_isotopologue_(M,I,formula))
+        self.sources = [self.make_source_(i) for i in range(1,nsources+1)]
+        self.cross_sections = []
+        for id,_,formula,_ in XSC_MOLECULES:
+            for i in range(ncross_sections):
+                self.cross_sections.append(self.make_cross_section_(id,formula,i))
+        self.parameter_metas = [
+            {'id':i,'name':name,'type':type_,'description':'synthetic parameter %s'%name,
+                'format':fmt,'units':units}
+            for i,(name,type_,fmt,units) in enumerate([
+                ('par_line','str','%160s',''),('trans_id','int','%12d',''),
+                ('global_iso_id','int','%5d',''),('nu','float','%12.6f','cm-1'),
+                ('sw','float','%10.3E','cm-1/(molec.cm-2)'),('a','float','%10.3E','s-1'),
+                ('gamma_air','float','%5.3f','cm-1.atm-1'),('elower','float','%10.4f','cm-1'),
+            ],start=1)]
+
+    def make_molecule_(self,id,name,formula,aliases):
+        ALIASES = [name,formula]+aliases
+        if id<1000: ALIASES.append('HITRAN-mol-%d'%id)
+        return {'id':id,'common_name':name,'ordinary_formula':formula,
+            'ordinary_formula_html':formula,'stoichiometric_formula':formula,
+            'inchi':'InChI=synthetic/%s'%formula,'inchikey':'SYNTHETIC-%s'%formula,
+            'aliases':[{'alias':alias,'type':'synthetic'} for alias in ALIASES]}
+
+    def get_global_iso_id_(self,M,I):
+        return (M-1)*len(ISO_CHARS)+I
+
+    def make_isotopologue_(self,M,I,formula):
+        id = self.get_global_iso_id_(M,I)
+        return {'id':id,'molecule_alias':formula,'isoid':I,
+            'inchi':'InChI=synthetic/%s/%d'%(formula,I),'inchikey':'SYNTHETIC-%s-%d'%(formula,I),
+            'iso_name':'(%d)%s'%(I,formula),'iso_name_html':'(%d)%s'%(I,formula),
+            'abundance':0.9/I**2,'mass':molweight(formula)+I-1,'afgl_code':'%d'%(100+I),
+            'aliases':[{'alias':'HITRAN-iso-%d'%id,'type':'HITRAN-global-ID'},
+                {'alias':'HITRAN-iso-%d-%d'%(M,I),'type':'HITRAN-local-ID'}]}
+
+    def make_source_(self,i):
+        alias = 'SYNTH-%d'%i
+        return {'id':i,'type':'article','authors':'A. Author, B. Author',
+            'title':'Synthetic source %d'%i,'journal':'J. Synth. Spectrosc.','volume':'%d'%i,
+            'page_start':'1','page_end':'10','year':2000+i%20,'institution':None,'note':None,
+            'doi':'10.0000/synthetic.%d'%i,'bibcode':None,'url':None,'short_alias':alias,
+            'aliases':[{'alias':alias,'type':'short'}]}
+
+    def make_cross_section_(self,mol_id,formula,i):
+        return {'id':mol_id*1000+i,'molecule_alias':formula,
+            'source_alias':self.sources[i%len(self.sources)]['short_alias'] if self.sources else None,
+            'numin':700.0,'numax':1300.0,'npnts':self.xsc_npnts,'sigma_max':1e-18,
+            'temperature':200.0+10*i,'pressure':100.0*(i+1),'resolution':0.01,
+            'resolution_units':'cm-1','broadener':'air','description':'synthetic',
+            'apodization':None,'json':None,'filename':'%s_%d.xsc'%(formula,i),
+            'format':'xsc','status':'main'}
+
+    def get_xsc_file(self,item):
+        """ Make the content of the cross-section file in the HITRAN format. """
+        rnd = np.random.default_rng([self.seed,item['id']])
+        XSC = item['sigma_max']*rnd.random(item['npnts'])
+        lines = ['%20s%10.4f%10.4f%7d%7.1f%6.1f%40s'%(item['molecule_alias'],item['numin'],
+            item['numax'],item['npnts'],item['temperature'],item['pressure'],item['source_alias'])]
+        VALS = XSC.tolist()
+        for i in range(0,len(VALS),10):
+            lines.append(''.join('%10.3E'%val for val in VALS[i:i+10]))
+        return '\n'.join(lines)+'\n'
+
+    def iter_transition_lines(self,iso_ids,numin,numax,block_size=100):
+        """
+        Generate the lines of the transitions .data file (par_line,trans_id,global_iso_id)
+        sorted by the wavenumber, by blocks of block_size cm-1.
+        """
+        ISOS = {iso['id']:iso for iso in self.isotopologues}
+        iso_ids = [id for id in iso_ids if id in ISOS]
+        bin_first = max(int(np.floor(numin)),0); bin_last = int(np.floor(numax))
+        for block_first in range(bin_first,bin_last+1,block_size):
+            NU = []; ROWS = []
+            for id in iso_ids:
+                for b in range(block_first,min(block_first+block_size,bin_last+1)):
+                    rnd = np.random.default_rng([self.seed,id,b])
+                    n = self.line_density
+                    nu = b+np.sort(rnd.random(n))
+                    keep = (nu>=numin)&(nu<=numax)
+                    if not np.any(keep): continue
+                    M = (id-1)//len(ISO_CHARS)+1
+                    I = ISOS[id]['isoid']
+                    VALS = [
+                        10.0**rnd.uniform(-30,-19,n),rnd.uniform(0,100,n),rnd.uniform(0,0.2,n),
+                        rnd.uniform(0,0.5,n),rnd.uniform(0,9000,n),rnd.uniform(0,1,n),
+                        rnd.uniform(0,0.009,n),rnd.integers(1,99,n),rnd.integers(1,99,n),
+                    ]
+                    TRANS_IDS = id*10**9+(b*MAX_LINE_DENSITY+np.arange(n))
+                    for j in np.flatnonzero(keep).tolist():
+                        NU.append(nu[j])
+                        ROWS.append((M,ISO_CHARS[I-1],nu[j],VALS[0][j],VALS[1][j],VALS[2][j],
+                            VALS[3][j],VALS[4][j],VALS[5][j],VALS[6][j],'v1 %d'%(j%10),'v0',
+                            'J %d'%(j%50),'J %d'%(j%49),'345000','  1  2  3  4','',
+                            VALS[7][j],VALS[8][j],int(TRANS_IDS[j]),id))
+            for k in np.argsort(NU,kind='stable').tolist():
+                row = ROWS[k]
+                yield PAR_LINE_FORMAT%row[:-2]+',%12d,%5d\n'%row[-2:]
+
+class APIRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Request handler of LocalAPIServer.
+    Data files support ETag (If-None-Match), byte ranges (Range, If-Range),
+    and the gzip content encoding.
+    """
+
+    def log_message(self,*args):
+        if self.server.verbose:
+            http.server.BaseHTTPRequestHandler.log_message(self,*args)
+
+    def do_GET(self):
+        self.handle_request_()
+
+    def do_HEAD(self):
+        self.handle_request_(head=True)
+
+    def handle_request_(self,head=False):
+        server = self.server
+        server.count_request_()
+        if server.latency: time.sleep(server.latency)
+        url = urllib.parse.urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        if len(parts)==4 and parts[0]=='api':
+            _,version,api_key,section = parts
+            if api_key!=server.api_key:
+                return self.send_error(403,'wrong api key')
+            try:
+                header = server.get_header(section,urllib.parse.parse_qs(url.query))
+            except KeyError:
+                return self.send_error(404,'unknown section %s'%section)
+            return self.send_data_(json.dumps(header).encode('utf-8'),'application/json',head)
+        path = server.get_file_path(url.path)
+        if path is None:
+            return self.send_error(404)
+        self.send_file_(path,head)
+
+    def send_data_(self,data,content_type,head=False):
+        self.send_response(200)
+        self.send_header('Content-Type',content_type)
+        self.send_header('Content-Length',str(len(data)))
+        self.end_headers()
+        if not head: self.write_(data)
+
+    def send_file_(self,path,head=False):
+        size = os.path.getsize(path)
+        stat = os.stat(path)
+        etag = '"%x-%x"'%(stat.st_mtime_ns,size)
+        if self.headers.get('If-None-Match')==etag:
+            self.send_response(304); self.end_headers()
+            return
+        gzipped = self.server.gzip and 'gzip' in self.headers.get('Accept-Encoding','')
+        start = 0
+        rng = self.headers.get('Range')
+        if rng and not gzipped and self.headers.get('If-Range',etag)==etag:
+            start = int(rng.split('=')[1].split('-')[0])
+            if start>=size:
+                self.send_response(416)
+                self.send_header('Content-Range','bytes */%d'%size)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range','bytes %d-%d/%d'%(start,size-1,size))
+        else:
+            self.send_response(200)
+        self.send_header('ETag',etag)
+        self.send_header('Accept-Ranges','bytes')
+        if gzipped:
+            self.send_header('Content-Encoding','gzip') # length is unknown, connection is closed at the end
+        else:
+            self.send_header('Content-Length',str(size-start))
+        self.end_headers()
+        if head: return
+        comp = zlib.compressobj(6,zlib.DEFLATED,16+zlib.MAX_WBITS) if gzipped else None
+        with open(path,'rb') as f:
+            f.seek(start)
+            for chunk in iter(lambda: f.read(SEND_CHUNK),b''):
+                self.write_(comp.compress(chunk) if comp else chunk)
+        if comp: self.write_(comp.flush())
+
+    def write_(self,data):
+        """ Write to the socket, throttled to server.bandwidth (bytes/sec). """
+        bandwidth = self.server.bandwidth
+        for i in range(0,len(data),SEND_CHUNK):
+            t0 = time.time()
+            chunk = data[i:i+SEND_CHUNK]
+            self.wfile.write(chunk)
+            if bandwidth:
+                delay = len(chunk)/bandwidth-(time.time()-t0)
+                if delay>0: time.sleep(delay)
+
+class LocalAPIServer(http.server.ThreadingHTTPServer):
+    """
+    Local HTTP server imitating the HITRANonline API.
+        database - SyntheticDatabase object (default: SyntheticDatabase())
+        datadir - folder for the generated files (default: new temporary folder)
+        latency - delay before each response (sec)
+        bandwidth - throughput limit of each response (bytes/sec, None means unlimited)
+        gzip - compress the data files if the client accepts gzip
+    The transition files are generated on the first request and reused
+    for the same queries. Use start/stop or the context manager protocol.
+    """
+
+    daemon_threads = True
+
+    def __init__(self,database=None,datadir=None,host='127.0.0.1',port=0,api_key=API_KEY,
+            latency=0.0,bandwidth=None,gzip=False,verbose=False):
+        http.server.ThreadingHTTPServer.__init__(self,(host,port),APIRequestHandler)
+        self.database = SyntheticDatabase() if database is None else database
+        self.tmpdir_ = datadir is None
+        self.datadir = os.path.abspath(tempfile.mkdtemp() if datadir is None else datadir)
+        self.api_key = api_key
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.gzip = gzip
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.nrequests = 0
+        self.thread = None
+        for item in self.database.cross_sections:
+            path = os.path.join(self.datadir,XSEC_DIR,item['filename'])
+            os.makedirs(os.path.dirname(path),exist_ok=True)
+            with open(path,'w') as f:
+                f.write(self.database.get_xsc_file(item))
+        os.makedirs(os.path.join(self.datadir,RESULTS_DIR),exist_ok=True)
+
+    @property
+    def url(self):
+        host,port = self.server_address[:2]
+        return 'http://%s:%d'%(host,port)
+
+    def count_request_(self):
+        with self.lock:
+            self.nrequests += 1
+
+    def get_file_path(self,urlpath):
+        """ Get the local path of the data file (None if it doesn't exist). """
+        path = os.path.normpath(os.path.join(self.datadir,urllib.parse.unquote(urlpath).lstrip('/')))
+        if not path.startswith(self.datadir+os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    def get_header(self,section,query):
+        """
+        Make the API header for the section with the query parsed by urllib.parse.parse_qs.
+        Raises KeyError for the unknown section.
+        """
+        db = self.database
+        MOLECULE_IDS = {mol['ordinary_formula']:mol['id'] for mol in db.molecules}
+
+        def select(ITEMS,key,get_id):
+            if key not in query: return ITEMS
+            ids = set(int(id) for val in query[key] for id in val.split(',') if id)
+            return [item for item in ITEMS if get_id(item) in ids]
+
+        if section=='info':
+            return {'content':{'class':'Info','format':'json','data':{
+                'results_dir':RESULTS_DIR,'xsec_dir':XSEC_DIR,'api_version':'v2',
+                'server':'hapi2 local stand-in'}}}
+        if section=='transitions':
+            return self.get_transitions_header_(query)
+        classname,ITEMS = {
+            'molecules':('Molecule',lambda: db.molecules),
+            'isotopologues':('Isotopologue',lambda: select(db.isotopologues,'molecule_id__in',
+                lambda item: MOLECULE_IDS[item['molecule_alias']])),
+            'sources':('Source',lambda: select(db.sources,'id__in',lambda item: item['id'])),
+            'cross-sections':('CrossSection',lambda: select(db.cross_sections,'molecule_id__in',
+                lambda item: MOLECULE_IDS[item['molecule_alias']])),
+            'parameter-metas':('ParameterMeta',lambda: [item for item in db.parameter_metas
+                if query.get('name__icontains',[''])[0].lower() in item['name']]),
+        }[section]
+        return {'content':{'class':classname,'format':'json','data':ITEMS()}}
+
+    def get_transitions_header_(self,query):
+        iso_ids = sorted(int(id) for id in query['iso_ids_list'][0].split(','))
+        numin = float(query['numin'][0]); numax = float(query['numax'][0])
+        key = hashlib.sha1(json.dumps([iso_ids,numin,numax,self.database.line_density,
+            self.database.seed]).encode('utf-8')).hexdigest()[:16]
+        filename = 'transitions_%s.data'%key
+        path = os.path.join(self.datadir,RESULTS_DIR,filename)
+        with self.lock: # the same query can come from several threads
+            if not os.path.isfile(path):
+                nlines = 0
+                with open(path+'.tmp','w') as f:
+                    for line in self.database.iter_transition_lines(iso_ids,numin,numax):
+                        f.write(line); nlines += 1
+                os.replace(path+'.tmp',path)
+                with open(path+'.json','w') as f:
+                    json.dump({'number_of_transitions':nlines},f)
+            with open(path+'.json') as f:
+                nlines = json.load(f)['number_of_transitions']
+        return {'content':{'class':'Transition','format':'text/hapi','data':filename,
+            'number_of_transitions':nlines,'parameters':PARLIST}}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever,daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.tmpdir_: shutil.rmtree(self.datadir,ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self,*args):
+        self.stop()
+
+@contextmanager
+def use_local_server(server=None,**argv):
+    """
+    Point the web API (SETTINGS host and api_key) to the local server
+    for the duration of the context, the server is started if not given.
+        argv - arguments of LocalAPIServer
+    """
+    own = server is None
+    if own: server = LocalAPIServer(**argv).start()
+    SETTINGS_ORIG = {key:SETTINGS.get(key) for key in ('host','api_key')}
+    SETTINGS.update({'host':server.url,'api_key':server.api_key})
+    try:
+        yield server
+    finally:
+        SETTINGS.update(SETTINGS_ORIG)
+        if own: server.stop()
+
+# ===================================================================================
+# BENCHMARK HARNESS
+# ===================================================================================
+
+BENCHMARK_CASES = ['info','parameter-metas','molecules','isotopologues','sources',
+    'cross-section-headers','cross-section-spectra','transitions','transitions-pipelined']
+
+def benchmark(server,cases=None,nruns=3,numin=0,numax=2000):
+    """
+    Measure the end-to-end time of the fetch_* functions against the local server:
+    latency of the header requests and throughput of the data downloads
+    (bytes/sec and items/sec, including parsing and insertion to the database).
+    HAPI2 must be initialized (the fetched objects are saved to its database).
+    The download cache is turned off, each transitions run makes a new linelist.
+        cases - names from BENCHMARK_CASES (default: all)
+        numin,numax - wavenumber range of the transitions (cm-1)
+    Returns the list of dicts {'case','run','elapsed_time','nbytes','nitems',...}.
+    """
+    import hapi2
+    from hapi2.web.api import fetch_header
+    if cases is None: cases = BENCHMARK_CASES
+    for case in cases:
+        if case not in BENCHMARK_CASES:
+            raise Exception('unknown benchmark case "%s"'%case)
+    RESULTS = []
+    SETTINGS_ORIG = {key:SETTINGS.get(key) for key in ('fetch_cache','fetch_pipelined')}
+    with use_local_server(server):
+        SETTINGS['fetch_cache'] = False
+        try:
+            hapi2.fetch_info()
+            hapi2.fetch_molecules()
+            mols_lbl = [hapi2.Molecule(name) for _,name,_ in LBL_MOLECULES[:server.database.nmolecules]]
+            mols_xsc = [hapi2.Molecule(name) for _,name,_,_ in XSC_MOLECULES]
+            hapi2.fetch_sources()
+            RUNS = {
+                'info':lambda: (fetch_header('info'),0),
+                'parameter-metas':lambda: (None,len(hapi2.fetch_parameter_metas())),
+                'molecules':lambda: (None,len(hapi2.fetch_molecules())),
+                'isotopologues':lambda: (None,len(hapi2.fetch_isotopologues(mols_lbl))),
+                'sources':lambda: (None,len(hapi2.fetch_sources())),
+                'cross-section-headers':lambda: (None,len(hapi2.fetch_cross_section_headers(mols_xsc))),
+                'cross-section-spectra':lambda: (None,len(hapi2.fetch_cross_sections(mols_xsc))),
+            }
+            for case in cases:
+                for irun in range(nruns):
+                    nrequests = server.nrequests
+                    t0 = time.time()
+                    if case.startswith('transitions'):
+                        isos = [iso for mol in mols_lbl for iso in mol.isotopologues]
+                        llst_name = 'benchmark_%s_%d_%s'%(case.replace('-','_'),irun,uuid())
+                        hapi2.fetch_transitions(isos,numin,numax,llst_name,
+                            pipelined=case=='transitions-pipelined')
+                        elapsed_time = time.time()-t0
+                        nbytes = os.path.getsize(os.path.join(SETTINGS['tmpdir'],llst_name+'.data'))
+                        nitems = hapi2.Linelist(llst_name).transitions.count()
+                    else:
+                        _,nitems = RUNS[case]()
+                        elapsed_time = time.time()-t0
+                        nbytes = None
+                    RESULTS.append({'case':case,'run':irun,'elapsed_time':elapsed_time,
+                        'nrequests':server.nrequests-nrequests,'nbytes':nbytes,'nitems':nitems,
+                        'mb_per_sec':nbytes/2**20/elapsed_time if nbytes else None,
+                        'items_per_sec':nitems/elapsed_time})
+        finally:
+            SETTINGS.update(SETTINGS_ORIG)
+    return RESULTS
+
+def summarize_benchmark(RESULTS):
+    """
+    Get the best (minimum time) run of each benchmark case.
+    """
+    BEST = {}
+    for result in RESULTS:
+        if result['case'] not in BEST or result['elapsed_time']<BEST[result['case']]['elapsed_time']:
+            BEST[result['case']] = result
+    return [BEST[case] for case in BENCHMARK_CASES if case in BEST]
+
+def print_benchmark(RESULTS):
+    print('%-24s %10s %10s %12s %10s %14s'%('case','time, sec','requests','items','MB/sec','items/sec'))
+    for result in summarize_benchmark(RESULTS):
+        print('%-24s %10.4f %10d %12d %10s %14.1f'%(result['case'],result['elapsed_time'],
+            result['nrequests'],result['nitems'],
+            '%.2f'%result['mb_per_sec'] if result['mb_per_sec'] else '-',result['items_per_sec']))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local stand-in of the HITRANonline API.')
+    parser.add_argument('mode',choices=['serve','benchmark'])
+    parser.add_argument('--host',default='127.0.0.1')
+    parser.add_argument('--port',type=int,default=0)
+    parser.add_argument('--datadir',default=None)
+    parser.add_argument('--molecules',type=int,default=3)
+    parser.add_argument('--isotopologues',type=int,default=3)
+    parser.add_argument('--line-density',type=int,default=20,help='lines per cm-1 per isotopologue')
+    parser.add_argument('--xsc-npnts',type=int,default=10000)
+    parser.add_argument('--latency',type=float,default=0.0,help='sec')
+    parser.add_argument('--bandwidth',type=float,default=None,help='MB/sec')
+    parser.add_argument('--gzip',action='store_true')
+    parser.add_argument('--nruns',type=int,default=3)
+    parser.add_argument('--numin',type=float,default=0)
+    parser.add_argument('--numax',type=float,default=2000)
+    parser.add_argument('--cases',default=None,help='comma-separated list of %s'%','.join(BENCHMARK_CASES))
+    args = parser.parse_args(argv)
+    database = SyntheticDatabase(nmolecules=args.molecules,nisotopologues=args.isotopologues,
+        xsc_npnts=args.xsc_npnts,line_density=args.line_density)
+    server = LocalAPIServer(database,args.datadir,args.host,args.port,latency=args.latency,
+        bandwidth=args.bandwidth*2**20 if args.bandwidth else None,gzip=args.gzip,
+        verbose=args.mode=='serve')
+    with server:
+        if args.mode=='serve':
+            print('Serving the HITRAN API stand-in at %s (api key "%s")'%(server.url,server.api_key))
+            try:
+                server.thread.join()
+            except KeyboardInterrupt:
+                pass
+            return
+        os.makedirs(SETTINGS['tmpdir'],exist_ok=True)
+        RESULTS = benchmark(server,args.cases.split(',') if args.cases else None,
+            args.nruns,args.numin,args.numax)
+        print_benchmark(RESULTS)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,351 @@
+import os
+import sys
+import time
+
+import numpy as np
+
+from hapi import LOCAL_TABLE_CACHE
+from hapi2.collect import Collection, uuid
+from hapi2 import Transition, Linelist, query, session, storage2cache, db_backend
+from hapi2.db.sqlalchemy.updaters import get_first_available_, id_conditions, chunks, \
+    insert_transition_dicts_core_
+
+from unittests import timeit, runtest
+from hapi2.format.streamers.dotpar import stream_hapi_transition_columns_, columns_to_transition_dicts_
+from hapi2.utils.xsc import compress_zlib, pack_double, get_compressor_module_
+from hapi2.config import SETTINGS
+from test_format_dotpar import make_dotpar_file, TMPDIR
+
+NLINES = 200000
+NPNTS_BLOB = 1000000
+
+def make_header(filestem):
+    return {'content':{'class':'Transition','format':'text/hapi','linelist':filestem}}
+
+def make_transitions_file(filestem,nlines,seed=0,id_offset=None):
+    """ Make synthetic transitions with the ids not yet occupied in the database. """
+    if id_offset is None:
+        id_offset,_ = get_first_available_(Transition,'id',local=False)
+    make_dotpar_file(filestem,nlines,seed=seed,id_offset=id_offset)
+    return id_offset
+
+def test_transitions_ingest_parallel():
+
+    session_id = uuid()
+
+    filestem_serial = 'ingest_serial_%s'%session_id
+    make_transitions_file(filestem_serial,NLINES,seed=1)
+    elapsed_time_serial,_ = timeit(Transition.update,
+        make_header(filestem_serial),local=False,llst_name=filestem_serial)
+
+    filestem_parallel = 'ingest_parallel_%s'%session_id
+    make_transitions_file(filestem_parallel,NLINES,seed=2)
+    elapsed_time,_ = timeit(Transition.update,
+        make_header(filestem_parallel),local=False,llst_name=filestem_parallel,parallel=True)
+
+    test_results = Collection()
+    test_results.update({'nlines':NLINES,
+        'serial_lines_per_sec':NLINES/elapsed_time_serial,
+        'parallel_lines_per_sec':NLINES/elapsed_time})
+
+    return elapsed_time,test_results
+
+def test_transitions_ingest_pipelined():
+    """
+    Compare the download followed by the ingest with the pipelined one,
+    the download is emulated by the stream of chunks with the bandwidth
+    matching the ingest throughput.
+    """
+    from hapi2.utils.pipeline import iter_threaded
+    
+    chunk_size = 2**20
+    
+    def emulate_download(path,delay):
+        def download(emit):
+            with open(path,'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size),b''):
+                    time.sleep(delay)
+                    emit(chunk)
+        return iter_threaded(download,16)
+    
+    session_id = uuid()
+    
+    filestem_local = 'ingest_local_%s'%session_id
+    make_transitions_file(filestem_local,NLINES,seed=4)
+    path = os.path.join(TMPDIR,filestem_local+'.data')
+    elapsed_time_ingest,_ = timeit(Transition.update,make_header(filestem_local),
+        local=False,llst_name=filestem_local,chunks=emulate_download(path,0))
+    delay = elapsed_time_ingest/(os.path.getsize(path)/chunk_size)
+    elapsed_time_download,_ = timeit(lambda: sum(len(chunk) for chunk in emulate_download(path,delay)))
+    
+    filestem_pipelined = 'ingest_pipelined_%s'%session_id
+    make_transitions_file(filestem_pipelined,NLINES,seed=5)
+    path = os.path.join(TMPDIR,filestem_pipelined+'.data')
+    elapsed_time,_ = timeit(Transition.update,make_header(filestem_pipelined),
+        local=False,llst_name=filestem_pipelined,chunks=emulate_download(path,delay))
+    
+    assert Linelist(filestem_pipelined).transitions.count()==NLINES
+    assert elapsed_time<0.8*(elapsed_time_download+elapsed_time_ingest)
+    
+    test_results = Collection()
+    test_results.update({'nlines':NLINES,'download':elapsed_time_download,
+        'ingest':elapsed_time_ingest,'sequential':elapsed_time_download+elapsed_time_ingest,
+        'pipelined':elapsed_time})
+    
+    return elapsed_time,test_results
+
+def test_transitions_resync():
+
+    filestem = 'resync_%s'%uuid()
+    make_transitions_file(filestem,NLINES,seed=3)
+    Transition.update(make_header(filestem),local=False,llst_name=filestem)
+    ids = [t.id for t in Linelist(filestem).transitions]
+
+    # re-sync of the same linelist: all transitions are looked up and updated
+    elapsed_time,_ = timeit(Transition.update,
+        make_header(filestem),local=False,llst_name=filestem)
+
+    test_results = Collection()
+    test_results.update({'nlines':NLINES,
+        'lookups_in_chunks':len(list(chunks(ids))),
+        'lookups_in_ranges':len(list(id_conditions(Transition.id,ids))),
+        'resync_lines_per_sec':NLINES/elapsed_time})
+
+    return elapsed_time,test_results
+
+def test_transitions_upsert():
+
+    filestem = 'upsert_%s'%uuid()
+    id_offset = make_transitions_file(filestem,NLINES,seed=4)
+    Transition.update(make_header(filestem),local=False,llst_name=filestem)
+    query(Transition).filter(Transition.id>id_offset,Transition.id<=id_offset+10).\
+        update({'extra':{'old_par':1.0}},synchronize_session=False)
+    session.commit()
+
+    # refresh the linelist with the new parameters of the same transitions
+    filestem_refresh = filestem+'_refresh'
+    make_transitions_file(filestem_refresh,NLINES,seed=5,id_offset=id_offset)
+    elapsed_time,_ = timeit(Transition.update,
+        make_header(filestem_refresh),local=False,llst_name=filestem,upsert=True)
+
+    nus = [nu for nu, in query(Transition.nu).order_by(Transition.id).\
+        filter(Transition.id>id_offset,Transition.id<=id_offset+NLINES)]
+    nus_refresh = [nu for columns in stream_hapi_transition_columns_(TMPDIR,filestem_refresh) \
+        for nu in columns['nu'].tolist()]
+    assert nus==nus_refresh
+
+    # the refresh without extra parameters keeps the stored ones
+    extra = lambda: [extra for extra, in query(Transition.extra).order_by(Transition.id).\
+        filter(Transition.id>id_offset,Transition.id<=id_offset+10)]
+    assert extra()==[{'old_par':1.0}]*10
+
+    # the new extra parameters are merged with the stored ones
+    TRANS_DICTS = columns_to_transition_dicts_(next(stream_hapi_transition_columns_(TMPDIR,filestem_refresh)))[:10]
+    for trans_dict in TRANS_DICTS: trans_dict['extra'] = {'new_par':2.0}
+    insert_transition_dicts_core_(Transition,TRANS_DICTS,Linelist(filestem).id,local=False,upsert=True)
+    assert extra()==[{'old_par':1.0,'new_par':2.0}]*10
+
+    test_results = Collection()
+    test_results.update({'nlines':NLINES,
+        'upsert_lines_per_sec':NLINES/elapsed_time})
+
+    return elapsed_time,test_results
+
+def test_transitions_columnar():
+
+    filestem = 'columnar_%s'%uuid()
+    make_transitions_file(filestem,NLINES,seed=6)
+    Transition.update(make_header(filestem),local=False,llst_name=filestem,columnar=True)
+
+    # legacy import from the database vs memory-mapped columns
+    tablename_db = filestem+'_db'
+    elapsed_time_db,_ = timeit(storage2cache,tablename_db,query=Linelist(filestem).transitions)
+    elapsed_time,_ = timeit(storage2cache,filestem)
+
+    data_db = LOCAL_TABLE_CACHE[tablename_db]['data']
+    data = LOCAL_TABLE_CACHE[filestem]['data']
+    assert isinstance(np.ma.getdata(data['nu']),np.memmap)
+    assert np.all(np.diff(data['nu'])>=0)
+
+    order_db = np.argsort(data_db['id'])
+    order = np.argsort(data['id'])
+    for parname in data_db:
+        assert data_db[parname][order_db].tolist()==data[parname][order].tolist(), parname
+
+    test_results = Collection()
+    test_results.update({'nlines':NLINES,
+        'db_lines_per_sec':NLINES/elapsed_time_db,
+        'columnar_lines_per_sec':NLINES/elapsed_time})
+
+    return elapsed_time,test_results
+
+def test_transitions_read_arrays():
+
+    filestem = 'read_arrays_%s'%uuid()
+    id_offset = make_transitions_file(filestem,NLINES,seed=7)
+    Transition.update(make_header(filestem),local=False,llst_name=filestem)
+
+    # make some NULLs
+    query(Transition).filter(Transition.id>id_offset,Transition.id<=id_offset+10).\
+        update({'sw':None,'gp':None},synchronize_session=False)
+    session.commit()
+
+    colnames = ['id','molec_id','local_iso_id','nu','sw','gamma_air','gamma_self','gp','iref']
+    q = Linelist(filestem).transitions.order_by(Transition.id)
+
+    def read_rows():
+        data = list(zip(*q.with_entities(*[getattr(Transition,colname) for colname in colnames]).all()))
+        return {colname:np.ma.array(datum) for colname,datum in zip(colnames,data)}
+
+    elapsed_time_rows,data_rows = timeit(read_rows)
+    elapsed_time,data = timeit(Transition.read_arrays,q,colnames,fill_values={'gp':0})
+
+    assert data['nu'].dtype==np.float64 and data['molec_id'].dtype==np.int64
+    assert not isinstance(data['nu'],np.ma.MaskedArray)
+    assert np.isnan(data['sw'][:10]).all() and (data['gp'][:10]==0).all()
+    for colname in colnames:
+        assert data_rows[colname][10:].tolist()==data[colname][10:].tolist(), colname
+
+    test_results = Collection()
+    test_results.update({'nlines':NLINES,
+        'rows_lines_per_sec':NLINES/elapsed_time_rows,
+        'arrays_lines_per_sec':NLINES/elapsed_time})
+
+    return elapsed_time,test_results
+
+def test_cross_section_blob_codec():
+
+    rnd = np.random.default_rng(0)
+    nu = np.linspace(2000.,2500.,NPNTS_BLOB)
+    xsc = np.exp(-(nu[:,None]-rnd.uniform(2000.,2500.,20))**2/0.5).sum(axis=1)*1e-20
+    CrossSectionData = db_backend.models.CrossSectionData
+    mbytes = (nu.nbytes+xsc.nbytes)/2**20
+
+    def store_legacy():
+        data = CrossSectionData()
+        data.b__nu__ = compress_zlib(pack_double(nu))
+        data.b__xsc__ = compress_zlib(pack_double(xsc))
+        return data
+
+    def load(data):
+        return data.unpack_nu(),data.unpack_xsc()
+
+    # legacy blobs are still readable
+    elapsed_time_store_legacy,data = timeit(store_legacy)
+    elapsed_time_load_legacy,(nu_,xsc_) = timeit(load,data)
+    assert np.array_equal(nu_,nu) and np.array_equal(xsc_,xsc)
+
+    SETTINGS_ORIG = {key:SETTINGS[key] for key in ('blob_compressor','blob_shuffle')}
+    test_results = Collection()
+    test_results.update({'compressor':'legacy','shuffle':False,
+        'ratio':(len(data.b__nu__)+len(data.b__xsc__))/2**20/mbytes,
+        'store_mb_per_sec':mbytes/elapsed_time_store_legacy,
+        'load_mb_per_sec':mbytes/elapsed_time_load_legacy})
+    for compressor in ['none','zlib','zstd','lz4']:
+        if compressor in ['zstd','lz4']:
+            try:
+                get_compressor_module_(compressor)
+            except Exception as e:
+                print(e); continue
+        for shuffle in [False,True]:
+            SETTINGS.update({'blob_compressor':compressor,'blob_shuffle':shuffle})
+            elapsed_time_store,data = timeit(CrossSectionData,nu,xsc)
+            elapsed_time_load,(nu_,xsc_) = timeit(load,data)
+            assert np.array_equal(nu_,nu) and np.array_equal(xsc_,xsc)
+            test_results.update({'compressor':compressor,'shuffle':shuffle,
+                'ratio':(len(data.b__nu__)+len(data.b__xsc__))/2**20/mbytes,
+                'store_mb_per_sec':mbytes/elapsed_time_store,
+                'load_mb_per_sec':mbytes/elapsed_time_load})
+    SETTINGS.update(SETTINGS_ORIG)
+
+    # default codec
+    elapsed_time_store,data = timeit(CrossSectionData,nu,xsc)
+    elapsed_time_load,_ = timeit(load,data)
+    assert elapsed_time_store<elapsed_time_store_legacy
+    assert elapsed_time_load<elapsed_time_load_legacy
+
+    return elapsed_time_load,test_results
+
+def make_cross_section(nu,xsc,numin=None,numax=None):
+    """ Make the transient CrossSection bypassing the molecule and source lookups. """
+    mapper = db_backend.models.CrossSection.__mapper__
+    mapper.registry.configure()
+    xs = mapper.class_manager.new_instance()
+    xs.numin = numin; xs.numax = numax
+    xs.set_data(nu,xsc)
+    return xs
+
+def test_cross_section_cached_data():
+
+    rnd = np.random.default_rng(0)
+    nu = np.linspace(2000.,2500.,NPNTS_BLOB)
+    xsc = np.exp(-(nu[:,None]-rnd.uniform(2000.,2500.,20))**2/0.5).sum(axis=1)*1e-20
+    RANGES = np.sort(rnd.uniform(1990.,2510.,(100,2)),axis=1)
+    RANGES[:10] = nu[rnd.integers(0,NPNTS_BLOB,(10,2))] # bounds on the grid nodes
+    RANGES[:10].sort(axis=1)
+    
+    def range_uncached(xs,numin,numax):
+        nu,xsc = xs.data.unpack_nu(),xs.data.unpack_xsc()
+        sort_ind = np.argsort(nu)
+        nu = nu[sort_ind]; xsc = xsc[sort_ind]
+        i1,i2 = np.searchsorted(nu,[numin,numax],side='right')
+        return nu[i1:i2],xsc[i1:i2]
+
+    def range_all(xs,range_fun):
+        return [range_fun(xs,numin,numax) for numin,numax in RANGES]
+
+    perm = rnd.permutation(NPNTS_BLOB)
+    CASES = [
+        ('uniform_header',make_cross_section(None,xsc,nu[0],nu[-1])),
+        ('uniform',make_cross_section(nu,xsc)),
+        ('unsorted',make_cross_section(nu[perm],xsc[perm])),
+    ]
+    test_results = Collection()
+    for case,xs in CASES:
+        elapsed_time_uncached,RES_UNCACHED = timeit(range_all,xs,range_uncached)
+        elapsed_time,RES = timeit(range_all,xs,xs.__class__.range)
+        for (nu_,xsc_),(nu_uncached,xsc_uncached) in zip(RES,RES_UNCACHED):
+            assert np.array_equal(nu_,nu_uncached) and np.array_equal(xsc_,xsc_uncached)
+        assert elapsed_time<elapsed_time_uncached
+        test_results.update({'case':case,'npnts':NPNTS_BLOB,'nranges':len(RANGES),
+            'uniform':xs.get_sorted_data_()[2],
+            'elapsed_time_uncached':elapsed_time_uncached,'elapsed_time':elapsed_time,
+            'speedup':elapsed_time_uncached/elapsed_time})
+
+    # set_data invalidates the cache
+    xs = CASES[1][1]
+    xs.set_data(nu,2*xsc)
+    assert np.array_equal(xs.range(2200.,2300.)[1],2*range_uncached(CASES[0][1],2200.,2300.)[1])
+    assert not xs.get_data()[1].flags.writeable
+
+    return elapsed_time,test_results
+
+TEST_CASES = [
+    test_transitions_ingest_parallel,
+    test_transitions_ingest_pipelined,
+    test_transitions_resync,
+    test_transitions_upsert,
+    test_transitions_columnar,
+    test_transitions_read_arrays,
+    test_cross_section_blob_codec,
+    test_cross_section_cached_data,
+]
+
+def do_tests(TEST_CASES,testgroup=None,session_name=None): # test all functions
+
+    if testgroup is None:
+        testgroup = os.path.basename(__file__)
+
+    session_uuid = uuid()
+
+    for test_fun in TEST_CASES:
+        runtest(test_fun,testgroup,session_name,session_uuid,save=True)
+
+if __name__=='__main__':
+
+    try:
+        session_name = sys.argv[1]
+    except IndexError:
+        session_name = '__not_supplied__'
+
+    do_tests(TEST_CASES,session_name=session_name)
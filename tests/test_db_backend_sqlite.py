@@ -0,0 +1,178 @@
+import os
+import sys
+
+from hapi2.collect import Collection, uuid
+from hapi2 import Transition, Linelist, query, session, db_backend, create_indexes, drop_indexes
+
+from unittests import timeit, runtest
+from test_db_backend import make_header, make_transitions_file
+
+NLINES = 200000
+NLINES_INDEXES = 2000000
+
+COLNAMES = ['id','nu','sw','gamma_air','local_upper_quanta','gp','gpp']
+
+def read_linelist(llst_name):
+    llst = Linelist(llst_name)
+    llst_vs_trans = db_backend.models.linelist_vs_transition
+    return query(*[getattr(Transition,colname) for colname in COLNAMES]+[Transition.extra]).\
+        join(llst_vs_trans,llst_vs_trans.c.transition_id==Transition.id).\
+        filter(llst_vs_trans.c.linelist_id==llst.id).order_by(Transition.id).all()
+
+def test_transitions_bulk_load():
+
+    session_id = uuid()
+
+    filestem_serial = 'ingest_serial_%s'%session_id
+    make_transitions_file(filestem_serial,NLINES,seed=1)
+    elapsed_time_serial,_ = timeit(Transition.update,
+        make_header(filestem_serial),local=False,llst_name=filestem_serial)
+
+    filestem_bulk = 'ingest_bulk_%s'%session_id
+    make_transitions_file(filestem_bulk,NLINES,seed=1)
+    elapsed_time,_ = timeit(Transition.update,
+        make_header(filestem_bulk),local=False,llst_name=filestem_bulk,bulk=True)
+
+    # same data (except ids) must be loaded in both modes
+    TRANSS_SERIAL = read_linelist(filestem_serial)
+    TRANSS_BULK = read_linelist(filestem_bulk)
+    assert len(TRANSS_BULK)==NLINES
+    assert [t[1:] for t in TRANSS_SERIAL]==[t[1:] for t in TRANSS_BULK]
+
+    test_results = Collection()
+    test_results.update({'nlines':NLINES,
+        'serial_lines_per_sec':NLINES/elapsed_time_serial,
+        'bulk_lines_per_sec':NLINES/elapsed_time})
+
+    return elapsed_time,test_results
+
+def test_transitions_bulk_load_existing_ids():
+    """
+    Bulk load of the ids which are already in the database must fail 
+    without committing any transitions, and restore the indexes.
+    """
+    from sqlalchemy import text, inspect
+
+    session_id = uuid()
+    nlines = 1000
+
+    filestem_first = 'bulk_first_%s'%session_id
+    id_offset = make_transitions_file(filestem_first,nlines,seed=1)
+    Transition.update(make_header(filestem_first),local=False,llst_name=filestem_first,bulk=True)
+
+    filestem_second = 'bulk_second_%s'%session_id
+    make_transitions_file(filestem_second,nlines,seed=2,id_offset=id_offset-nlines//2)
+    indexes = lambda: sorted(ix['name'] for ix in inspect(session.connection()).get_indexes('transition'))
+    synchronous = lambda: session.execute(text('PRAGMA synchronous')).scalar()
+    INDEXES = indexes(); SYNCHRONOUS = synchronous(); NTRANS = query(Transition).count()
+    try:
+        elapsed_time,_ = timeit(Transition.update,
+            make_header(filestem_second),local=False,llst_name=filestem_second,bulk=True)
+        raise AssertionError('bulk load must fail')
+    except Exception as e:
+        if type(e) is AssertionError: raise
+        assert 'already in the database' in str(e)
+
+    assert query(Transition).count()==NTRANS
+    assert len(read_linelist(filestem_second))==0
+    assert len(read_linelist(filestem_first))==nlines
+    assert indexes()==INDEXES and synchronous()==SYNCHRONOUS
+
+    test_results = Collection()
+    test_results.update({'nlines':nlines,'noverlap':nlines//2})
+
+    return 0.0,test_results
+
+def test_transitions_indexes():
+
+    filestem = 'indexes_%s'%uuid()
+    make_transitions_file(filestem,NLINES_INDEXES,seed=6)
+    Transition.update(make_header(filestem),local=False,llst_name=filestem,bulk=True)
+
+    llst_vs_trans = db_backend.models.linelist_vs_transition
+    tables = [Transition.__table__,llst_vs_trans]
+    isoal_id, = query(Transition.isotopologue_alias_id).first()
+    ids = [id_ for id_, in query(Transition.id).limit(1000)]
+
+    QUERIES = {
+        'nu_range': lambda: query(Transition.id).\
+            filter(Transition.nu.between(1000,1010)).all(),
+        'isotopologue_nu_range': lambda: query(Transition.id).\
+            filter(Transition.isotopologue_alias_id==isoal_id,Transition.nu.between(1000,2000)).all(),
+        'linelists_for_transitions': lambda: query(llst_vs_trans.c.linelist_id).\
+            filter(llst_vs_trans.c.transition_id.in_(ids)).all(),
+    }
+
+    drop_indexes(tables)
+    TIMES_NOINDEX = {name:timeit(QUERIES[name])[0] for name in QUERIES}
+    elapsed_time,_ = timeit(create_indexes,tables)
+    TIMES_INDEX = {name:timeit(QUERIES[name])[0] for name in QUERIES}
+
+    test_results = Collection()
+    test_results.update([{'query':name,'nlines':NLINES_INDEXES,
+        'time_noindex':TIMES_NOINDEX[name],'time_index':TIMES_INDEX[name],
+        'speedup':TIMES_NOINDEX[name]/TIMES_INDEX[name]} for name in QUERIES])
+
+    return elapsed_time,test_results
+
+def test_legacy_mapping_duplicates():
+    """
+    Mapping table of the older versions has no primary key and can hold duplicates:
+    they must be deleted once, and the unique index created on the first call.
+    """
+    from sqlalchemy import MetaData, Table, Column, Integer, text, inspect
+
+    name = 'legacy_map_%s'%uuid().replace('-','_')
+    session.execute(text('CREATE TABLE %s (linelist_id INTEGER, transition_id INTEGER)'%name))
+    ROWS = [(i%3,i) for i in range(1000)]
+    session.execute(text('INSERT INTO %s VALUES (:l,:t)'%name),
+        [{'l':l,'t':t} for l,t in ROWS+ROWS[:500]])
+    table = Table(name,MetaData(),
+        Column('linelist_id',Integer,primary_key=True),
+        Column('transition_id',Integer,primary_key=True))
+
+    elapsed_time,_ = timeit(create_indexes,[table])
+    count = lambda: session.execute(text('SELECT COUNT(*) FROM %s'%name)).scalar()
+    assert count()==len(ROWS)
+    assert '%s__pk'%name in [ix['name'] for ix in inspect(session.connection()).get_indexes(name)]
+    
+    # the mapping inserts skip the duplicates now
+    session.execute(db_backend.models.insert_ignore_statement(table),
+        [{'linelist_id':l,'transition_id':t} for l,t in ROWS[:100]])
+    assert count()==len(ROWS)
+    
+    # next call doesn't scan the table again
+    elapsed_time_next,_ = timeit(create_indexes,[table])
+    session.commit()
+
+    test_results = Collection()
+    test_results.update({'nrows':len(ROWS),'nduplicates':500,
+        'first_call':elapsed_time,'next_call':elapsed_time_next})
+
+    return elapsed_time,test_results
+
+TEST_CASES = [
+    test_transitions_bulk_load,
+    test_transitions_bulk_load_existing_ids,
+    test_transitions_indexes,
+    test_legacy_mapping_duplicates,
+]
+
+def do_tests(TEST_CASES,testgroup=None,session_name=None): # test all functions
+
+    if testgroup is None:
+        testgroup = os.path.basename(__file__)
+
+    session_uuid = uuid()
+
+    for test_fun in TEST_CASES:
+        runtest(test_fun,testgroup,session_name,session_uuid,save=True)
+
+if __name__=='__main__':
+
+    try:
+        session_name = sys.argv[1]
+    except IndexError:
+        session_name = '__not_supplied__'
+
+    do_tests(TEST_CASES,session_name=session_name)
@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import random
+
+import hapi
+from hapi2.collect import Collection, uuid
+from hapi2.format.streamers.dotpar import stream_hapi_transition_data_, \
+    stream_hapi_transition_columns_, stream_hapi_transition_columns_parallel_, \
+    columns_to_transition_dicts_
+
+from unittests import timeit, runtest
+
+TMPDIR = '~tmp'
+NLINES = 200000
+
+def make_par_line(i,rnd):
+    """ Make random par_line in the HITRAN format. """
+    return '%2d%1s%12.6f%10.3E%10.3E%5.3f%5.3f%10.4f%4.2f%8.6f%15s%15s%15s%15s%6s%12s%1s%7.1f%7.1f'%(
+        rnd.randint(1,47),rnd.choice('1234567890AB'),rnd.uniform(0,10000),
+        rnd.uniform(1e-30,1e-19),rnd.uniform(0,100),rnd.uniform(0,0.2),
+        rnd.uniform(0,0.5),rnd.uniform(0,9000),rnd.uniform(0,1),rnd.uniform(0,0.009),
+        'v1 %d'%(i%10),'v0','J %d'%(i%50),'J %d'%(i%49),'345000','  1  2  3  4',
+        '' if i%3 else 'W',rnd.randint(1,99),rnd.randint(1,99))
+
+def make_dotpar_file(filestem,nlines,tmpdir=TMPDIR,seed=0,id_offset=0):
+    """ Make synthetic HAPI .data and .header files. """
+    rnd = random.Random(seed)
+    if not os.path.isdir(tmpdir): os.mkdir(tmpdir)
+    with open(os.path.join(tmpdir,filestem+'.data'),'w') as f:
+        for i in range(nlines):
+            f.write('%s,%12d,%5d\n'%(make_par_line(i,rnd),id_offset+i+1,rnd.randint(1,130)))
+    with open(os.path.join(tmpdir,filestem+'.header'),'w') as f:
+        json.dump(hapi.prepareHeader(parlist=['par_line','trans_id','global_iso_id']),f)
+
+def test_dotpar_columnar_consistency():
+
+    filestem = 'dotpar_consistency'
+    make_dotpar_file(filestem,10000)
+
+    def parse():
+        TRANS_DICTS = []
+        for columns in stream_hapi_transition_columns_(TMPDIR,filestem,chunk_size=100000):
+            TRANS_DICTS += columns_to_transition_dicts_(columns)
+        return TRANS_DICTS
+
+    elapsed_time,TRANS_DICTS = timeit(parse)
+    TRANS_DICTS_REF = list(stream_hapi_transition_data_(TMPDIR,filestem))
+
+    assert TRANS_DICTS==TRANS_DICTS_REF
+
+    test_results = Collection()
+    test_results.update({'nlines':len(TRANS_DICTS)})
+
+    return elapsed_time,test_results
+
+def test_dotpar_parallel_consistency():
+
+    filestem = 'dotpar_consistency'
+    make_dotpar_file(filestem,10000)
+
+    def parse():
+        TRANS_DICTS = []
+        for columns in stream_hapi_transition_columns_parallel_(TMPDIR,filestem,
+                nworkers=2,queue_depth=3,shard_size=100000):
+            TRANS_DICTS += columns_to_transition_dicts_(columns)
+        return TRANS_DICTS
+
+    elapsed_time,TRANS_DICTS = timeit(parse)
+    TRANS_DICTS_REF = list(stream_hapi_transition_data_(TMPDIR,filestem))
+
+    assert TRANS_DICTS==TRANS_DICTS_REF
+
+    test_results = Collection()
+    test_results.update({'nlines':len(TRANS_DICTS)})
+
+    return elapsed_time,test_results
+
+def test_dotpar_columnar_throughput():
+
+    filestem = 'dotpar_throughput'
+    make_dotpar_file(filestem,NLINES)
+
+    elapsed_time_lines,_ = timeit(lambda:
+        sum(1 for _ in stream_hapi_transition_data_(TMPDIR,filestem)))
+    elapsed_time,_ = timeit(lambda:
+        sum(len(c['nu']) for c in stream_hapi_transition_columns_(TMPDIR,filestem)))
+    elapsed_time_parallel,_ = timeit(lambda:
+        sum(len(c['nu']) for c in stream_hapi_transition_columns_parallel_(TMPDIR,filestem,
+            shard_size=1024*1024)))
+
+    test_results = Collection()
+    test_results.update({'nlines':NLINES,
+        'per_line_lines_per_sec':NLINES/elapsed_time_lines,
+        'columnar_lines_per_sec':NLINES/elapsed_time,
+        'parallel_lines_per_sec':NLINES/elapsed_time_parallel})
+
+    return elapsed_time,test_results
+
+TEST_CASES = [
+    test_dotpar_columnar_consistency,
+    test_dotpar_parallel_consistency,
+    test_dotpar_columnar_throughput,
+]
+
+def do_tests(TEST_CASES,testgroup=None,session_name=None): # test all functions
+
+    if testgroup is None:
+        testgroup = os.path.basename(__file__)
+
+    session_uuid = uuid()
+
+    for test_fun in TEST_CASES:
+        runtest(test_fun,testgroup,session_name,session_uuid,save=True)
+
+if __name__=='__main__':
+
+    try:
+        session_name = sys.argv[1]
+    except IndexError:
+        session_name = '__not_supplied__'
+
+    do_tests(TEST_CASES,session_name=session_name)
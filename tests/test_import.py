@@ -0,0 +1,59 @@
+import os
+import sys
+import tempfile
+import subprocess
+
+from hapi2.collect import Collection, uuid
+
+from unittests import timeit, runtest
+
+IMPORT_TIME_TARGET = 1.0 # seconds
+NRUNS = 5
+
+def test_import_cold():
+    """
+    Time the plain "import hapi2" in the fresh interpreter.
+    Import must be fast and must not touch the working directory
+    (config file, database and temporary folder are made by hapi2.init).
+    """
+    workdir = tempfile.mkdtemp()
+    env = dict(os.environ,PYTHONPATH=os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__))),os.environ.get('PYTHONPATH','')]))
+
+    def run(script):
+        subprocess.run([sys.executable,'-c',script],cwd=workdir,env=env,check=True)
+
+    test_results = Collection()
+    TIMES = []
+    for irun in range(NRUNS):
+        t_python,_ = timeit(run,'pass')
+        t_import,_ = timeit(run,'import hapi2')
+        TIMES.append(t_import-t_python)
+        test_results.update({'run':irun,'python':t_python,'import':TIMES[-1]})
+    assert os.listdir(workdir)==[]
+    assert min(TIMES)<IMPORT_TIME_TARGET
+
+    return min(TIMES),test_results
+
+TEST_CASES = [
+    test_import_cold,
+]
+
+def do_tests(TEST_CASES,testgroup=None,session_name=None): # test all functions
+
+    if testgroup is None:
+        testgroup = os.path.basename(__file__)
+
+    session_uuid = uuid()
+
+    for test_fun in TEST_CASES:
+        runtest(test_fun,testgroup,session_name,session_uuid,save=True)
+
+if __name__=='__main__':
+
+    try:
+        session_name = sys.argv[1]
+    except IndexError:
+        session_name = '__not_supplied__'
+
+    do_tests(TEST_CASES,session_name=session_name)
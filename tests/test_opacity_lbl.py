@@ -0,0 +1,480 @@
+import os
+import sys
+import json
+import tempfile
+import subprocess
+
+import numpy as np
+import numba
+
+import hapi
+from hapi2.collect import Collection, uuid
+import hapi2
+from hapi2 import Transition, Linelist, save_columns
+from hapi2.config.config import SETTINGS_DEFAULT, CONFIG_FILE
+from hapi2.db.sqlalchemy.columnar import get_columnar_dir, COLUMNAR_HEADER
+from hapi2.opacity.lbl.calc_xsc import LinesFromColumns, LinesFromDatabase, \
+    calc_windows, get_max_wing, LBL_WINDOW_BINS
+from hapi2.opacity.lbl.lut import LUT
+from hapi2.db.models import PartitionFunctionTable
+from hapi2.opacity.lbl.numba.fast_abscoef import absorptionCoefficient_Voigt, absorptionCoefficient_Multi, \
+    CALCat_, CALCu_, CALC_REDUCE_, PREFILTER_LINES, arange_
+from hapi2.opacity.lbl.numba import settings as numba_settings
+
+from unittests import timeit, runtest
+from test_db_backend import make_header, make_transitions_file
+
+NLINES = 200000
+NLINES_KERNEL = [10**5,10**6,10**7]
+NLAYERS = 32
+ENVIRONMENT = {'T':296.,'p':1.}
+DILUENT = {'air':1.}
+
+def make_columnar_linelist(llst_name,nlines,numin=2000.,numax=2500.,seed=0):
+    """ Make the columnar store of the synthetic CO2 linelist bypassing the database. """
+    rnd = np.random.default_rng(seed)
+    data = {
+        'id': np.arange(1,nlines+1,dtype=np.int64),
+        'isotopologue_alias_id': np.ones(nlines,dtype=np.int64),
+        'molec_id': np.full(nlines,2,dtype=np.int64),
+        'local_iso_id': np.ones(nlines,dtype=np.int64),
+        'nu': np.sort(rnd.uniform(numin,numax,nlines)),
+        'sw': 10**rnd.uniform(-26,-19,nlines),
+        'elower': rnd.uniform(0,5000,nlines),
+        'gamma_air': rnd.uniform(0.05,0.1,nlines),
+        'gamma_self': rnd.uniform(0.05,0.12,nlines),
+        'n_air': rnd.uniform(0.5,0.8,nlines),
+        'delta_air': rnd.uniform(-0.005,0,nlines),
+    }
+    dirname = get_columnar_dir(llst_name)
+    os.makedirs(dirname)
+    for parname in data:
+        np.save(os.path.join(dirname,parname+'.npy'),data[parname])
+    header = {'linelist':llst_name,'number_of_rows':nlines,'order':'nu','isotopologue_alias_ids':[1],
+        'columns':{parname:{'dtype':data[parname].dtype.str,
+            'min':data[parname].min().item(),'max':data[parname].max().item()} for parname in data}}
+    with open(os.path.join(dirname,COLUMNAR_HEADER),'w') as f:
+        json.dump(header,f)
+
+def test_lbl_windows_consistency():
+
+    llst_name = 'lbl_windows_%s'%uuid()
+    make_columnar_linelist(llst_name,NLINES)
+    lines = LinesFromColumns(llst_name)
+    wngrid = np.arange(1990.,2510.,0.01)
+    line_budget = NLINES//10
+    wing = get_max_wing(lines.get_limits(),{},ENVIRONMENT,DILUENT)
+
+    nlines_max = []
+    def calc(tablename,grid):
+        nlines_max.append(len(hapi.LOCAL_TABLE_CACHE[tablename]['data']['nu']))
+        return absorptionCoefficient_Voigt(SourceTables=tablename,WavenumberGrid=grid,
+            Environment=ENVIRONMENT,Diluent=DILUENT)[1]
+
+    elapsed_time_full,xsc_full = timeit(calc_windows,lines,wngrid,calc)
+    nlines_max.clear()
+    elapsed_time,xsc = timeit(calc_windows,lines,wngrid,calc,line_budget,wing)
+
+    assert max(nlines_max)<=line_budget
+    assert np.allclose(xsc,xsc_full,rtol=1e-12,atol=1e-12*xsc_full.max())
+
+    test_results = Collection()
+    test_results.update({'nlines':NLINES,'line_budget':line_budget,'wing':wing,
+        'nwindows':len(nlines_max),'nlines_max':max(nlines_max),
+        'elapsed_time_full':elapsed_time_full})
+
+    return elapsed_time,test_results
+
+def test_lbl_windows_database():
+
+    filestem = 'lbl_windows_db_%s'%uuid()
+    make_transitions_file(filestem,NLINES,seed=8)
+    Transition.update(make_header(filestem),local=False,llst_name=filestem)
+    save_columns(filestem)
+
+    lines = LinesFromDatabase(Linelist(filestem).transitions)
+    lines_ref = LinesFromColumns(filestem)
+
+    edges = np.linspace(1000.,2000.,LBL_WINDOW_BINS+1)
+    elapsed_time,counts = timeit(lines.get_histogram,edges)
+    counts_ref = lines_ref.get_histogram(edges)
+    assert counts.sum()==counts_ref.sum()
+    assert np.abs(counts-counts_ref).sum()<=1e-3*counts.sum() # rounding at the bin edges
+    assert lines.get_limits()==lines_ref.get_limits()
+
+    lines.load('~scratch_db',(1500.,1510.))
+    lines_ref.load('~scratch',(1500.,1510.))
+    assert sorted(hapi.LOCAL_TABLE_CACHE['~scratch_db']['data']['nu'])==\
+        hapi.LOCAL_TABLE_CACHE['~scratch']['data']['nu'].tolist()
+
+    test_results = Collection()
+    test_results.update({'nlines':NLINES,'nbins':LBL_WINDOW_BINS})
+
+    return elapsed_time,test_results
+
+def make_kernel_inputs(nlines,numin=2000.,numax=2500.,seed=0):
+    """ Make the synthetic inputs of the CALC* kernels. """
+    rnd = np.random.default_rng(seed)
+    NU = rnd.uniform(numin,numax,nlines)
+    SW = 10**rnd.uniform(-26,-19,nlines)
+    ELOWER = rnd.uniform(0,5000,nlines)
+    MOLEC_ID = np.full(nlines,2,dtype=np.int64)
+    LOCAL_ISO_ID = np.ones(nlines,dtype=np.int64)
+    GAMMA_L = rnd.uniform(0.05,0.1,nlines)
+    GAMMA_D = rnd.uniform(0.002,0.004,nlines)
+    DELTA = rnd.uniform(-0.005,0,nlines)
+    return NU,SW,ELOWER,MOLEC_ID,LOCAL_ISO_ID,GAMMA_L,GAMMA_D,DELTA,np.int64(nlines)
+
+def test_lbl_uniform_kernel():
+
+    Omegas = arange_(1990.,2510.,0.01)
+    OmegaWing = 0.0; OmegaWingHW = 5.0
+
+    def run(kernel,nlines,*reflect):
+        return kernel(Omegas,*make_kernel_inputs(nlines),OmegaWing,OmegaWingHW,*reflect,1)
+
+    run(CALCat_,10,False); run(CALCu_,10) # warm up
+
+    test_results = Collection()
+    for nlines in NLINES_KERNEL:
+        elapsed_time_at,Xsect_at = timeit(run,CALCat_,nlines,False)
+        elapsed_time,Xsect = timeit(run,CALCu_,nlines)
+        assert np.allclose(Xsect,Xsect_at,rtol=1e-9,atol=1e-9*Xsect_at.max())
+        test_results.update({'nlines':nlines,'npnts':len(Omegas),
+            'CALCat_':elapsed_time_at,'CALCu_':elapsed_time,
+            'speedup':elapsed_time_at/elapsed_time})
+
+    return elapsed_time,test_results
+
+def test_lbl_reduction_scaling():
+
+    Omegas = arange_(1990.,2510.,0.01)
+    OmegaWing = 0.0; OmegaWingHW = 5.0
+    nlines = NLINES_KERNEL[0]
+    INPUTS = make_kernel_inputs(nlines)
+    
+    def run(reduction):
+        return CALC_REDUCE_(Omegas,*INPUTS,OmegaWing,OmegaWingHW,False,1,reduction)
+
+    Xsect_ref = CALCat_(Omegas,*INPUTS,OmegaWing,OmegaWingHW,False,1)
+    
+    nthreads_max = numba.config.NUMBA_NUM_THREADS
+    test_results = Collection()
+    try:
+        for nthreads in range(1,nthreads_max+1):
+            numba.set_num_threads(nthreads)
+            for reduction in ['atomic','private','tiled']:
+                run(reduction) # warm up
+                elapsed_time,Xsect = timeit(run,reduction)
+                assert np.allclose(Xsect,Xsect_ref,rtol=1e-9,atol=1e-9*Xsect_ref.max())
+                test_results.update({'nlines':nlines,'npnts':len(Omegas),'nthreads':nthreads,
+                    'reduction':reduction,'elapsed_time':elapsed_time})
+    finally:
+        numba.set_num_threads(nthreads_max)
+
+    # the half-profile reflection is calculated by CALCat_ whatever the reduction is
+    Xsect_reflect = CALCat_(Omegas,*INPUTS,OmegaWing,OmegaWingHW,True,1)
+    for reduction in ['atomic','private','tiled']:
+        Xsect = CALC_REDUCE_(Omegas,*INPUTS,OmegaWing,OmegaWingHW,True,1,reduction)
+        assert np.allclose(Xsect,Xsect_reflect,rtol=1e-9,atol=1e-9*Xsect_reflect.max())
+
+    return elapsed_time,test_results
+
+def test_lbl_multi_layer():
+
+    llst_name = 'lbl_multi_%s'%uuid()
+    make_columnar_linelist(llst_name,NLINES)
+    lines = LinesFromColumns(llst_name)
+    wngrid = np.arange(1990.,2510.,0.01)
+    Environments = [{'T':T,'p':p} for T,p in zip(np.linspace(200.,300.,NLAYERS),np.logspace(-3,0,NLAYERS))]
+    Diluents = [{'air':1.-vmr,'self':vmr} for vmr in np.linspace(0.,0.1,NLAYERS)]
+
+    def calc_loop(tablename,grid):
+        return np.array([absorptionCoefficient_Voigt(SourceTables=tablename,WavenumberGrid=grid,
+            Environment=Environment,Diluent=Diluent)[1] for Environment,Diluent in zip(Environments,Diluents)])
+
+    def calc_multi(layout):
+        def calc(tablename,grid):
+            return absorptionCoefficient_Multi(1,None,SourceTables=tablename,WavenumberGrid=grid,
+                Environments=Environments,Diluents=Diluents,layout=layout)[1]
+        return calc
+
+    calc_windows(lines,wngrid[:10],calc_multi('auto'),nlayers=NLAYERS) # warm up
+    elapsed_time_loop,xsc_loop = timeit(calc_windows,lines,wngrid,calc_loop)
+    
+    test_results = Collection()
+    for layout in ['layers','lines','auto']:
+        elapsed_time,xsc = timeit(calc_windows,lines,wngrid,calc_multi(layout))
+        assert xsc.shape==(NLAYERS,len(wngrid))
+        assert np.allclose(xsc,xsc_loop,rtol=1e-9,atol=1e-9*xsc_loop.max())
+        test_results.update({'nlines':NLINES,'nlayers':NLAYERS,'layout':layout,
+            'elapsed_time_loop':elapsed_time_loop,'elapsed_time':elapsed_time,
+            'speedup':elapsed_time_loop/elapsed_time})
+
+    # windowed calculation of the layers
+    line_budget = NLINES//10
+    wing = max([get_max_wing(lines.get_limits(),{},Environment,Diluent) \
+        for Environment,Diluent in zip(Environments,Diluents)])
+    xsc = calc_windows(lines,wngrid,calc_multi('auto'),line_budget,wing,nlayers=NLAYERS)
+    assert np.allclose(xsc,xsc_loop,rtol=1e-6,atol=1e-6*xsc_loop.max())
+
+    return elapsed_time,test_results
+
+def test_lbl_lut():
+
+    llst_name = 'lbl_lut_%s'%uuid()
+    make_columnar_linelist(llst_name,NLINES//10)
+    LinesFromColumns(llst_name).load('~scratch')
+    wngrid = np.arange(2000.,2100.,0.01)
+    temperatures = np.linspace(200.,320.,13)
+    pressures = np.logspace(-3,0,13)
+    vmrs = [0.,0.02,0.04]
+
+    nchunks_max = 10
+    def calc(Environments,vmr):
+        if nchunks_max is not None and len(CHUNKS)>=nchunks_max:
+            raise KeyboardInterrupt
+        CHUNKS.append(vmr)
+        return absorptionCoefficient_Multi(1,None,SourceTables='~scratch',WavenumberGrid=wngrid,
+            Environments=Environments,Diluents={'air':1.-vmr,'self':vmr})[1]
+
+    dirname = os.path.join(tempfile.mkdtemp(),'lut')
+    lut = LUT.create(dirname,wngrid,temperatures,pressures,vmrs,'CO2')
+
+    # interrupted build
+    CHUNKS = []
+    try:
+        lut.build('CO2',calc)
+    except KeyboardInterrupt:
+        pass
+    assert len(CHUNKS)==nchunks_max
+    assert not lut.is_complete('CO2')
+
+    # resumed build
+    CHUNKS = []; nchunks_max = None
+    lut = LUT.create(dirname,wngrid,temperatures,pressures,vmrs,'CO2')
+    elapsed_time_build,nchunks = timeit(lut.build,'CO2',calc)
+    assert nchunks==len(pressures)*len(vmrs)-10
+    assert lut.is_complete('CO2')
+
+    # interpolation at nodes and between nodes
+    lut = LUT(dirname)
+    xsc_node = lut.interpolate('CO2',temperatures[2],pressures[3],vmrs[1])
+    xsc_ref = calc([{'T':temperatures[2],'p':pressures[3]}],vmrs[1])[0]
+    assert np.allclose(xsc_node,xsc_ref,rtol=1e-6,atol=1e-6*xsc_ref.max())
+
+    nconds = 1000
+    rnd = np.random.default_rng(0)
+    TS = rnd.uniform(temperatures[0],temperatures[-1],nconds)
+    PS = np.exp(rnd.uniform(np.log(pressures[0]),np.log(pressures[-1]),nconds))
+    VMRS = rnd.uniform(vmrs[0],vmrs[-1],nconds)
+    elapsed_time,XSC = timeit(lut.interpolate,'CO2',TS,PS,VMRS)
+    assert XSC.shape==(nconds,len(wngrid))
+
+    XSC_REF = calc([{'T':T,'p':p} for T,p in zip(TS[:10],PS[:10])],VMRS[0])
+    XSC_LUT = lut.interpolate('CO2',TS[:10],PS[:10],VMRS[0])
+    rel_err = (np.abs(XSC_LUT-XSC_REF).sum(axis=1)/XSC_REF.sum(axis=1)).max() # integral error
+    assert rel_err<0.05
+
+    test_results = Collection()
+    test_results.update({'nlines':NLINES//10,'npnts':len(wngrid),'shape':lut.get_shape_(),
+        'nconds':nconds,'elapsed_time_build':elapsed_time_build,'max_rel_err':rel_err})
+
+    return elapsed_time,test_results
+
+def test_lbl_adaptive_grid():
+
+    Omegas = arange_(1990.,2510.,0.01)
+    OmegaWing = 25.0; OmegaWingHW = 5.0
+    nlines = NLINES_KERNEL[0]//10
+    INPUTS = make_kernel_inputs(nlines)
+
+    def run(WingTolerance,reduction='private'):
+        return CALC_REDUCE_(Omegas,*INPUTS,OmegaWing,OmegaWingHW,False,1,reduction,WingTolerance)
+
+    run(None); run(1e-3) # warm up
+    elapsed_time_exact,Xsect_ref = timeit(run,None)
+
+    # the per-thread buffers over the limit are replaced with the shared atomic buffer
+    PRIVATE_BUFFER_LIMIT = numba_settings.PRIVATE_BUFFER_LIMIT
+    try:
+        numba_settings.PRIVATE_BUFFER_LIMIT = 0
+        Xsect_shared = run(1e-3,None)
+    finally:
+        numba_settings.PRIVATE_BUFFER_LIMIT = PRIVATE_BUFFER_LIMIT
+    assert np.allclose(Xsect_shared,run(1e-3),rtol=1e-9,atol=1e-9*Xsect_ref.max())
+
+    test_results = Collection()
+    for WingTolerance in [1e-2,1e-3,1e-4,1e-5]:
+        elapsed_time,Xsect = timeit(run,WingTolerance)
+        rel_err = np.max(np.abs(Xsect-Xsect_ref)/Xsect_ref)
+        assert rel_err<=WingTolerance
+        test_results.update({'nlines':nlines,'npnts':len(Omegas),'WingTolerance':WingTolerance,
+            'max_rel_err':rel_err,'elapsed_time_exact':elapsed_time_exact,
+            'elapsed_time':elapsed_time,'speedup':elapsed_time_exact/elapsed_time})
+
+    return elapsed_time,test_results
+
+def test_lbl_prefilter():
+
+    llst_name = 'lbl_prefilter_%s'%uuid()
+    make_columnar_linelist(llst_name,NLINES)
+    LinesFromColumns(llst_name).load('~scratch')
+    wngrid = np.arange(1990.,2510.,0.01)
+    j0,j1 = np.searchsorted(wngrid,[2200.,2250.])
+
+    def calc(grid,**kwargs):
+        return absorptionCoefficient_Voigt(SourceTables='~scratch',WavenumberGrid=grid,
+            Environment=ENVIRONMENT,Diluent=DILUENT,**kwargs)[1]
+
+    # lines out of the grid don't contribute
+    xsc_full = calc(wngrid)
+    xsc = calc(wngrid[j0:j1])
+    assert np.allclose(xsc,xsc_full[j0:j1],rtol=1e-12,atol=1e-12*xsc_full.max())
+
+    # weak lines
+    elapsed_time_full,xsc_full = timeit(calc,wngrid)
+    test_results = Collection()
+    for threshold in [1e-6,1e-4,1e-2]:
+        elapsed_time,xsc = timeit(calc,wngrid,RelativeIntensityThreshold=threshold)
+        NU,SW = [hapi.LOCAL_TABLE_CACHE['~scratch']['data'][par] for par in ('nu','sw')]
+        nkept = len(PREFILTER_LINES(wngrid,NU,SW,np.zeros(NLINES),np.zeros(NLINES),
+            0.,0.,0.,threshold))
+        rel_err = np.abs(xsc-xsc_full).sum()/xsc_full.sum()
+        assert rel_err<=10*threshold
+        test_results.update({'nlines':NLINES,'threshold':threshold,'nremoved':NLINES-nkept,
+            'rel_err':rel_err,'elapsed_time_full':elapsed_time_full,'elapsed_time':elapsed_time,
+            'speedup':elapsed_time_full/elapsed_time})
+
+    return elapsed_time,test_results
+
+def test_lbl_partition_function():
+
+    M,I = 2,1
+    TT = np.array(hapi.TIPS_2021_ISOT_HASH[(M,I)],dtype=np.float64)
+    QQ = np.array(hapi.TIPS_2021_ISOQ_HASH[(M,I)],dtype=np.float64)
+    rnd = np.random.default_rng(0)
+    TS = np.concatenate([TT,rnd.uniform(TT[0],TT[-1],NLAYERS*1000)])
+
+    elapsed_time_table,table = timeit(PartitionFunctionTable,TT,QQ)
+    elapsed_time_atob,QS_atob = timeit(lambda: np.array([hapi.AtoB(T,TT,QQ,len(TT)) for T in TS]))
+    elapsed_time,QS = timeit(table,TS)
+    rel_err = np.abs(QS/QS_atob-1).max()
+    assert rel_err<1e-10
+    assert np.abs(QS[:len(TT)]/QQ-1).max()<1e-12
+    assert type(table(296.)) is float
+
+    test_results = Collection()
+    test_results.update({'ntemps':len(TS),'max_rel_err':rel_err,
+        'elapsed_time_table':elapsed_time_table,'elapsed_time_atob':elapsed_time_atob,
+        'elapsed_time':elapsed_time,'speedup':elapsed_time_atob/elapsed_time})
+
+    return elapsed_time,test_results
+
+STARTUP_SCRIPT = """
+from time import time
+t = time()
+import hapi2
+t_import = time()-t
+t = time()
+hapi2.opacity.warmup()
+print('STARTUP %f %f'%(t_import,time()-t))
+"""
+
+def make_numba_cache_workdir():
+    """ Make the working folder with the config file turning on the Numba cache. """
+    workdir = tempfile.mkdtemp()
+    with open(os.path.join(workdir,CONFIG_FILE),'w') as f:
+        json.dump(dict(SETTINGS_DEFAULT,numba_cache=True,
+            numba_cache_dir=os.path.join(workdir,'numba_cache')),f,indent=3)
+    env = dict(os.environ,PYTHONPATH=os.pathsep.join(
+        [os.path.dirname(os.path.dirname(hapi2.__file__)),os.environ.get('PYTHONPATH','')]))
+    return workdir,env
+
+def test_lbl_numba_cache_startup():
+
+    workdir,env = make_numba_cache_workdir()
+
+    def startup():
+        output = subprocess.run([sys.executable,'-c',STARTUP_SCRIPT],cwd=workdir,env=env,
+            capture_output=True,text=True,check=True).stdout
+        line, = [line for line in output.splitlines() if line.startswith('STARTUP')]
+        return [float(val) for val in line.split()[1:]]
+
+    test_results = Collection()
+    TOTALS = []
+    for run in ['cold','warm']:
+        t_import,t_warmup = startup()
+        TOTALS.append(t_import+t_warmup)
+        test_results.update({'run':run,'import':t_import,'warmup':t_warmup,'total':TOTALS[-1]})
+    cold,warm = TOTALS
+    assert os.listdir(os.path.join(workdir,'numba_cache'))
+    assert warm<cold
+
+    return warm,test_results
+
+KERNELS_IMPORT_SCRIPT = """
+import numba
+import hapi2
+from hapi2.opacity.lbl.numba import fast_abscoef, settings
+print('KERNELS %s %s'%(settings.CACHE,numba.config.CACHE_DIR))
+"""
+
+def test_lbl_numba_settings_before_init():
+
+    workdir,env = make_numba_cache_workdir()
+
+    elapsed_time,output = timeit(subprocess.run,[sys.executable,'-c',KERNELS_IMPORT_SCRIPT],
+        cwd=workdir,env=env,capture_output=True,text=True,check=True)
+    line, = [line for line in output.stdout.splitlines() if line.startswith('KERNELS')]
+    cache,cache_dir = line.split()[1:]
+
+    # the settings of the config file are applied to the kernels imported without hapi2.init
+    assert cache=='True'
+    assert cache_dir==os.path.join(workdir,'numba_cache','kernels-%s'%numba_settings.get_cache_key_())
+
+    # the kernels compiled with the other constants are cached in the other folder
+    ADAPTIVE_CORE_HW = numba_settings.ADAPTIVE_CORE_HW
+    try:
+        numba_settings.ADAPTIVE_CORE_HW = 2*ADAPTIVE_CORE_HW
+        assert cache_dir!=os.path.join(workdir,'numba_cache','kernels-%s'%numba_settings.get_cache_key_())
+    finally:
+        numba_settings.ADAPTIVE_CORE_HW = ADAPTIVE_CORE_HW
+
+    test_results = Collection()
+    test_results.update({'numba_cache':cache,'numba_cache_dir':cache_dir})
+
+    return elapsed_time,test_results
+
+TEST_CASES = [
+    test_lbl_windows_consistency,
+    test_lbl_windows_database,
+    test_lbl_uniform_kernel,
+    test_lbl_reduction_scaling,
+    test_lbl_multi_layer,
+    test_lbl_lut,
+    test_lbl_adaptive_grid,
+    test_lbl_prefilter,
+    test_lbl_partition_function,
+    test_lbl_numba_cache_startup,
+    test_lbl_numba_settings_before_init,
+]
+
+def do_tests(TEST_CASES,testgroup=None,session_name=None): # test all functions
+
+    if testgroup is None:
+        testgroup = os.path.basename(__file__)
+
+    session_uuid = uuid()
+
+    for test_fun in TEST_CASES:
+        runtest(test_fun,testgroup,session_name,session_uuid,save=True)
+
+if __name__=='__main__':
+
+    try:
+        session_name = sys.argv[1]
+    except IndexError:
+        session_name = '__not_supplied__'
+
+    do_tests(TEST_CASES,session_name=session_name)
@@ -1,9 +1,107 @@
+import os
 import sys
+import gzip
+import time
+import hashlib
+import tempfile
+import threading
+import http.server
+import numpy as np
+from functools import partial
+from contextlib import nullcontext
+
 from hapi2.collect import Collection, uuid
-from hapi2 import Molecule
+from hapi2 import Molecule, Linelist
+from hapi2.config import SETTINGS
+from hapi2.web.server import LocalAPIServer, SyntheticDatabase, use_local_server, \
+    benchmark, BENCHMARK_CASES
 
 from unittests import timeit, runtest
 
+NFILES = 40
+LATENCY = 0.1 # sec
+LIVE = bool(os.environ.get('HAPI2_TEST_LIVE')) # test against HITRANonline instead of the local stand-in
+
+class SlowFilesHandler(http.server.SimpleHTTPRequestHandler):
+    """ Serve files with the latency, failing the first request of every 5th file. """
+    
+    lock = threading.Lock()
+    active = 0; max_active = 0; failed = set()
+    
+    def do_GET(self):
+        cls = self.__class__
+        with cls.lock:
+            cls.active += 1; cls.max_active = max(cls.max_active,cls.active)
+            fail = self.path.endswith('0.txt') and self.path not in cls.failed
+            if fail: cls.failed.add(self.path)
+        try:
+            time.sleep(LATENCY)
+            if fail:
+                self.send_error(503)
+            else:
+                super().do_GET()
+        finally:
+            with cls.lock: cls.active -= 1
+
+    def log_message(self,*args):
+        pass
+
+class GzipFilesHandler(http.server.SimpleHTTPRequestHandler):
+    """ Serve files with the gzip content encoding if the client accepts it. """
+
+    def do_GET(self):
+        with open(self.translate_path(self.path),'rb') as f:
+            data = f.read()
+        gzipped = 'gzip' in self.headers.get('Accept-Encoding','')
+        if gzipped: data = gzip.compress(data,compresslevel=1)
+        self.send_response(200)
+        if gzipped: self.send_header('Content-Encoding','gzip')
+        self.send_header('Content-Length',str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self,*args):
+        pass
+
+class CachingFilesHandler(http.server.SimpleHTTPRequestHandler):
+    """ Serve files with ETags and byte ranges, the first response can be cut at cut_at bytes. """
+
+    cut_at = None; nbytes_sent = 0; requests = []
+
+    def do_GET(self):
+        cls = self.__class__
+        with open(self.translate_path(self.path),'rb') as f:
+            data = f.read()
+        etag = '"%s"'%hashlib.md5(data).hexdigest()
+        cls.requests.append((self.path,dict(self.headers)))
+        if self.headers.get('If-None-Match')==etag:
+            self.send_response(304); self.end_headers()
+            return
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range')==etag:
+            start = int(self.headers['Range'][len('bytes='):].split('-')[0])
+            self.send_response(206)
+            self.send_header('Content-Range','bytes %d-%d/%d'%(start,len(data)-1,len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag',etag)
+        self.send_header('Content-Length',str(len(data)-start))
+        self.end_headers()
+        data = data[start:]
+        if cls.cut_at is not None:
+            data = data[:cls.cut_at]; cls.cut_at = None
+        self.wfile.write(data)
+        cls.nbytes_sent += len(data)
+
+    def log_message(self,*args):
+        pass
+
+def start_files_server(directory,handler=SlowFilesHandler):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1',0),
+        partial(handler,directory=directory))
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return server
+
 def fetch_objects(fetch_func,*args,**argv):    
     
     elapsed_time,objs = timeit(fetch_func,*args,**argv)    
@@ -72,28 +170,286 @@ def test_fetch_cross_section_spectra_ccl4():
     
     return elapsed_time,test_results
 
+def test_fetch_files_concurrent():
+
+    from hapi2 import fetch_files
+
+    datadir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(datadir,'data','xsec'))
+    for i in range(NFILES):
+        with open(os.path.join(datadir,'data','xsec','%d.txt'%i),'w') as f:
+            f.write('%d\n'%i*10000)
+    server = start_files_server(datadir)
+    SETTINGS_ORIG = {key:SETTINGS[key] for key in ('host','tmpdir')}
+    SETTINGS.update({'host':'http://127.0.0.1:%d'%server.server_address[1],
+        'tmpdir':tempfile.mkdtemp()})
+    tasks = [('data/xsec','%d.txt'%i) for i in range(NFILES)]
+    
+    test_results = Collection()
+    TIMES = []
+    try:
+        for workers,host_limit in [(1,1),(8,4),(16,16)]:
+            SlowFilesHandler.max_active = 0; SlowFilesHandler.failed = set()
+            elapsed_time,paths = timeit(fetch_files,tasks,workers=workers,
+                host_limit=host_limit,backoff=0.01)
+            for i,path in enumerate(paths):
+                with open(path) as f:
+                    assert f.read()=='%d\n'%i*10000
+            assert SlowFilesHandler.max_active<=host_limit
+            assert len(SlowFilesHandler.failed)==NFILES//10
+            TIMES.append(elapsed_time)
+            test_results.update({'nfiles':NFILES,'workers':workers,'host_limit':host_limit,
+                'max_active':SlowFilesHandler.max_active,'elapsed_time':elapsed_time})
+    finally:
+        SETTINGS.update(SETTINGS_ORIG)
+        server.shutdown()
+    sequential,concurrent,_ = TIMES
+    assert concurrent<sequential/2
+
+    return concurrent,test_results
+
+def test_fetch_file_streaming():
+
+    from hapi2.web.api import fetch_file, DOWNLOAD_CHUNK
+
+    datadir = tempfile.mkdtemp()
+    # multi-byte characters are split by the chunk boundaries
+    data = ('x'+'\u00e9\u20ac'*1000+'\n').encode('utf-8')*10000
+    os.makedirs(os.path.join(datadir,'data'))
+    with open(os.path.join(datadir,'data','big.txt'),'wb') as f:
+        f.write(data)
+    server = start_files_server(datadir,GzipFilesHandler)
+    SETTINGS_ORIG = {key:SETTINGS[key] for key in ('host','tmpdir','fetch_gzip','fetch_cache')}
+    SETTINGS.update({'host':'http://127.0.0.1:%d'%server.server_address[1],
+        'tmpdir':tempfile.mkdtemp(),'fetch_cache':False})
+    
+    test_results = Collection()
+    TIMES = []
+    try:
+        for fetch_gzip in [False,True]:
+            SETTINGS['fetch_gzip'] = fetch_gzip
+            PROGRESS = []
+            elapsed_time,path = timeit(fetch_file,'data','big.txt',
+                progress=lambda nbytes,nbytes_total:PROGRESS.append((nbytes,nbytes_total)))
+            with open(path,'rb') as f:
+                assert f.read()==data
+            nbytes,nbytes_total = PROGRESS[-1]
+            assert nbytes==nbytes_total and len(PROGRESS)>=nbytes//DOWNLOAD_CHUNK
+            assert (nbytes<len(data))==fetch_gzip
+            TIMES.append(elapsed_time)
+            test_results.update({'gzip':fetch_gzip,'size_mb':len(data)/2**20,
+                'transferred_mb':nbytes/2**20,'nchunks':len(PROGRESS),
+                'elapsed_time':elapsed_time,'mb_per_sec':len(data)/2**20/elapsed_time})
+    finally:
+        SETTINGS.update(SETTINGS_ORIG)
+        server.shutdown()
+
+    return TIMES[0],test_results
+
+def test_fetch_file_cache():
+
+    from hapi2.web.api import fetch_file
+
+    datadir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(datadir,'data'))
+    rnd = np.random.default_rng(0)
+    DATA = {}
+    for i in range(4):
+        DATA[i] = rnd.integers(0,256,20*2**20,dtype=np.uint8).tobytes()
+        with open(os.path.join(datadir,'data','%d.dat'%i),'wb') as f:
+            f.write(DATA[i])
+    server = start_files_server(datadir,CachingFilesHandler)
+    SETTINGS_ORIG = {key:SETTINGS[key] for key in ('host','tmpdir','fetch_cache','fetch_cache_dir','fetch_cache_size')}
+    SETTINGS.update({'host':'http://127.0.0.1:%d'%server.server_address[1],
+        'tmpdir':tempfile.mkdtemp(),'fetch_cache':True,'fetch_cache_dir':tempfile.mkdtemp(),
+        'fetch_cache_size':50*2**20})
+    
+    def fetch(i):
+        CachingFilesHandler.nbytes_sent = 0
+        elapsed_time,path = timeit(fetch_file,'data','%d.dat'%i)
+        with open(path,'rb') as f:
+            assert f.read()==DATA[i]
+        return elapsed_time,CachingFilesHandler.nbytes_sent
+    
+    test_results = Collection()
+    try:
+        # interrupted download is resumed
+        CachingFilesHandler.cut_at = 5*2**20
+        try:
+            fetch_file('data','0.dat')
+            raise AssertionError('download must fail')
+        except Exception as e:
+            if type(e) is AssertionError: raise
+        elapsed_time_cold,nbytes = fetch(0)
+        assert nbytes==len(DATA[0])-5*2**20
+        assert 'Range' in CachingFilesHandler.requests[-1][1]
+        test_results.update({'case':'resumed','elapsed_time':elapsed_time_cold,'nbytes_sent':nbytes})
+        # cached file is revalidated
+        elapsed_time,nbytes = fetch(0)
+        assert nbytes==0
+        test_results.update({'case':'cached','elapsed_time':elapsed_time,'nbytes_sent':nbytes})
+        # modified file is downloaded again
+        DATA[0] = DATA[0][::-1]
+        with open(os.path.join(datadir,'data','0.dat'),'wb') as f:
+            f.write(DATA[0])
+        elapsed_time,nbytes = fetch(0)
+        assert nbytes==len(DATA[0])
+        test_results.update({'case':'modified','elapsed_time':elapsed_time,'nbytes_sent':nbytes})
+        # least recently used files are evicted
+        for i in [1,2,0,3]:
+            fetch(i)
+        for i in [0,3]:
+            assert fetch(i)[1]==0
+        assert fetch(1)[1]==len(DATA[1])
+        objects = os.listdir(os.path.join(SETTINGS['fetch_cache_dir'],'objects'))
+        assert sum(os.path.getsize(os.path.join(SETTINGS['fetch_cache_dir'],'objects',obj)) 
+            for obj in objects)<=SETTINGS['fetch_cache_size']
+        test_results.update({'case':'evicted','nobjects':len(objects)})
+    finally:
+        SETTINGS.update(SETTINGS_ORIG)
+        server.shutdown()
+
+    return elapsed_time_cold,test_results
+
+def test_fetch_file_cache_shared():
+
+    from hapi2.web.cache import DownloadCache, CACHE_INDEX
+
+    datadir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(datadir,'data'))
+    rnd = np.random.default_rng(1)
+    DATA = {}
+    for i in range(4):
+        DATA[i] = rnd.integers(0,256,4*2**20,dtype=np.uint8).tobytes()
+        with open(os.path.join(datadir,'data','%d.dat'%i),'wb') as f:
+            f.write(DATA[i])
+    server = start_files_server(datadir,CachingFilesHandler)
+    host = 'http://127.0.0.1:%d'%server.server_address[1]
+    
+    # two caches on the same folder stand for two processes sharing fetch_cache_dir
+    cache_dir = tempfile.mkdtemp(); outdir = tempfile.mkdtemp()
+    CACHES = [DownloadCache(cache_dir,2**30) for _ in range(2)]
+    ERRORS = []
+    
+    def fetch(j):
+        i = j%len(DATA)
+        path = os.path.join(outdir,'%d.dat'%j)
+        try:
+            CACHES[j%2].fetch('%s/data/%d.dat'%(host,i),path)
+            with open(path,'rb') as f:
+                assert f.read()==DATA[i]
+        except Exception as e:
+            ERRORS.append(e)
+    
+    def fetch_all():
+        threads = [threading.Thread(target=fetch,args=(j,)) for j in range(4*len(DATA))]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+    
+    CachingFilesHandler.nbytes_sent = 0
+    try:
+        elapsed_time,_ = timeit(fetch_all)
+    finally:
+        server.shutdown()
+    
+    assert not ERRORS, ERRORS
+    # each file is downloaded once, the concurrent fetches wait and revalidate it
+    assert CachingFilesHandler.nbytes_sent==sum(len(data) for data in DATA.values())
+    # index entries saved by both caches are kept
+    index = DownloadCache(cache_dir,2**30).index
+    assert sorted(index)==sorted('%s/data/%d.dat'%(host,i) for i in DATA)
+    assert len(os.listdir(os.path.join(cache_dir,'objects')))==len(DATA)
+    
+    test_results = Collection()
+    test_results.update({'nfiles':len(DATA),'nfetches':4*len(DATA),
+        'nbytes_sent':CachingFilesHandler.nbytes_sent})
+
+    return elapsed_time,test_results
+
+def test_fetch_transitions_pipelined():
+
+    from hapi2 import fetch_transitions
+
+    isos = Molecule('co2').isotopologues
+    session_id = uuid()
+    
+    test_results = Collection()
+    NLINES = {}
+    for pipelined in [True,False]:
+        llst_name = 'co2_%s_%s'%('pipelined' if pipelined else 'plain',session_id)
+        elapsed_time,_ = timeit(fetch_transitions,isos,1000,1500,llst_name,pipelined=pipelined)
+        NLINES[pipelined] = Linelist(llst_name).transitions.count()
+        test_results.update({'pipelined':pipelined,'elapsed_time':elapsed_time,
+            'nlines':NLINES[pipelined],'lines_per_sec':NLINES[pipelined]/elapsed_time})
+        if pipelined: elapsed_time_pipelined = elapsed_time
+    assert NLINES[True]==NLINES[False]>0
+    
+    return elapsed_time_pipelined,test_results
+
+def test_local_server_benchmark():
+
+    database = SyntheticDatabase(nmolecules=2,nisotopologues=2,line_density=10)
+    with LocalAPIServer(database,latency=0.01) as server:
+        elapsed_time,RESULTS = timeit(benchmark,server,nruns=2,numin=0,numax=200)
+
+    assert set(result['case'] for result in RESULTS)==set(BENCHMARK_CASES)
+    for result in RESULTS:
+        if result['case'].startswith('transitions'):
+            assert result['nitems']==database.nmolecules*database.nisotopologues*\
+                database.line_density*200
+    
+    test_results = Collection()
+    test_results.update(RESULTS)
+    
+    return elapsed_time,test_results
+
+def test_local_server_relative_datadir():
+
+    from hapi2.web.server import XSEC_DIR
+
+    database = SyntheticDatabase(nmolecules=1,nisotopologues=1,ncross_sections=1)
+    datadir = os.path.relpath(tempfile.mkdtemp())
+    filename = database.cross_sections[0]['filename']
+    with LocalAPIServer(database,datadir) as server:
+        elapsed_time,path = timeit(server.get_file_path,'/%s/%s'%(XSEC_DIR,filename))
+        assert path==os.path.abspath(os.path.join(datadir,XSEC_DIR,filename))
+        assert server.get_file_path('/../%s'%filename) is None
+    
+    test_results = Collection()
+    test_results.update({'datadir':datadir,'path':path})
+    
+    return elapsed_time,test_results
+
 TEST_CASES = [
+    test_local_server_benchmark,
+    test_local_server_relative_datadir,
+    test_fetch_file_cache,
+    test_fetch_file_cache_shared,
+    test_fetch_file_streaming,
+    test_fetch_files_concurrent,
     test_fetch_info,
     test_fetch_parameter_metas_all,
     test_fetch_sources_all,
     test_fetch_molecules_all,
     test_fetch_isotopologues_all,
     test_fetch_transitions_water_tiny,
+    test_fetch_transitions_pipelined,
     #test_fetch_transitions_water_normal,
     #test_fetch_transitions_co2_large,
-    #test_fetch_cross_section_headers_ccl4,
-    #test_fetch_cross_section_spectra_ccl4,
+    test_fetch_cross_section_headers_ccl4,
+    test_fetch_cross_section_spectra_ccl4,
 ]
 
 def do_tests(TEST_CASES,testgroup=None,session_name=None): # test all functions    
 
     if testgroup is None:
-        testgroup = __file__
+        testgroup = os.path.basename(__file__)
 
     session_uuid = uuid()
     
-    for test_fun in TEST_CASES:        
-        runtest(test_fun,testgroup,session_name,session_uuid,save=True)
+    with nullcontext() if LIVE else use_local_server():
+        for test_fun in TEST_CASES:        
+            runtest(test_fun,testgroup,session_name,session_uuid,save=True)
         
 if __name__=='__main__':
     